@@ -0,0 +1,181 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, Dict, Iterable, List
+
+import aiohttp
+import httplib2
+from googleapiclient.errors import HttpError
+
+from gmail2s3.gmailauth import (
+    COUNT_CACHE,
+    LIST_PAGE_SIZE,
+    GmailClient,
+    MessageList,
+    MessageQuery,
+    get_gmail_client,
+)
+from gmail2s3.ratelimit import QuotaLimiter, gmail_limiter
+
+logger = logging.getLogger(__name__)
+
+GMAIL_API = "https://gmail.googleapis.com/gmail/v1/users/me"
+
+
+class AsyncGmailClient:
+    """
+    asyncio transport to the Gmail API, built on aiohttp.
+    It exposes the listing/fetching methods of GmailClient and reuses its
+    credentials and quota limiter, so concurrent calls share one event loop.
+    Messages are returned as the Gmail JSON resources.
+    """
+
+    def __init__(
+        self,
+        gmail: GmailClient | None = None,
+        session: aiohttp.ClientSession | None = None,
+        api_url: str = GMAIL_API,
+    ):
+        self.gmail = gmail or get_gmail_client()
+        self.limiter: QuotaLimiter = gmail_limiter()
+        self.api_url = api_url
+        self._session = session
+        self._token_lock: asyncio.Lock | None = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def _access_token(self) -> str:
+        # Loading and refreshing the credentials are blocking (files, httplib2)
+        if self._token_lock is None:
+            self._token_lock = asyncio.Lock()
+        async with self._token_lock:
+            client = await asyncio.to_thread(lambda: self.gmail.client)
+            creds = client.creds
+            if creds.access_token_expired:
+                await asyncio.to_thread(creds.refresh, httplib2.Http())
+            return creds.access_token
+
+    async def _request(
+        self, method: str, path: str, params: dict | list | None = None, **kwargs
+    ) -> dict:
+        headers = {"Authorization": f"Bearer {await self._access_token()}"}
+        async with self.session.request(
+            method, f"{self.api_url}{path}", params=params, headers=headers, **kwargs
+        ) as resp:
+            content = await resp.read()
+            if resp.status >= 400:
+                # Same error as the googleapiclient transport
+                raise HttpError(
+                    httplib2.Response({"status": resp.status}),
+                    content,
+                    uri=str(resp.url),
+                )
+            return await resp.json(content_type=None)
+
+    async def call(
+        self,
+        quota_method: str,
+        method: str,
+        path: str,
+        params: dict | list | None = None,
+        **kwargs,
+    ) -> dict:
+        return await self.limiter.acall(
+            quota_method, self._request, method, path, params=params, **kwargs
+        )
+
+    async def iter_emails(
+        self, message_query: MessageQuery, page_size: int = LIST_PAGE_SIZE
+    ) -> AsyncIterator[List[dict]]:
+        """Yield the message refs matching the query page by page"""
+        params = {"q": GmailClient.build_query(message_query), "maxResults": page_size}
+        while True:
+            resp = await self.call("messages.list", "GET", "/messages", params)
+            yield resp.get("messages", [])
+            if "nextPageToken" not in resp:
+                break
+            params["pageToken"] = resp["nextPageToken"]
+
+    async def estimate_emails(self, message_query: MessageQuery) -> int:
+        """Gmail estimate of the number of messages matching the query"""
+        params = {"q": GmailClient.build_query(message_query), "maxResults": 1}
+        resp = await self.call("messages.list", "GET", "/messages", params)
+        return resp.get("resultSizeEstimate", 0)
+
+    async def count_emails(
+        self, message_query: MessageQuery, exact: bool = False
+    ) -> int:
+        """Same as GmailClient.count_emails, sharing its cache"""
+        key = (GmailClient.build_query(message_query), exact)
+        total = COUNT_CACHE.get(key)
+        if total is None:
+            if exact:
+                total = 0
+                async for page in self.iter_emails(message_query):
+                    total += len(page)
+            else:
+                total = await self.estimate_emails(message_query)
+            COUNT_CACHE.set(key, total)
+        return total
+
+    async def list_emails(self, message_query: MessageQuery) -> MessageList:
+        messages = []
+        async for page in self.iter_emails(message_query):
+            messages.extend(page)
+        return MessageList(message_refs=messages, query=message_query)
+
+    async def get_history_id(self) -> str:
+        profile = await self.call("getProfile", "GET", "/profile")
+        return profile["historyId"]
+
+    async def get_email(self, message_ref: dict, fmt: str = "full") -> dict:
+        return await self.call(
+            "messages.get", "GET", f"/messages/{message_ref['id']}", {"format": fmt}
+        )
+
+    async def get_email_date(self, message_id: str) -> datetime:
+        """
+        Date of a message, from its Date header like simplegmail,
+        to find where the sync stored it
+        """
+        message = await self.call(
+            "messages.get",
+            "GET",
+            f"/messages/{message_id}",
+            {"format": "metadata", "metadataHeaders": "Date"},
+        )
+        for header in message.get("payload", {}).get("headers", []):
+            if header["name"].lower() == "date":
+                try:
+                    return parsedate_to_datetime(header["value"]).astimezone()
+                except (TypeError, ValueError):
+                    break
+        return datetime.fromtimestamp(
+            int(message["internalDate"]) / 1000, timezone.utc
+        ).astimezone()
+
+    async def get_emails(
+        self, message_refs: Iterable[dict], fmt: str = "full", concurrency: int = 10
+    ) -> Dict[str, dict]:
+        """Fetch messages concurrently, indexed by message id"""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(ref: dict) -> dict:
+            async with semaphore:
+                return await self.get_email(ref, fmt)
+
+        messages = await asyncio.gather(*[fetch(ref) for ref in message_refs])
+        return {x["id"]: x for x in messages}
+
+    async def list_labels(self) -> Dict[str, str]:
+        resp = await self.call("labels.list", "GET", "/labels")
+        return {x["name"]: x["id"] for x in resp.get("labels", [])}
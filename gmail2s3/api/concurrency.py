@@ -0,0 +1,152 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, closing
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator
+
+from gmail2s3.config import GCONFIG
+from gmail2s3.exception import TooManyRequests
+
+logger = logging.getLogger(__name__)
+
+# Seconds a client is asked to wait when an endpoint is saturated
+RETRY_AFTER = 30
+
+_EXECUTOR: ThreadPoolExecutor | None = None
+_DONE = object()
+
+
+def blocking_executor() -> ThreadPoolExecutor:
+    """
+    Thread pool dedicated to the blocking Gmail/S3 calls of the API,
+    so they never run on the event loop nor starve the default pool.
+    """
+    global _EXECUTOR  # pylint: disable=global-statement
+    if _EXECUTOR is None:
+        _EXECUTOR = ThreadPoolExecutor(
+            max_workers=GCONFIG.gmail2s3["api_workers"],
+            thread_name_prefix="gmail2s3-api",
+        )
+    return _EXECUTOR
+
+
+def shutdown_executor() -> None:
+    global _EXECUTOR  # pylint: disable=global-statement
+    if _EXECUTOR is not None:
+        _EXECUTOR.shutdown(wait=False, cancel_futures=True)
+        _EXECUTOR = None
+
+
+async def run_blocking(func: Callable, *args, **kwargs) -> Any:
+    """Run `func` in the blocking executor, keeping the context variables"""
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(blocking_executor(), call)
+
+
+async def iter_blocking(
+    func: Callable[..., Iterator], *args, maxsize: int = 100
+) -> AsyncIterator:
+    """
+    Iterate the blocking generator `func(*args)` in the blocking executor.
+    Items are handed over through a bounded queue, a slow client pauses
+    the generator. The generator is closed when the iteration stops.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item: Any) -> bool:
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while not stop.is_set():
+            try:
+                future.result(timeout=1)
+                return True
+            except concurrent.futures.TimeoutError:
+                continue
+        future.cancel()
+        return False
+
+    def produce() -> None:
+        try:
+            with closing(func(*args)) as items:
+                for item in items:
+                    if not put(item):
+                        return
+        finally:
+            put(_DONE)
+
+    producer = asyncio.ensure_future(run_blocking(produce))
+    try:
+        while (item := await queue.get()) is not _DONE:
+            yield item
+        # Raises the error of the generator, if any
+        await producer
+    finally:
+        stop.set()
+
+
+class ConcurrencyLimit:
+    """
+    FastAPI dependency limiting the requests in flight on an endpoint.
+    Requests over the limit fail fast with a 429 and a Retry-After header
+    instead of queueing behind the running ones.
+    The counter is only touched from the event loop, it needs no lock.
+    """
+
+    def __init__(self, name: str, limit: int, retry_after: int = RETRY_AFTER):
+        self.name = name
+        self.limit = limit
+        self.retry_after = retry_after
+        self.in_flight = 0
+
+    def check(self) -> None:
+        if self.in_flight >= self.limit:
+            logger.warning("%s: %s requests in flight", self.name, self.in_flight)
+            raise TooManyRequests(
+                f"Too many concurrent requests on {self.name}",
+                {"limit": self.limit},
+                retry_after=self.retry_after,
+            )
+
+    @asynccontextmanager
+    async def hold(self) -> AsyncIterator[None]:
+        self.check()
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+    async def __call__(self) -> AsyncIterator[None]:
+        async with self.hold():
+            yield
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls sharing the same key: the first caller runs
+    the call, the others wait for it and get the same result or error.
+    The call is shielded, a disconnected client doesn't cancel it for the others.
+    """
+
+    def __init__(self):
+        self.calls: Dict[str, asyncio.Future] = {}
+
+    async def do(self, key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        call = self.calls.get(key)
+        if call is None:
+            call = asyncio.ensure_future(func())
+            self.calls[key] = call
+            call.add_done_callback(lambda _: self._forget(key, call))
+        else:
+            logger.info("join the running call %s", key)
+        return await asyncio.shield(call)
+
+    def _forget(self, key: str, call: asyncio.Future) -> None:
+        if self.calls.get(key) is call:
+            del self.calls[key]
@@ -1,24 +1,44 @@
 # pylint: disable=no-name-in-module
 # pylint: disable=no-self-argument
 # pylint: disable=too-few-public-methods
+import hashlib
+import json
 import logging
+import os
 from copy import deepcopy
-from typing import List
-from fastapi import APIRouter
+from typing import AsyncIterator, Iterator, List
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
+from gmail2s3.aiogmail import AsyncGmailClient
+from gmail2s3.api.concurrency import (
+    ConcurrencyLimit,
+    SingleFlight,
+    iter_blocking,
+    run_blocking,
+)
 from gmail2s3.gmailauth import (
+    MessageFormat,
     MessageQuery,
     Gmail2S3,
     WebHook,
     WebHookBody,
 )
-from gmail2s3.s3 import S3Dest, S3Client
+from gmail2s3.ledger import default_ledger
+from gmail2s3.s3 import S3Dest, UploadPolicy, get_s3_client
 from gmail2s3.config import GCONFIG
+from gmail2s3.utils import SYNC_THREADS, file_lock
+
 
+NDJSON = "application/x-ndjson"
 
 router = APIRouter(prefix="/api/v1", tags=["gmail2s3"])
 logger = logging.getLogger(__name__)
 
+sync_limit = ConcurrencyLimit("sync_emails", GCONFIG.gmail2s3["max_syncs"])
+copy_limit = ConcurrencyLimit("copy_s3", GCONFIG.gmail2s3["max_copies"])
+sync_flight = SingleFlight()
+
 
 class SyncedEmail(BaseModel):
     message_id: str = Field("...")
@@ -33,6 +53,9 @@ class SyncedEmailList(BaseModel):
 class S3Conf(BaseModel):
     bucket: str | None = Field(None)
     prefix: str | None = Field(None)
+    upload_policy: UploadPolicy | None = Field(
+        None, description="Skip the objects already in the bucket"
+    )
 
 
 class CopyS3Resp(BaseModel):
@@ -49,49 +72,166 @@ class SyncedEmailRequest(BaseModel):
     query: MessageQuery = Field(MessageQuery())
     webhooks: List[WebHook] = Field([])
     s3conf: S3Conf = Field({})
+    workers: int = Field(
+        1,
+        ge=1,
+        le=SYNC_THREADS,
+        description="Number of emails synced concurrently, at most the sync threads",
+    )
+    dedup_attachments: bool | None = Field(
+        None, description="Store each unique attachment once, default to the config"
+    )
+    lazy_pdf: bool | None = Field(
+        None, description="Skip the PDF, rendered on demand, default to the config"
+    )
+    formats: List[MessageFormat] | None = Field(
+        None, description="Artifacts uploaded for each email, default to the config"
+    )
+    eml_gzip: bool | None = Field(
+        None, description="Upload the eml format gzipped, default to the config"
+    )
 
 
-@router.post("/sync_emails", response_model=SyncedEmailList)
-async def sync_emails(req: SyncedEmailRequest) -> SyncedEmailList:
-    s3conf = deepcopy(GCONFIG.s3)
-    if req.s3conf:
-        s3conf.update(req.s3conf.dict(exclude_none=True))
-    gmailsyncer = Gmail2S3(
-        message_query=req.query, webhooks=req.webhooks, s3conf=s3conf
-    )
-    resp = gmailsyncer.sync_emails()
-    return SyncedEmailList(synced_emails=resp, total=len(resp))
+def get_aiogmail(request: Request) -> AsyncGmailClient:
+    """Async Gmail client shared by all the requests of the app"""
+    if getattr(request.app.state, "aiogmail", None) is None:
+        request.app.state.aiogmail = AsyncGmailClient()
+    return request.app.state.aiogmail
 
 
-@router.post("/sync_emails_info", response_model=dict)
-async def sync_emails_info(req: SyncedEmailRequest) -> dict:
+def build_syncer(req: SyncedEmailRequest) -> Gmail2S3:
     s3conf = deepcopy(GCONFIG.s3)
     if req.s3conf:
         s3conf.update(req.s3conf.dict(exclude_none=True))
-    gmailsyncer = Gmail2S3(
-        message_query=req.query, webhooks=req.webhooks, s3conf=s3conf
+    return Gmail2S3(
+        message_query=req.query,
+        webhooks=req.webhooks,
+        s3conf=s3conf,
+        ledger=default_ledger(),
+        dedup_attachments=req.dedup_attachments,
+        lazy_pdf=req.lazy_pdf,
+        formats=req.formats,
+        eml_gzip=req.eml_gzip,
     )
-    resp = gmailsyncer.sync_emails_info()
-    return resp
 
 
-@router.post("/webhooks/upload_attachment/copy", response_model=CopyS3RespList)
-async def copy_s3(webhook: WebHookBody) -> CopyS3RespList:
+def sync_key(req: SyncedEmailRequest) -> str:
+    """Canonical hash of a sync, `workers` only changes how it runs"""
+    canonical = json.dumps(
+        req.dict(exclude={"workers"}), sort_keys=True, default=str
+    ).encode("utf-8")
+    return hashlib.sha256(canonical).hexdigest()
+
+
+def _sync_lock(key: str) -> str:
+    # Identical syncs of the other API workers run one after the other,
+    # the later ones skip the emails already synced
+    return os.path.join(GCONFIG.gmail2s3["tmp_dir"], "locks", f"sync-{key}.lock")
+
+
+def _sync_emails(req: SyncedEmailRequest, key: str) -> List[dict]:
+    with file_lock(_sync_lock(key)):
+        return build_syncer(req).sync_emails(workers=req.workers)
+
+
+def _iter_sync_emails(req: SyncedEmailRequest, key: str) -> Iterator[dict]:
+    with file_lock(_sync_lock(key)):
+        yield from build_syncer(req).iter_sync_emails(workers=req.workers)
+
+
+async def _run_sync(req: SyncedEmailRequest, key: str) -> List[dict]:
+    async with sync_limit.hold():
+        # The sync pipeline is blocking, keep it out of the event loop
+        return await run_blocking(_sync_emails, req, key)
+
+
+async def _stream_sync(req: SyncedEmailRequest, key: str) -> AsyncIterator[str]:
+    """One json line per synced email, then a summary line with the total"""
+    total = 0
+    try:
+        async with sync_limit.hold():
+            async for synced_email in iter_blocking(_iter_sync_emails, req, key):
+                total += 1
+                yield json.dumps(synced_email) + "\n"
+    except Exception as exc:  # pylint: disable=broad-except
+        # The status is already sent, report the error in the stream
+        logger.exception("streamed sync failed")
+        yield json.dumps({"total": total, "error": repr(exc)}) + "\n"
+        return
+    yield json.dumps({"total": total}) + "\n"
+
+
+@router.post(
+    "/sync_emails",
+    response_model=SyncedEmailList,
+    responses={200: {"content": {NDJSON: {}}}},
+)
+async def sync_emails(
+    req: SyncedEmailRequest, request: Request
+) -> SyncedEmailList | StreamingResponse:
+    key = sync_key(req)
+    if NDJSON in request.headers.get("accept", ""):
+        sync_limit.check()
+        return StreamingResponse(_stream_sync(req, key), media_type=NDJSON)
+    # Concurrent identical requests share one sync and its result
+    resp = await sync_flight.do(key, lambda: _run_sync(req, key))
+    return SyncedEmailList(synced_emails=resp, total=len(resp))
+
+
+@router.post("/sync_emails_info", response_model=dict)
+async def sync_emails_info(
+    req: SyncedEmailRequest,
+    exact: bool = False,
+    aiogmail: AsyncGmailClient = Depends(get_aiogmail),
+) -> dict:
+    """
+    Number of emails matching the query, estimated by Gmail in one call.
+    With ?exact=true all the message refs are listed to count them.
+    """
+    return {
+        "total": await aiogmail.count_emails(req.query, exact),
+        "exact": exact,
+        "query": req.query.dict(),
+    }
+
+
+def _copy_s3(webhooks: List[WebHookBody]) -> CopyS3RespList:
     res = CopyS3RespList()
-    s3conf = deepcopy(GCONFIG.s3)
-    message_id = webhook.payload.message_ref["id"]
-    s3_dest_bucket = webhook.params["s3_copy_dest"]["bucket"]
-    s3_dest_prefix = f"{webhook.params['s3_copy_dest']['prefix']}{message_id}/"
-    s3_client = S3Client(s3conf, bucket=s3conf["bucket"])
-    for s3_src in webhook.payload.s3_uploads:
-        resp = s3_client.copy_s3_to_s3(
-            src_bucket=s3_src["bucket"],
-            src_path=s3_src["path"],
-            dest_bucket=s3_dest_bucket,
-            dest_prefix=s3_dest_prefix,
-            name_only=True,
-        )
-        logger.info(resp)
-        res.result.append(CopyS3Resp(source=resp[0], dest=resp[1]))
+    s3_client = get_s3_client(GCONFIG.s3, bucket=GCONFIG.s3["bucket"])
+    copies = []
+    for webhook in webhooks:
+        message_id = webhook.payload.message_ref["id"]
+        s3_dest_bucket = webhook.params["s3_copy_dest"]["bucket"]
+        s3_dest_prefix = f"{webhook.params['s3_copy_dest']['prefix']}{message_id}/"
+        for s3_src in webhook.payload.s3_uploads:
+            dest_path = s3_client.copy_path(
+                s3_src["path"],
+                dest_prefix=s3_dest_prefix,
+                name_only=True,
+                # Content-addressed attachments are copied under their original name
+                dest_name=s3_src.get("filename"),
+            )
+            copies.append(
+                (
+                    S3Dest(bucket=s3_src["bucket"], path=s3_src["path"]),
+                    S3Dest(bucket=s3_dest_bucket, path=dest_path),
+                )
+            )
+    # Copies run concurrently, bounded by the S3 max_concurrency
+    for future in s3_client.copy_many(copies):
+        source, dest = future.result()
+        logger.info("copied %s to %s", source, dest)
+        res.result.append(CopyS3Resp(source=source, dest=dest))
     res.count = len(res.result)
     return res
+
+
+@router.post(
+    "/webhooks/upload_attachment/copy",
+    response_model=CopyS3RespList,
+    dependencies=[Depends(copy_limit)],
+)
+async def copy_s3(webhook: List[WebHookBody] | WebHookBody) -> CopyS3RespList:
+    """Copy the uploads of one webhook event, or of a list of events"""
+    webhooks = webhook if isinstance(webhook, list) else [webhook]
+    return await run_blocking(_copy_s3, webhooks)
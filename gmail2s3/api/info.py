@@ -6,6 +6,7 @@ from fastapi import APIRouter
 from pydantic import BaseModel, Field
 
 import gmail2s3
+from gmail2s3.api.concurrency import run_blocking
 from gmail2s3.exception import Forbidden
 
 router = APIRouter()
@@ -34,7 +35,7 @@ async def gen_error_uncatch():
 
 @router.get("/slow", tags=["debug"])
 async def slow_req():
-    time.sleep(5)
+    await run_blocking(time.sleep, 5)
     return {"ok": 200}
 
 
@@ -0,0 +1,70 @@
+# pylint: disable=no-name-in-module
+# pylint: disable=too-few-public-methods
+import logging
+from typing import List
+
+from fastapi import APIRouter, Depends, Request
+from pydantic import BaseModel, Field
+
+from gmail2s3.api.gmail2s3 import SyncedEmailRequest, build_syncer
+from gmail2s3.exception import ResourceNotFound
+from gmail2s3.jobs import Job, JobManager, JobProgress, default_job_manager
+
+router = APIRouter(prefix="/api/v1/jobs", tags=["jobs"])
+logger = logging.getLogger(__name__)
+
+
+class JobCreated(BaseModel):
+    id: str = Field("...")
+    status: str = Field("...")
+    url: str = Field("...", description="Poll this url to follow the job")
+
+
+def sync_emails_job(params: dict, progress: JobProgress) -> List[dict]:
+    req = SyncedEmailRequest(**params)
+    gmailsyncer = build_syncer(req)
+    progress.set_total(gmailsyncer.gmail.estimate_emails(req.query))
+    return gmailsyncer.sync_emails(workers=req.workers, progress=progress)
+
+
+def job_manager() -> JobManager:
+    manager = default_job_manager()
+    manager.register("sync_emails", sync_emails_job)
+    return manager
+
+
+def get_jobs(request: Request) -> JobManager:
+    """Job manager shared by all the requests of the app"""
+    if getattr(request.app.state, "jobs", None) is None:
+        request.app.state.jobs = job_manager()
+    return request.app.state.jobs
+
+
+def _get_job(jobs: JobManager, job_id: str) -> Job:
+    job = jobs.get(job_id)
+    if job is None:
+        raise ResourceNotFound(f"job {job_id} not found", {"id": job_id})
+    return job
+
+
+@router.post("/sync_emails", response_model=JobCreated, status_code=202)
+async def sync_emails(
+    req: SyncedEmailRequest, request: Request, jobs: JobManager = Depends(get_jobs)
+) -> JobCreated:
+    job = jobs.submit("sync_emails", req.dict())
+    return JobCreated(
+        id=job.id,
+        status=job.status.value,
+        url=str(request.url_for("get_job", job_id=job.id)),
+    )
+
+
+@router.get("/{job_id}", response_model=Job)
+async def get_job(job_id: str, jobs: JobManager = Depends(get_jobs)) -> Job:
+    return _get_job(jobs, job_id)
+
+
+@router.delete("/{job_id}", response_model=Job)
+async def cancel_job(job_id: str, jobs: JobManager = Depends(get_jobs)) -> Job:
+    _get_job(jobs, job_id)
+    return jobs.cancel(job_id)
@@ -0,0 +1,99 @@
+# pylint: disable=no-name-in-module
+# pylint: disable=too-few-public-methods
+import logging
+
+from fastapi import APIRouter, Depends
+from fastapi.responses import RedirectResponse, Response
+
+from gmail2s3.aiogmail import AsyncGmailClient
+from gmail2s3.api.concurrency import SingleFlight, run_blocking
+from gmail2s3.api.gmail2s3 import get_aiogmail
+from gmail2s3.config import GCONFIG
+from gmail2s3.exception import ResourceNotFound
+from gmail2s3.gmailauth import GmailClient
+from gmail2s3.ledger import default_ledger
+from gmail2s3.pdf import render_async
+from gmail2s3.s3 import S3Dest, get_s3_client
+
+router = APIRouter(prefix="/api/v1/messages", tags=["messages"])
+logger = logging.getLogger(__name__)
+
+PDF = "application/pdf"
+
+pdf_flight = SingleFlight()
+
+
+def _ledger_dump(message_id: str) -> S3Dest | None:
+    """Where the dumps of the message were uploaded, without extension"""
+    ledger = default_ledger()
+    if ledger is None:
+        return None
+    entry = ledger.lookup([message_id]).get(message_id)
+    for dump in entry.dumps_s3 if entry else []:
+        if dump["path"].endswith(".txt"):
+            return S3Dest(bucket=dump["bucket"], path=dump["path"][: -len(".txt")])
+    return None
+
+
+async def _message_dump(message_id: str, aiogmail: AsyncGmailClient) -> S3Dest:
+    dump = await run_blocking(_ledger_dump, message_id)
+    if dump is not None:
+        return dump
+    # Not in the ledger: the storage path is derived from the message date
+    message_date = await aiogmail.get_email_date(message_id)
+    path = GmailClient.message_path(message_id, message_date)
+    return S3Dest(
+        bucket=GCONFIG.s3["bucket"],
+        path=f"{GCONFIG.s3['prefix'] or ''}{path}/{message_id}",
+    )
+
+
+def _cached_pdf(dump: S3Dest, content: bool = True) -> bytes | None:
+    """
+    Returns the PDF of the message, rendered from its txt dump and stored
+    next to it the first time. With `content` unset, returns None if
+    the PDF is already stored instead of downloading it.
+    """
+    s3 = get_s3_client(GCONFIG.s3, bucket=dump.bucket)
+    pdf_path = f"{dump.path}.pdf"
+    if content:
+        pdf = s3.get_object(pdf_path)
+        if pdf is not None:
+            return pdf
+    elif s3.exists(pdf_path):
+        return None
+    text = s3.get_object(f"{dump.path}.txt")
+    if text is None:
+        raise ResourceNotFound(
+            f"message {dump.path} not synced", {"bucket": dump.bucket}
+        )
+    logger.info("render %s", pdf_path)
+    pdf = render_async(text.decode("utf-8")).result()
+    s3.put_object(pdf, pdf_path)
+    return pdf
+
+
+@router.get(
+    "/{message_id}/pdf",
+    response_class=Response,
+    responses={200: {"content": {PDF: {}}}, 307: {"description": "Cached PDF"}},
+)
+async def message_pdf(
+    message_id: str,
+    redirect: bool = False,
+    aiogmail: AsyncGmailClient = Depends(get_aiogmail),
+) -> Response:
+    """
+    PDF of a synced email, rendered on the first request and stored in S3.
+    With ?redirect=true, redirect to a temporary URL of the stored PDF.
+    """
+    dump = await _message_dump(message_id, aiogmail)
+    # Concurrent requests of the same PDF render it once
+    pdf = await pdf_flight.do(
+        f"{dump.bucket}/{dump.path}:{redirect}",
+        lambda: run_blocking(_cached_pdf, dump, not redirect),
+    )
+    if redirect:
+        s3 = get_s3_client(GCONFIG.s3, bucket=dump.bucket)
+        return RedirectResponse(s3.presigned_url(f"{dump.path}.pdf"))
+    return Response(pdf, media_type=PDF)
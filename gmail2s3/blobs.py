@@ -0,0 +1,88 @@
+import hashlib
+import json
+import logging
+import threading
+from concurrent.futures import Future
+from pathlib import PurePath
+from typing import List, Set, Tuple
+
+from gmail2s3.ledger import SyncLedger
+from gmail2s3.s3 import S3Client, S3Dest
+
+logger = logging.getLogger(__name__)
+
+BLOBS_PREFIX = "blobs/"
+
+# (bucket, path) of the blobs known to exist, shared by the process
+_KNOWN: Set[Tuple[str, str]] = set()
+_KNOWN_LOCK = threading.Lock()
+
+
+def blob_path(digest: str) -> str:
+    return f"{BLOBS_PREFIX}{digest[:2]}/{digest}"
+
+
+class BlobStore:
+    """
+    Content-addressed store for the attachments: each unique content is
+    uploaded once under `blobs/<sha256[:2]>/<sha256>`.
+    Known blobs are remembered by the process and in the ledger,
+    so S3 is only checked, with a HEAD, for hashes never seen before.
+    """
+
+    def __init__(self, s3: S3Client, ledger: SyncLedger | None = None):
+        self.s3 = s3
+        self.ledger = ledger
+
+    def _known(self, path: str) -> bool:
+        key = (self.s3.bucket, path)
+        with _KNOWN_LOCK:
+            if key in _KNOWN:
+                return True
+        return self.ledger is not None and self.ledger.has_blob(*key)
+
+    def _remember(self, path: str) -> None:
+        with _KNOWN_LOCK:
+            _KNOWN.add((self.s3.bucket, path))
+        if self.ledger is not None:
+            self.ledger.record_blob(self.s3.bucket, path)
+
+    def put(self, data: bytes, filename: str) -> Future:
+        """Upload `data` unless its blob exists, returns a Future of S3Dest"""
+        dest = blob_path(hashlib.sha256(data).hexdigest())
+        s3_dest = S3Dest(
+            bucket=self.s3.bucket,
+            path=f"{self.s3.prefix}{dest}",
+            size=len(data),
+            filename=filename,
+        )
+        result: Future = Future()
+        if self._known(s3_dest.path) or self.s3.exists(dest):
+            logger.debug("blob %s exists: %s", s3_dest.path, filename)
+            self._remember(s3_dest.path)
+            result.set_result(s3_dest)
+            return result
+
+        def done(upload: Future) -> None:
+            if upload.exception() is not None:
+                result.set_exception(upload.exception())
+                return
+            self._remember(s3_dest.path)
+            result.set_result(s3_dest)
+
+        self.s3.upload_many([(data, dest)])[0].add_done_callback(done)
+        return result
+
+    def put_manifest(self, dest: str, s3_dests: List[S3Dest]) -> S3Dest:
+        """Per-message list of the attachments and the blob holding each of them"""
+        manifest = [
+            {
+                "filename": x.filename,
+                "sha256": PurePath(x.path).name,
+                "size": x.size,
+                "bucket": x.bucket,
+                "path": x.path,
+            }
+            for x in s3_dests
+        ]
+        return self.s3.put_object(json.dumps(manifest).encode("utf-8"), dest)
@@ -0,0 +1,68 @@
+import hashlib
+import json
+import logging
+import pathlib
+
+from gmail2s3.s3 import S3Client
+
+logger = logging.getLogger(__name__)
+
+
+class Checkpoint:
+    """
+    Store the state of the last successful sync (e.g. the Gmail historyId)
+    """
+
+    def load(self) -> dict | None:
+        raise NotImplementedError
+
+    def save(self, state: dict) -> None:
+        raise NotImplementedError
+
+
+class FileCheckpoint(Checkpoint):
+    def __init__(self, path: str):
+        self.path = pathlib.Path(path)
+
+    def load(self) -> dict | None:
+        if not self.path.exists():
+            return None
+        return json.loads(self.path.read_text(encoding="utf-8"))
+
+    def save(self, state: dict) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        tmp_path.write_text(json.dumps(state), encoding="utf-8")
+        tmp_path.replace(self.path)
+        logger.info("checkpoint saved: %s", self.path)
+
+
+def query_key(query: str) -> str:
+    """Short stable key of a serialized query, to checkpoint each query apart"""
+    return hashlib.sha256(query.encode("utf-8")).hexdigest()[:16]
+
+
+class S3Checkpoint(Checkpoint):
+    """Checkpoint stored as a JSON object next to the synced data"""
+
+    def __init__(self, s3: S3Client, dest: str):
+        self.s3 = s3
+        self.dest = dest
+
+    @classmethod
+    def for_query(cls, s3: S3Client, query: str) -> "S3Checkpoint":
+        """
+        Checkpoint of the syncs of `query`: syncs of other queries,
+        e.g. other labels, don't move its historyId
+        """
+        return cls(s3, f"checkpoints/gmail-sync-{query_key(query)}.json")
+
+    def load(self) -> dict | None:
+        content = self.s3.get_object(self.dest)
+        if content is None:
+            return None
+        return json.loads(content)
+
+    def save(self, state: dict) -> None:
+        s3_dest = self.s3.put_object(json.dumps(state).encode("utf-8"), self.dest)
+        logger.info("checkpoint saved: %s", s3_dest)
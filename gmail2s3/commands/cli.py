@@ -8,6 +8,7 @@ from gmail2s3.commands.openapi import OpenapiCmd
 from gmail2s3.commands.gmailauth import GmailAuthCmd
 from gmail2s3.commands.gmailsync import GmailSyncCmd
 from gmail2s3.commands.gmailforward import GmailForwardCmd
+from gmail2s3.commands.gmailledger import GmailLedgerCmd
 
 
 def all_commands():
@@ -18,6 +19,7 @@ def all_commands():
         GmailAuthCmd.name: GmailAuthCmd,
         GmailSyncCmd.name: GmailSyncCmd,
         GmailForwardCmd.name: GmailForwardCmd,
+        GmailLedgerCmd.name: GmailLedgerCmd,
     }
 
 
@@ -17,6 +17,7 @@ class CommandBase:
     default_media_type = "-"
     parse_unknown = False
     output_default = "text"
+    output_choices = ["text", "none", "json", "yaml"]
 
     def __init__(self, args_options, unknown=None):
         self.unknown = unknown
@@ -30,11 +31,15 @@ class CommandBase:
             self._render_json()
         elif self.output == "yaml":
             self._render_yaml()
+        elif self.output == "jsonl":
+            self._render_jsonl()
         else:
             print(self._render_console())
 
     def render_error(self, payload):
-        if self.output == "json":
+        if self.output == "jsonl":
+            self._render_jsonl(payload)
+        elif self.output == "json":
             self._render_json(payload)
         elif self.output == "yaml":
             self._render_yaml(payload)
@@ -89,6 +94,11 @@ class CommandBase:
             value = self._render_dict()
         print(json.dumps(value, indent=2, separators=(",", ": ")))
 
+    def _render_jsonl(self, value=None):
+        if not value:
+            value = self._render_dict()
+        print(json.dumps(value), flush=True)
+
     def _render_dict(self):
         raise NotImplementedError
 
@@ -112,7 +122,7 @@ class CommandBase:
         parser.add_argument(
             "--output",
             default=cls.output_default,
-            choices=["text", "none", "json", "yaml"],
+            choices=cls.output_choices,
             help="output format",
         )
 
@@ -0,0 +1,110 @@
+import argparse
+import sys
+
+from gmail2s3.commands.command_base import CommandBase
+from gmail2s3.commands.utils import LoadVariables
+from gmail2s3.config import GCONFIG
+from gmail2s3.ledger import default_ledger
+
+
+class GmailLedgerCmd(CommandBase):
+    name = "gmail-ledger"
+    help_message = "Inspect or export the sync ledger"
+
+    def __init__(self, options):
+        super().__init__(options)
+        self.conf = options.conf
+        GCONFIG.load_conf(self.conf)
+        self.ledger_path = options.ledger
+        self.message_ids = options.message_id
+        self.pending = options.pending
+        self.export = options.export
+        self.export_format = options.export_format
+        self._result = None
+
+    @classmethod
+    def _add_arguments(cls, parser):
+        parser.add_argument(
+            "--conf",
+            "-c",
+            default={},
+            required=False,
+            action=LoadVariables,
+            help="Path to configuration file of the application. Can set the GMAIL2S3_CONF_FILE envvar instead",
+        )
+
+        parser.add_argument(
+            "--ledger",
+            required=False,
+            default=None,
+            type=str,
+            help="Path to the SQLite sync ledger. Can set the GMAIL2S3_LEDGER envvar instead",
+        )
+
+        parser.add_argument(
+            "--message-id",
+            "-m",
+            required=False,
+            action="append",
+            default=[],
+            help="Show only these messages: -m id1 -m id2",
+        )
+
+        parser.add_argument(
+            "--pending",
+            required=False,
+            default=False,
+            action=argparse.BooleanOptionalAction,
+            help="Show only the messages with uncompleted stages",
+        )
+
+        parser.add_argument(
+            "--export",
+            required=False,
+            default=None,
+            type=str,
+            help="Export the ledger to a file, '-' for stdout",
+        )
+
+        parser.add_argument(
+            "--export-format",
+            required=False,
+            default="json",
+            choices=["json", "csv"],
+            help="Export as json lines or csv",
+        )
+
+    def _call(self):
+        ledger = default_ledger(self.ledger_path)
+        if ledger is None:
+            raise argparse.ArgumentTypeError(
+                "No ledger configured: use --ledger or GMAIL2S3_LEDGER"
+            )
+        try:
+            if self.export == "-":
+                count = ledger.export(sys.stdout, self.export_format, self.pending)
+                self._result = {"exported": count}
+            elif self.export:
+                with open(self.export, "w", encoding="utf-8") as output:
+                    count = ledger.export(output, self.export_format, self.pending)
+                self._result = {"exported": count, "path": self.export}
+            elif self.message_ids:
+                entries = ledger.lookup(self.message_ids)
+                self._result = {
+                    "total": len(entries),
+                    "entries": [x.dict() for x in entries.values()],
+                }
+            else:
+                entries = ledger.entries(pending_only=self.pending)
+                self._result = {
+                    "total": len(entries),
+                    "entries": [x.dict() for x in entries],
+                }
+        finally:
+            ledger.close()
+
+    def _render_dict(self):
+        return self._result
+
+    def _render_console(self):
+        return self._result
@@ -1,20 +1,34 @@
 import argparse
 import datetime
+import json
 from copy import deepcopy
+from gmail2s3.checkpoint import Checkpoint, FileCheckpoint, S3Checkpoint
 from gmail2s3.commands.command_base import CommandBase
 from gmail2s3.commands.utils import LoadVariables
+from gmail2s3.ledger import default_ledger
+from gmail2s3.s3 import UploadPolicy
+from gmail2s3.sharding import ShardedSync
 from gmail2s3.gmailauth import (
+    MessageFormat,
     MessageQuery,
     Gmail2S3,
     WebHook,
 )
 
-from gmail2s3.config import GCONFIG
+from gmail2s3.config import GCONFIG, envlist
+
+
+def message_formats(value: str):
+    try:
+        return [MessageFormat(x) for x in envlist(value)]
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(str(exc)) from exc
 
 
 class GmailSyncCmd(CommandBase):
     name = "gmail-sync"
     help_message = "Sync emails to S3"
+    output_choices = CommandBase.output_choices + ["jsonl"]
 
     def __init__(self, options):
         super().__init__(options)
@@ -30,12 +44,27 @@ class GmailSyncCmd(CommandBase):
         self.conf = options.conf
         GCONFIG.load_conf(self.conf)
         self.info = options.info
+        self.exact = options.exact
+        self.workers = options.workers
+        self.incremental = options.incremental
+        self.checkpoint_path = options.checkpoint
+        self.ledger_path = options.ledger
+        self.dedup_attachments = options.dedup_attachments
+        self.lazy_pdf = options.lazy_pdf
+        self.formats = options.formats
+        self.eml_gzip = options.eml_gzip
+        self.shards = options.shards
+        self.sync_id = options.sync_id
+        self.plan_only = options.plan_only
+        self.lease_ttl = datetime.timedelta(hours=options.lease_ttl)
 
         self.s3conf = deepcopy(GCONFIG.s3)
         if options.s3_prefix:
             self.s3conf["prefix"] = options.s3_prefix
         if options.s3_bucket:
             self.s3conf["bucket"] = options.s3_bucket
+        if options.upload_policy:
+            self.s3conf["upload_policy"] = options.upload_policy
 
         self._result = None
 
@@ -55,6 +84,15 @@ class GmailSyncCmd(CommandBase):
             type=str,
         )
 
+        parser.add_argument(
+            "--upload-policy",
+            default=None,
+            required=False,
+            choices=[x.value for x in UploadPolicy],
+            help="Upload 'always', only objects missing from the bucket ('if-missing'), "
+            "or missing or with a different size/ETag ('if-changed')",
+        )
+
         parser.add_argument(
             "--conf",
             "-c",
@@ -107,6 +145,122 @@ class GmailSyncCmd(CommandBase):
             help="Returns only the number of emails matching the query",
         )
 
+        parser.add_argument(
+            "--exact",
+            required=False,
+            default=False,
+            action=argparse.BooleanOptionalAction,
+            help="With --info, count the emails by listing them instead of using Gmail's estimate",
+        )
+
+        parser.add_argument(
+            "--workers",
+            "-j",
+            required=False,
+            default=1,
+            type=int,
+            help="Number of emails to sync concurrently",
+        )
+
+        parser.add_argument(
+            "--incremental",
+            required=False,
+            default=False,
+            action=argparse.BooleanOptionalAction,
+            help="Sync only the emails added or labeled since the previous incremental run",
+        )
+
+        parser.add_argument(
+            "--checkpoint",
+            required=False,
+            default=None,
+            type=str,
+            help="Local file storing the incremental sync checkpoint. "
+            "Default to the object 'checkpoints/gmail-sync-<query hash>.json' "
+            "in the S3 bucket, one per query",
+        )
+
+        parser.add_argument(
+            "--ledger",
+            required=False,
+            default=None,
+            type=str,
+            help="Path to the SQLite sync ledger, stages already completed are skipped. "
+            "Can set the GMAIL2S3_LEDGER envvar instead",
+        )
+
+        parser.add_argument(
+            "--dedup-attachments",
+            required=False,
+            default=None,
+            action=argparse.BooleanOptionalAction,
+            help="Upload each unique attachment once under 'blobs/<sha256>' with a manifest per email. "
+            "Can set the GMAIL2S3_DEDUP_ATTACHMENTS envvar instead",
+        )
+
+        parser.add_argument(
+            "--lazy-pdf",
+            required=False,
+            default=None,
+            action=argparse.BooleanOptionalAction,
+            help="Don't render the PDF of the emails, the API renders it from the txt dump on first request. "
+            "Can set the GMAIL2S3_LAZY_PDF envvar instead",
+        )
+
+        parser.add_argument(
+            "--formats",
+            required=False,
+            default=None,
+            type=message_formats,
+            help="Comma separated artifacts to upload for each email, among "
+            f"{','.join(x.value for x in MessageFormat)}: --formats attachments. "
+            "Can set the GMAIL2S3_FORMATS envvar instead",
+        )
+
+        parser.add_argument(
+            "--eml-gzip",
+            required=False,
+            default=None,
+            action=argparse.BooleanOptionalAction,
+            help="Upload the raw message of the 'eml' format gzipped, as <id>.eml.gz. "
+            "Can set the GMAIL2S3_EML_GZIP envvar instead",
+        )
+
+        parser.add_argument(
+            "--shards",
+            required=False,
+            default=0,
+            type=int,
+            help="Split the sync in up to N date windows that several processes can sync in parallel. "
+            "Requires --after and --sync-id",
+        )
+
+        parser.add_argument(
+            "--sync-id",
+            required=False,
+            default=None,
+            type=str,
+            help="Name of a sharded sync, shared by all the processes working on it",
+        )
+
+        parser.add_argument(
+            "--plan-only",
+            required=False,
+            default=False,
+            action="store_true",
+            help="Only split the sharded sync and store its plan, without syncing. "
+            "Run it once before starting the pods if the S3 store ignores conditional writes",
+        )
+
+        parser.add_argument(
+            "--lease-ttl",
+            required=False,
+            default=6,
+            type=float,
+            help="Hours after which a shard claimed by a process can be claimed by another one. "
+            "The lease is renewed every half TTL as long as the shard's emails are synced",
+        )
+
         parser.add_argument(
             "--webhooks",
             "-w",
@@ -122,14 +276,69 @@ class GmailSyncCmd(CommandBase):
             "verify_ssl": true ]}'""",
         )
 
+    def _checkpoint(self, gmailsyncer: Gmail2S3) -> Checkpoint | None:
+        if not self.incremental:
+            return None
+        if self.checkpoint_path:
+            return FileCheckpoint(self.checkpoint_path)
+        return S3Checkpoint.for_query(
+            gmailsyncer.s3, self.message_query.json(sort_keys=True)
+        )
+
     def _call(self):
         gmailsyncer = Gmail2S3(
-            message_query=self.message_query, webhooks=self.webhooks, s3conf=self.s3conf
+            message_query=self.message_query,
+            webhooks=self.webhooks,
+            s3conf=self.s3conf,
+            ledger=default_ledger(self.ledger_path),
+            dedup_attachments=self.dedup_attachments,
+            lazy_pdf=self.lazy_pdf,
+            formats=self.formats,
+            eml_gzip=self.eml_gzip,
         )
         if self.info:
-            self._result = gmailsyncer.sync_emails_info()
+            self._result = gmailsyncer.sync_emails_info(exact=self.exact)
+        elif self.shards:
+            if not self.sync_id:
+                raise argparse.ArgumentTypeError("--shards requires --sync-id")
+            sharded = ShardedSync(
+                gmailsyncer,
+                sync_id=self.sync_id,
+                shards=self.shards,
+                lease_ttl=self.lease_ttl,
+            )
+            if self.plan_only:
+                self._result = {
+                    "shards": [json.loads(x.json()) for x in sharded.plan()]
+                }
+            else:
+                resp = sharded.run(workers=self.workers, progress=self._progress)
+                self._set_result(resp)
+        elif self.output == "jsonl":
+            # Print each email once synced, without keeping the list
+            total = 0
+            for synced_email in gmailsyncer.iter_sync_emails(
+                workers=self.workers, checkpoint=self._checkpoint(gmailsyncer)
+            ):
+                self._render_jsonl(synced_email)
+                total += 1
+            self._result = {"total": total}
+        else:
+            resp = gmailsyncer.sync_emails(
+                workers=self.workers, checkpoint=self._checkpoint(gmailsyncer)
+            )
+            self._set_result(resp)
+
+    @property
+    def _progress(self):
+        if self.output == "jsonl":
+            return self._render_jsonl
+        return None
+
+    def _set_result(self, resp):
+        if self.output == "jsonl":
+            self._result = {"total": len(resp)}
         else:
-            resp = gmailsyncer.sync_emails()
             self._result = {"total": len(resp), "synced_emails": resp}
 
     def _render_dict(self):
@@ -52,6 +52,10 @@ def envbool(value: str):
     return value and (value.lower() in ("1", "true", "True", "yes"))
 
 
+def envlist(value: str):
+    return [x.strip() for x in value.split(",") if x.strip()]
+
+
 APP_ENVIRON = getenv("APP_ENV", "development")
 
 GMAIL2S3_API = getenv("GMAIL2S3_API", "https://gmail2s3.conny.dev")
@@ -62,6 +66,42 @@ GMAIL2S3_CONF_DIR = os.getenv(
 )
 GMAIL2S3_CONF_FILE = os.getenv("GMAIL2S3_CONF_FILE", None)
 GMAIL2S3_DOWNLOAD_DIR = os.getenv("GMAIL2S3_DOWNLOAD_DIR", "/tmp/gmail2s3")
+GMAIL2S3_LEDGER = os.getenv(
+    "GMAIL2S3_LEDGER", None
+)  # Path to the SQLite sync ledger, unset to disable it
+GMAIL2S3_DEDUP_ATTACHMENTS = getenv(
+    "GMAIL2S3_DEDUP_ATTACHMENTS", False, envbool
+)  # Store each unique attachment once under blobs/
+GMAIL2S3_PDF_RENDERER = os.getenv(
+    "GMAIL2S3_PDF_RENDERER", "fpdf"
+)  # fpdf (in-process) or wkhtmltopdf
+GMAIL2S3_PDF_FONT = os.getenv(
+    "GMAIL2S3_PDF_FONT", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+)  # TrueType font of the fpdf renderer, latin-1 only without it
+GMAIL2S3_FORMATS = getenv(
+    "GMAIL2S3_FORMATS", ["json", "txt", "pdf", "attachments"], envlist
+)  # Artifacts uploaded for each email
+GMAIL2S3_EML_GZIP = getenv(
+    "GMAIL2S3_EML_GZIP", False, envbool
+)  # Upload the eml format gzipped, as <id>.eml.gz
+GMAIL2S3_LAZY_PDF = getenv(
+    "GMAIL2S3_LAZY_PDF", False, envbool
+)  # Skip the PDF during syncs, it's rendered by GET /api/v1/messages/<id>/pdf
+GMAIL2S3_RENDER_WORKERS = getenv(
+    "GMAIL2S3_RENDER_WORKERS", None, int
+)  # Processes rendering PDFs, the number of CPUs by default, 0 to render in the sync threads
+GMAIL2S3_RENDER_QUEUE = getenv(
+    "GMAIL2S3_RENDER_QUEUE", None, int
+)  # Renders queued at once, twice the render workers by default
+GMAIL2S3_JOBS_DB = os.getenv("GMAIL2S3_JOBS_DB", "/tmp/gmail2s3/jobs.db")
+GMAIL2S3_JOBS_WORKERS = getenv("GMAIL2S3_JOBS_WORKERS", 2, int)
+GMAIL2S3_API_WORKERS = getenv(
+    "GMAIL2S3_API_WORKERS", 8, int
+)  # Threads running the blocking Gmail/S3 calls of the API
+GMAIL2S3_MAX_SYNCS = getenv(
+    "GMAIL2S3_MAX_SYNCS", 2, int
+)  # Syncs running at once per API worker, more are rejected with a 429
+GMAIL2S3_MAX_COPIES = getenv("GMAIL2S3_MAX_COPIES", 8, int)
 GMAIL2S3_TOKEN = os.getenv(
     "GMAIL2S3_TOKEN", "changeme"
 )  # Set to None or empty to skip the token
@@ -77,6 +117,18 @@ GMAIL2S3_S3_SECRET_KEY = os.getenv("GMAIL2S3_S3_SECRET_KEY", None)
 GMAIL2S3_S3_REGION = os.getenv("GMAIL2S3_S3_REGION", None)
 GMAIL2S3_S3_PREFIX = os.getenv("GMAIL2S3_S3_PREFIX", None)
 GMAIL2S3_S3_BUCKET = os.getenv("GMAIL2S3_S3_BUCKET", None)
+GMAIL2S3_S3_UPLOAD_POLICY = os.getenv(
+    "GMAIL2S3_S3_UPLOAD_POLICY", "always"
+)  # always, if-missing or if-changed
+GMAIL2S3_S3_MULTIPART_THRESHOLD = getenv(
+    "GMAIL2S3_S3_MULTIPART_THRESHOLD", 8 * 1024 * 1024, int
+)
+GMAIL2S3_S3_MULTIPART_CHUNKSIZE = getenv(
+    "GMAIL2S3_S3_MULTIPART_CHUNKSIZE", 8 * 1024 * 1024, int
+)
+GMAIL2S3_S3_MAX_CONCURRENCY = getenv(
+    "GMAIL2S3_S3_MAX_CONCURRENCY", 10, int
+)  # Concurrent uploads and parts per process
 
 PROMETHEUS_MULTIPROC_DIR = os.getenv(
     "PROMETHEUS_MULTIPROC_DIR", os.path.join(GMAIL2S3_TMP_DIR, "prometheus")
@@ -96,6 +148,20 @@ class Gmail2S3Config:
                 "env": APP_ENVIRON,
                 "url": GMAIL2S3_API,
                 "download_dir": GMAIL2S3_DOWNLOAD_DIR,
+                "ledger": GMAIL2S3_LEDGER,
+                "dedup_attachments": GMAIL2S3_DEDUP_ATTACHMENTS,
+                "pdf_renderer": GMAIL2S3_PDF_RENDERER,
+                "pdf_font": GMAIL2S3_PDF_FONT,
+                "formats": GMAIL2S3_FORMATS,
+                "eml_gzip": GMAIL2S3_EML_GZIP,
+                "lazy_pdf": GMAIL2S3_LAZY_PDF,
+                "render_workers": GMAIL2S3_RENDER_WORKERS,
+                "render_queue": GMAIL2S3_RENDER_QUEUE,
+                "jobs_db": GMAIL2S3_JOBS_DB,
+                "jobs_workers": GMAIL2S3_JOBS_WORKERS,
+                "api_workers": GMAIL2S3_API_WORKERS,
+                "max_syncs": GMAIL2S3_MAX_SYNCS,
+                "max_copies": GMAIL2S3_MAX_COPIES,
                 "token": GMAIL2S3_TOKEN,
                 "tmp_dir": GMAIL2S3_TMP_DIR,
                 "prometheus_dir": PROMETHEUS_MULTIPROC_DIR,
@@ -107,12 +173,17 @@ class Gmail2S3Config:
                 "region": GMAIL2S3_S3_REGION,
                 "prefix": GMAIL2S3_S3_PREFIX,
                 "bucket": GMAIL2S3_S3_BUCKET,
+                "upload_policy": GMAIL2S3_S3_UPLOAD_POLICY,
+                "multipart_threshold": GMAIL2S3_S3_MULTIPART_THRESHOLD,
+                "multipart_chunksize": GMAIL2S3_S3_MULTIPART_CHUNKSIZE,
+                "max_concurrency": GMAIL2S3_S3_MAX_CONCURRENCY,
             },
             "gmail": {
                 "client_secret": None,
                 "gmail_token": None,
                 "in_labels": [],
                 "out_labels": [],
+                "quota_units_per_second": 250,
             },
             "sentry": {
                 "url": GMAIL2S3_SENTRY_URL,
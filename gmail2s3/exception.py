@@ -33,6 +33,19 @@ class ResourceNotFound(Gmail2S3Exception):
     errorcode = "resource-not-found"
 
 
+class TooManyRequests(Gmail2S3Exception):
+    status_code = 429
+    errorcode = "too-many-requests"
+
+    def __init__(self, message, payload=None, retry_after: int = 30):
+        super().__init__(message, payload)
+        self.retry_after = retry_after
+
+    @property
+    def headers(self):
+        return {"Retry-After": str(self.retry_after)}
+
+
 class Forbidden(Gmail2S3Exception):
     status_code = 403
     errorcode = "forbidden"
@@ -1,25 +1,113 @@
+import base64
+import gzip
 import pathlib
 import logging
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+from contextlib import closing
 from pathlib import PurePath
 from enum import Enum
+from itertools import chain
 from datetime import datetime, date
-from typing import Dict, List, Tuple, Any
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Set,
+    Tuple,
+)
 
-import pdfkit
+from googleapiclient.errors import HttpError
 from pydantic import BaseModel, Field
 from simplegmail import Gmail
 from simplegmail.message import Message
 from simplegmail.attachment import Attachment
 from simplegmail.query import construct_query
 
+from gmail2s3.blobs import BlobStore
+from gmail2s3.checkpoint import Checkpoint
 from gmail2s3.config import GCONFIG
-from gmail2s3.s3 import S3Client, S3Dest
+from gmail2s3.ledger import LedgerEntry, SyncLedger, SyncStage
+from gmail2s3.pdf import render_async
+from gmail2s3.ratelimit import QuotaLimiter, gmail_limiter
+from gmail2s3.s3 import S3Client, S3Dest, UploadPolicy, get_s3_client
 from gmail2s3.client import Gmail2S3Client
+from gmail2s3.utils import (
+    SYNC_THREADS,
+    ClientRegistry,
+    TTLCache,
+    chunked,
+    client_threads,
+    ordered_map,
+)
 
 
 logger = logging.getLogger(__name__)
 
+# Number of messages fetched ahead of the caller by default
+FETCH_AHEAD = 10
+# Maximum number of messages fetched ahead of the caller
+FETCH_MAX_AHEAD = 100
+# Number of messages fetched at once
+FETCH_WORKERS = 10
+# Maximum page size of messages.list
+LIST_PAGE_SIZE = 500
+# Seconds before the label name -> id map is fetched again
+LABELS_CACHE_TTL = 300
+# Seconds the number of emails matching a query is cached
+COUNT_CACHE_TTL = 60
+# Maximum number of messages modified by a batchModify call
+BATCH_MODIFY_MAX_IDS = 1000
+# Labels of the messages messages.list skips, unless asked for
+SPAM_TRASH_LABELS = {"SPAM", "TRASH"}
+
+# Counts of emails by (query, exact), shared by the sync and async clients
+COUNT_CACHE = TTLCache(COUNT_CACHE_TTL)
+# Authenticated Gmail clients reused by the process, one per thread
+GMAIL_CLIENTS = ClientRegistry(maxsize=client_threads)
+
+_SYNC_EXECUTOR: ThreadPoolExecutor | None = None
+_SYNC_EXECUTOR_LOCK = threading.Lock()
+
+
+def sync_executor() -> ThreadPoolExecutor:
+    """Thread pool running the emails of the concurrent syncs"""
+    global _SYNC_EXECUTOR  # pylint: disable=global-statement
+    with _SYNC_EXECUTOR_LOCK:
+        if _SYNC_EXECUTOR is None:
+            _SYNC_EXECUTOR = ThreadPoolExecutor(
+                max_workers=SYNC_THREADS, thread_name_prefix="gmail2s3-sync"
+            )
+        return _SYNC_EXECUTOR
+
+
+def shutdown_sync_executor() -> None:
+    global _SYNC_EXECUTOR  # pylint: disable=global-statement
+    with _SYNC_EXECUTOR_LOCK:
+        if _SYNC_EXECUTOR is not None:
+            _SYNC_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+            _SYNC_EXECUTOR = None
+
+
+def _done(result: Any) -> Future:
+    """Future already resolved to `result`"""
+    future: Future = Future()
+    future.set_result(result)
+    return future
+
+
+def _epoch(value: date | datetime) -> str:
+    # datetime.timestamp handles timezone-aware datetimes, strftime("%s") doesn't
+    if isinstance(value, datetime):
+        return str(int(value.timestamp()))
+    return value.strftime("%s")
+
 
 class WebHookType(str, Enum):
     SYNCED_EMAIL = "synced_email"
@@ -27,6 +115,32 @@ class WebHookType(str, Enum):
     SYNC_COMPLETED = "sync_completed"
 
 
+class MessageFormat(str, Enum):
+    JSON = "json"
+    TXT = "txt"
+    PDF = "pdf"
+    EML = "eml"
+    ATTACHMENTS = "attachments"
+
+
+# Formats written to disk by GmailClient.dump_message
+DUMP_FORMATS = (MessageFormat.JSON, MessageFormat.TXT)
+
+
+def dest_format(message_id: str, s3_dest: S3Dest) -> MessageFormat:
+    """Format of an uploaded object, the dumps are named after the message"""
+    path = PurePath(s3_dest.path)
+    if path.suffix == ".gz":
+        path = path.with_suffix("")
+    if (
+        path.parent.name == message_id
+        and path.stem == message_id
+        and path.suffix[1:] in set(MessageFormat)
+    ):
+        return MessageFormat(path.suffix[1:])
+    return MessageFormat.ATTACHMENTS
+
+
 class MessageQuery(BaseModel):
     after: date | datetime | None = Field(None)
     before: date | datetime | None = Field(None)
@@ -60,6 +174,9 @@ class WebHook(BaseModel):
     token: str = Field("")
     headers: dict = Field({})
     verify_ssl: bool = Field(True)
+    formats: List[MessageFormat] | None = Field(
+        None, description="Only send the uploads of these formats, all by default"
+    )
 
     def trigger_event(
         self, message_ref: dict, attachments: List[Attachment], s3_dests: List[S3Dest]
@@ -83,6 +200,14 @@ class WebHook(BaseModel):
             )
 
         elif self.event == WebHookType.SYNCED_EMAIL:
+            if self.formats is not None:
+                s3_dests = [
+                    x
+                    for x in s3_dests
+                    if dest_format(message_ref["id"], x) in self.formats
+                ]
+                if MessageFormat.ATTACHMENTS not in self.formats:
+                    attachments = []
             body = WebHookBody(
                 event=WebHookType.SYNCED_EMAIL,
                 payload=WebHookPayload(
@@ -115,12 +240,22 @@ class GmailClient:
     ):
         if not client_secret:
             client_secret = GCONFIG.gmail["client_secret"]
-        if not gmail_token: 
+        if not gmail_token:
             gmail_token = GCONFIG.gmail["gmail_token"]
 
         self.client_secret = client_secret
         self.gmail_token = gmail_token
         self._client = None
+        self._fetch_pool: ThreadPoolExecutor | None = None
+        # Idle Gmail clients of get_emails, each fetch uses one exclusively
+        self._fetch_clients: List[Gmail] = []
+        self._fetch_lock = threading.Lock()
+        self._labels: Dict[str, str] = {}
+        self._labels_expire_at = 0.0
+        # label ids to add -> message ids, applied by flush_labels
+        self._pending_labels: Dict[Tuple[str, ...], List[str]] = {}
+        self._pending_lock = threading.Lock()
+        self.limiter: QuotaLimiter = gmail_limiter()
         self.dest_dir = dest_dir
         pathlib.Path(self.dest_dir).mkdir(parents=True, exist_ok=True)
 
@@ -152,16 +287,17 @@ class GmailClient:
         return self._client
 
     # YYYY-MM-DD[*HH[:MM[:SS[.fff[fff]]]][+HH:MM[:SS[.ffffff]]]]
-    def list_emails(self, message_query: MessageQuery) -> MessageList:
+    @staticmethod
+    def build_query(message_query: MessageQuery) -> str:
         query_params = {}
         if message_query.labels:
             query_params["labels"] = message_query.labels
         if message_query.exclude_labels:
             query_params["exclude_labels"] = [[x] for x in message_query.exclude_labels]
         if message_query.after:
-            query_params["after"] = message_query.after.strftime("%s")
+            query_params["after"] = _epoch(message_query.after)
         if message_query.before:
-            query_params["before"] = message_query.before.strftime("%s")
+            query_params["before"] = _epoch(message_query.before)
         if message_query.sender:
             query_params["sender"] = message_query.sender
         if message_query.to:
@@ -169,49 +305,407 @@ class GmailClient:
 
         query = construct_query(query_params)
         logger.info("Params: %s, query: %s", query_params, str(query))
-        messages = self.client.get_messages(query=query, refs_only=True)
+        return query
+
+    def iter_emails(
+        self, message_query: MessageQuery, page_size: int = LIST_PAGE_SIZE
+    ) -> Iterator[List[dict]]:
+        """
+        Yield the message refs matching the query page by page,
+        as soon as each page is received
+        """
+        params = {
+            "userId": "me",
+            "q": self.build_query(message_query),
+            "maxResults": page_size,
+        }
+        messages = self.client.service.users().messages()
+        while True:
+            resp = self.limiter.call("messages.list", messages.list(**params).execute)
+            yield resp.get("messages", [])
+            if "nextPageToken" not in resp:
+                break
+            params["pageToken"] = resp["nextPageToken"]
+
+    def estimate_emails(self, message_query: MessageQuery) -> int:
+        """Gmail estimate of the number of messages matching the query"""
+        resp = self.limiter.call(
+            "messages.list",
+            self.client.service.users()
+            .messages()
+            .list(userId="me", q=self.build_query(message_query), maxResults=1)
+            .execute,
+        )
+        return resp.get("resultSizeEstimate", 0)
+
+    def count_emails(self, message_query: MessageQuery, exact: bool = False) -> int:
+        """
+        Number of emails matching the query: Gmail's estimate in one call,
+        or the exact count by listing all the pages. Counts are cached.
+        """
+        key = (self.build_query(message_query), exact)
+        total = COUNT_CACHE.get(key)
+        if total is None:
+            if exact:
+                total = sum(len(page) for page in self.iter_emails(message_query))
+            else:
+                total = self.estimate_emails(message_query)
+            COUNT_CACHE.set(key, total)
+        return total
+
+    def list_emails(self, message_query: MessageQuery) -> MessageList:
+        messages = list(chain.from_iterable(self.iter_emails(message_query)))
         return MessageList(message_refs=messages, query=message_query)
 
+    def get_history_id(self) -> str:
+        """Current historyId of the mailbox"""
+        profile = self.limiter.call(
+            "getProfile", self.client.service.users().getProfile(userId="me").execute
+        )
+        return profile["historyId"]
+
+    def list_history(
+        self, start_history_id: str, message_query: MessageQuery
+    ) -> Tuple[MessageList, str] | None:
+        """
+        List the messages added, or labeled, since `start_history_id`
+        and matching the query. Like a listing, spam and trash are excluded
+        unless the query asks for them, and messages deleted since are dropped.
+        Returns the message list and the latest historyId,
+        or None if the start_history_id is too old and a full listing is needed.
+        """
+        labels = {self.get_label_id(x) for x in message_query.labels}
+        exclude_labels = {self.get_label_id(x) for x in message_query.exclude_labels}
+        exclude_labels |= SPAM_TRASH_LABELS - labels
+        params = {
+            "userId": "me",
+            "startHistoryId": start_history_id,
+            "historyTypes": ["messageAdded", "labelAdded", "messageDeleted"],
+        }
+        message_refs: Dict[str, dict] = {}
+        history = self.client.service.users().history()
+        try:
+            while True:
+                resp = self.limiter.call("history.list", history.list(**params).execute)
+                for record in resp.get("history", []):
+                    for change in record.get("messagesAdded", []) + record.get(
+                        "labelsAdded", []
+                    ):
+                        msg = change["message"]
+                        label_ids = set(msg.get("labelIds", []))
+                        if labels <= label_ids and not exclude_labels & label_ids:
+                            message_refs[msg["id"]] = {
+                                "id": msg["id"],
+                                "threadId": msg["threadId"],
+                            }
+                        else:
+                            # The latest labels of the message don't match anymore
+                            message_refs.pop(msg["id"], None)
+                    for change in record.get("messagesDeleted", []):
+                        message_refs.pop(change["message"]["id"], None)
+                if "nextPageToken" not in resp:
+                    break
+                params["pageToken"] = resp["nextPageToken"]
+        except HttpError as exc:
+            if exc.resp.status == 404:
+                logger.warning("historyId %s expired", start_history_id)
+                return None
+            raise
+        if message_refs and _has_search_filters(message_query):
+            # History records can't be filtered by date or sender/recipient
+            matching = {
+                ref["id"] for page in self.iter_emails(message_query) for ref in page
+            }
+            message_refs = {k: v for k, v in message_refs.items() if k in matching}
+        logger.info(
+            "history since %s: %s messages", start_history_id, len(message_refs)
+        )
+        return (
+            MessageList(message_refs=list(message_refs.values()), query=message_query),
+            resp["historyId"],
+        )
+
     def get_email(self, message_ref: dict, with_raw: bool = True):
-        message = self.client.get_message_from_ref(ref=message_ref, with_raw=with_raw)
+        message = self.limiter.call(
+            "messages.get",
+            self.client.get_message_from_ref,
+            ref=message_ref,
+            with_raw=with_raw,
+        )
         return message
 
+    def _checkout_client(self) -> Gmail:
+        with self._fetch_lock:
+            if self._fetch_clients:
+                return self._fetch_clients.pop()
+        return self.auth()
+
+    def _checkin_client(self, client: Gmail) -> None:
+        with self._fetch_lock:
+            self._fetch_clients.append(client)
+
+    def _fetch_email(self, message_ref: dict, with_raw: bool) -> Tuple[Gmail, Message]:
+        """Fetch a message with an idle client, returned with the message"""
+        client = self._checkout_client()
+        try:
+            message = self.limiter.call(
+                "messages.get",
+                client.get_message_from_ref,
+                ref=message_ref,
+                with_raw=with_raw,
+            )
+        except BaseException:
+            self._checkin_client(client)
+            raise
+        return client, message
+
+    def _submit_fetch(self, message_ref: dict, with_raw: bool) -> Future:
+        # Under the lock: close() doesn't shut the pool down in between
+        with self._fetch_lock:
+            if self._fetch_pool is None:
+                self._fetch_pool = ThreadPoolExecutor(
+                    max_workers=FETCH_WORKERS, thread_name_prefix="gmail-fetch"
+                )
+            return self._fetch_pool.submit(self._fetch_email, message_ref, with_raw)
+
+    def close(self) -> None:
+        """
+        Stop the fetch threads and drop the idle clients. The client can
+        still be used, e.g. by the thread it was evicted from, it restarts them.
+        """
+        with self._fetch_lock:
+            pool, self._fetch_pool = self._fetch_pool, None
+            self._fetch_clients.clear()
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+    def _release_fetch(self, future: Future) -> None:
+        if not future.cancelled() and future.exception() is None:
+            self._checkin_client(future.result()[0])
+
+    def get_emails(
+        self,
+        message_refs: Iterable[dict],
+        with_raw: bool = True,
+        ahead: int = FETCH_AHEAD,
+    ) -> Iterator[Tuple[dict, Message]]:
+        """
+        Fetch messages concurrently, up to `ahead` messages ahead of the caller,
+        and yield them in order as (message_ref, message) as soon as each is fetched.
+        httplib2 isn't thread-safe: each message is fetched with its own client,
+        which is reused only once the caller asks for the next message.
+        The yielded message can safely be used (attachments, labels)
+        from the calling thread until then.
+        Messages deleted since they were listed are yielded as None.
+        """
+        ahead = max(1, min(ahead, FETCH_MAX_AHEAD))
+        refs = iter(message_refs)
+        pending: Deque[Tuple[dict, Future]] = deque()
+
+        def fetch_ahead():
+            while len(pending) < ahead:
+                ref = next(refs, None)
+                if ref is None:
+                    return
+                pending.append((ref, self._submit_fetch(ref, with_raw)))
+
+        try:
+            fetch_ahead()
+            while pending:
+                ref, future = pending.popleft()
+                try:
+                    client, message = future.result()
+                except HttpError as exc:
+                    if exc.resp.status != 404:
+                        raise
+                    logger.warning("message %s deleted, skipped", ref["id"])
+                    fetch_ahead()
+                    yield ref, None
+                    continue
+                fetch_ahead()
+                try:
+                    yield ref, message
+                finally:
+                    self._checkin_client(client)
+        finally:
+            for _, future in pending:
+                if not future.cancel():
+                    future.add_done_callback(self._release_fetch)
+
+    @staticmethod
+    def storage_path(message: Message) -> str:
+        return GmailClient.message_path(message.id, message.date)
+
     @staticmethod
-    def _message_storage_path(message: Message) -> str:
-        return str(PurePath().joinpath(message.date.strftime("%Y/%m"), message.id))
+    def message_path(message_id: str, message_date: datetime) -> str:
+        return str(PurePath().joinpath(message_date.strftime("%Y/%m"), message_id))
 
     def download_attachments(self, message: Message, overwrite: bool = True):
         paths = []
         for attach in message.attachments:
             fpath = PurePath().joinpath(
                 self.dest_dir,
-                self._message_storage_path(message),
+                self.storage_path(message),
                 "attachments",
                 f"{attach.filename}",
             )
-            attach.save(str(fpath), overwrite)
+            self.limiter.call(
+                "messages.attachments.get", attach.save, str(fpath), overwrite
+            )
             paths.append((str(fpath), attach))
         return paths
 
-    def dump_message(self, message: Message) -> List[PurePath]:
+    def iter_attachments(
+        self, message: Message, skip: Callable[[str], bool] | None = None
+    ) -> Iterator[Tuple[str, Attachment]]:
+        """
+        Yield (storage path, attachment) with the attachment data downloaded
+        in memory, one attachment at a time, nothing is written to disk.
+        Attachments whose path is `skip`ped are yielded without their data.
+        """
+        for attach in message.attachments:
+            path = str(
+                PurePath().joinpath(
+                    self.storage_path(message), "attachments", attach.filename
+                )
+            )
+            if skip is None or not skip(path):
+                self.limiter.call("messages.attachments.get", attach.download)
+            yield path, attach
+
+    def dump_message(
+        self, message: Message, formats: Iterable[MessageFormat] = DUMP_FORMATS
+    ) -> List[PurePath]:
         """
-        Save to disk the original JSON fron GMAIL
-        convert and store the email to txt and PDF too
+        Save to disk the original JSON fron GMAIL and/or the email as txt.
+        The PDF is rendered in memory by `render_pdf`
         """
         fpath = PurePath().joinpath(
-            self.dest_dir, self._message_storage_path(message), f"{message.id}"
+            self.dest_dir, self.storage_path(message), f"{message.id}"
         )
-        message.dump(str(fpath) + ".json", as_string=False)
-        message.dump(str(fpath) + ".txt", as_string=True)
-        m = message.as_simple_string()
-        html = f'<html><header><meta charset="utf-8"/></header><body><div>{m}</div></body></html>'
-        html = html.replace("\n", "<br />\n")
-        pdfkit.from_string(html, str(fpath) + ".pdf")
-        return [PurePath(str(fpath) + x) for x in [".json", ".pdf", ".txt"]]
+        paths = []
+        for fmt in DUMP_FORMATS:
+            if fmt in formats:
+                path = PurePath(f"{fpath}.{fmt.value}")
+                message.dump(str(path), as_string=fmt == MessageFormat.TXT)
+                paths.append(path)
+        return paths
 
     @staticmethod
-    def add_labels(message: Message, labels: List[str]):
-        return message.add_labels(labels)
+    def raw_message(message: Message) -> bytes:
+        """
+        The RFC 822 message as fetched with `with_raw`, decoded from
+        the base64url of the Gmail API but otherwise unchanged
+        """
+        raw = message.raw
+        if isinstance(raw, bytes):
+            return raw
+        return base64.urlsafe_b64decode(raw + "=" * (-len(raw) % 4))
+
+    def render_pdf(self, message: Message) -> Future:
+        """
+        Start rendering the email to PDF in the render pool,
+        returns a Future of the PDF bytes
+        """
+        return render_async(message.as_simple_string())
+
+    def add_labels(self, message: Message, labels: List[str]):
+        return self.limiter.call("messages.modify", message.add_labels, labels)
+
+    def forward_email(self, message: Message, to: str, forward_prefix: str):
+        return self.limiter.call(
+            "messages.send",
+            self.client.forward_message,
+            message,
+            sender=message.sender,
+            to=to,
+            forward_prefix=forward_prefix,
+        )
+
+    def forward_raw_email(self, message: Message, to: str):
+        return self.limiter.call(
+            "messages.send",
+            self.client.forward_raw_message,
+            message,
+            to=to,
+            sender=message.sender,
+        )
+
+    def get_label_id(self, name: str) -> str:
+        """
+        Resolve a label name with a cached map, refreshed every LABELS_CACHE_TTL
+        seconds or when the label is unknown
+        """
+        if time.monotonic() >= self._labels_expire_at or name not in self._labels:
+            self._labels = {
+                x.name: x.id
+                for x in self.limiter.call("labels.list", self.client.list_labels)
+            }
+            self._labels_expire_at = time.monotonic() + LABELS_CACHE_TTL
+        if name not in self._labels:
+            self._labels[name] = self.limiter.call(
+                "labels.create", self.client.get_label_id, name
+            )
+        return self._labels[name]
+
+    def queue_labels(self, message_id: str, label_ids: List[str]) -> int:
+        """
+        Queue labels to add to a message, they are applied by flush_labels.
+        Returns the number of queued messages.
+        """
+        with self._pending_lock:
+            self._pending_labels.setdefault(tuple(sorted(label_ids)), []).append(
+                message_id
+            )
+            return sum(len(x) for x in self._pending_labels.values())
+
+    def flush_labels(self) -> List[str]:
+        """
+        Apply the queued labels with batchModify,
+        by chunks of BATCH_MODIFY_MAX_IDS messages.
+        Returns the ids of the labelled messages.
+        """
+        with self._pending_lock:
+            pending = self._pending_labels
+            self._pending_labels = {}
+        labelled = []
+        for label_ids, message_ids in pending.items():
+            for ids in chunked(message_ids, BATCH_MODIFY_MAX_IDS):
+                self.limiter.call(
+                    "messages.batchModify",
+                    self.client.service.users()
+                    .messages()
+                    .batchModify(
+                        userId="me", body={"ids": ids, "addLabelIds": list(label_ids)}
+                    )
+                    .execute,
+                )
+                labelled.extend(ids)
+                logger.info("labelled %s messages with %s", len(ids), label_ids)
+        return labelled
+
+
+def _has_search_filters(message_query: MessageQuery) -> bool:
+    """True if the query filters on more than labels"""
+    return bool(
+        message_query.after
+        or message_query.before
+        or message_query.sender
+        or message_query.to
+    )
+
+
+def get_gmail_client(client_secret=None, gmail_token=None) -> GmailClient:
+    """
+    Cached GmailClient for these credentials, the token files are read once.
+    httplib2 isn't thread-safe: each thread gets its own client.
+    """
+    client_secret = client_secret or GCONFIG.gmail["client_secret"]
+    gmail_token = gmail_token or GCONFIG.gmail["gmail_token"]
+    return GMAIL_CLIENTS.get(
+        (client_secret, gmail_token, threading.get_ident()),
+        lambda: GmailClient(client_secret=client_secret, gmail_token=gmail_token),
+    )
 
 
 class Gmail2S3:
@@ -220,14 +714,58 @@ class Gmail2S3:
         message_query: MessageQuery,
         webhooks: List[WebHook] | None = None,
         s3conf: dict | None = None,
+        ledger: SyncLedger | None = None,
+        dedup_attachments: bool | None = None,
+        lazy_pdf: bool | None = None,
+        formats: Iterable[MessageFormat] | None = None,
+        eml_gzip: bool | None = None,
     ):
-
-        self.gmail = GmailClient()
+        # googleapiclient (httplib2) and boto3 resources aren't thread-safe:
+        # each worker thread lazily gets its own Gmail and S3 clients,
+        # reused across syncs through the process-wide client registries
+        self._local = threading.local()
         self.webhooks = self._webhooks_dict(webhooks)
         if not s3conf:
             s3conf = GCONFIG.s3
-        self.s3 = S3Client(s3conf, bucket=s3conf["bucket"], prefix=s3conf["prefix"])
+        self.s3conf = s3conf
         self.message_query = message_query
+        self.ledger = ledger
+        if dedup_attachments is None:
+            dedup_attachments = GCONFIG.gmail2s3["dedup_attachments"]
+        self.dedup_attachments = dedup_attachments
+        if formats is None:
+            formats = GCONFIG.gmail2s3["formats"]
+        # Artifacts produced and uploaded for each email
+        self.formats = {MessageFormat(x) for x in formats}
+        if eml_gzip is None:
+            eml_gzip = GCONFIG.gmail2s3["eml_gzip"]
+        self.eml_gzip = eml_gzip
+        if lazy_pdf is None:
+            lazy_pdf = GCONFIG.gmail2s3["lazy_pdf"]
+        if lazy_pdf and MessageFormat.PDF in self.formats:
+            # The PDF is rendered on demand by the API, from the txt dump,
+            # instead of during the sync
+            self.formats.discard(MessageFormat.PDF)
+            self.formats.add(MessageFormat.TXT)
+        self._local.gmail = get_gmail_client()
+        self._local.s3 = self._new_s3()
+
+    def _new_s3(self) -> S3Client:
+        return get_s3_client(
+            self.s3conf, bucket=self.s3conf["bucket"], prefix=self.s3conf["prefix"]
+        )
+
+    @property
+    def gmail(self) -> GmailClient:
+        if not hasattr(self._local, "gmail"):
+            self._local.gmail = get_gmail_client()
+        return self._local.gmail
+
+    @property
+    def s3(self) -> S3Client:
+        if not hasattr(self._local, "s3"):
+            self._local.s3 = self._new_s3()
+        return self._local.s3
 
     @classmethod
     def _webhooks_dict(
@@ -254,17 +792,62 @@ class Gmail2S3:
                 s3_dests=s3_dests,
             )
 
-    def sync_email(
-        self, message_ref: dict, flag_label: str = "s3"
-    ) -> Tuple[dict, List[str]]:
-        message = self.gmail.get_email(message_ref)
-        attachments = self.gmail.download_attachments(message)
-        s3_dests = []
-        for att in attachments:
-            fpath, attach = att
-            s3_dest = self.s3.upload_file(
-                fpath, str(PurePath(fpath).relative_to(self.gmail.dest_dir))
+    def _record(
+        self,
+        message_id: str,
+        stage: SyncStage,
+        s3_dests: List[S3Dest] | None = None,
+        formats: Iterable[MessageFormat] = (),
+    ):
+        if self.ledger is not None:
+            self.ledger.record(
+                message_id,
+                stage,
+                s3_paths=[x.dict() for x in s3_dests or []],
+                formats=[x.value for x in formats],
             )
+
+    def _missing_formats(self, entry: LedgerEntry) -> Set[MessageFormat]:
+        """Requested formats not uploaded yet according to the ledger entry"""
+        return {x for x in self.formats if x.value not in entry.formats}
+
+    def _completed(self, entry: LedgerEntry | None, flag_label: str) -> bool:
+        return entry is not None and entry.completed(
+            flag_label, [x.value for x in self.formats]
+        )
+
+    def _sync_attachments(
+        self, message_ref: dict, message: Message
+    ) -> Tuple[List[Attachment], List[S3Dest]]:
+        # Attachments go from the Gmail response to S3 without touching the disk,
+        # each upload starts while the next attachment is downloaded
+        attachments = []
+        uploads = []
+        blobs = BlobStore(self.s3, self.ledger) if self.dedup_attachments else None
+        manifest = ""
+        existing: Dict[str, S3Dest] = {}
+
+        def skip(dest: str) -> bool:
+            # Content-addressed blobs need the data to find their path
+            if blobs is not None:
+                return False
+            s3_dest = self._existing(dest)
+            if s3_dest is not None:
+                existing[dest] = s3_dest
+            return s3_dest is not None
+
+        for dest, attach in self.gmail.iter_attachments(message, skip):
+            attachments.append(attach)
+            if dest in existing:
+                uploads.append(_done(existing[dest]))
+            elif blobs is not None:
+                manifest = str(PurePath(dest).parent) + ".json"
+                uploads.append(blobs.put(attach.data, attach.filename))
+            else:
+                uploads.extend(self.s3.upload_many([(attach.data, dest)]))
+        s3_dests = []
+        for attach, upload in zip(attachments, uploads):
+            s3_dest = upload.result()
             s3_dests.append(s3_dest)
             self.trigger_webhooks(
                 WebHookType.UPLOADED_ATTACHMENT,
@@ -272,91 +855,369 @@ class Gmail2S3:
                 attachments=[attach],
                 s3_dests=[s3_dest],
             )
-        raw_message_paths = self.gmail.dump_message(message)
-        for raw_message_path in raw_message_paths:
-            email_s3_path = self.s3.upload_file(
-                str(raw_message_path),
-                str(raw_message_path.relative_to(self.gmail.dest_dir)),
-            )
-            s3_dests.append(email_s3_path)
-        self.trigger_webhooks(
-            WebHookType.SYNCED_EMAIL,
-            message_ref,
-            [att[1] for att in attachments],
+        if blobs is not None and manifest:
+            s3_dests.append(blobs.put_manifest(manifest, s3_dests))
+        self._record(
+            message_ref["id"],
+            SyncStage.ATTACHMENTS,
             s3_dests,
+            [MessageFormat.ATTACHMENTS],
+        )
+        return attachments, s3_dests
+
+    def _existing(self, dest: str, comparable: bool = True) -> S3Dest | None:
+        """
+        The object already uploaded to `dest` if the upload policy keeps it,
+        so it's not produced again: any existing object with if-missing,
+        with if-changed only if its content can't be compared byte for byte
+        """
+        if self.s3.upload_policy == UploadPolicy.ALWAYS or (
+            self.s3.upload_policy == UploadPolicy.IF_CHANGED and comparable
+        ):
+            return None
+        return self.s3.stat(dest)
+
+    def _pdf_dest(self, message: Message) -> str:
+        return f"{PurePath(self.gmail.storage_path(message), message.id)}.pdf"
+
+    def _render_pdf(self, message: Message) -> Future | None:
+        """Start rendering the PDF if it's requested and not uploaded yet"""
+        if MessageFormat.PDF not in self.formats or self._existing_pdf(message):
+            return None
+        return self.gmail.render_pdf(message)
+
+    def _existing_pdf(self, message: Message) -> S3Dest | None:
+        # The PDF metadata hold the rendering date: a rendered PDF never has the
+        # ETag of the uploaded one, which is kept unless the policy is 'always'
+        return self._existing(self._pdf_dest(message), comparable=False)
+
+    def _sync_dumps(
+        self,
+        message_ref: dict,
+        message: Message,
+        pdf: Future | None = None,
+        formats: Set[MessageFormat] | None = None,
+        previous: List[S3Dest] | None = None,
+    ) -> List[S3Dest]:
+        """
+        Upload the dumps of the `formats`, the requested ones by default.
+        They're recorded along with the `previous` dumps of other formats.
+        """
+        if formats is None:
+            formats = self.formats
+        formats = formats - {MessageFormat.ATTACHMENTS}
+        fpath = PurePath(self.gmail.storage_path(message), message.id)
+        uploads = [_done(x) for x in previous or []]
+        dumps = set()
+        for fmt in formats.intersection(DUMP_FORMATS):
+            existing = self._existing(f"{fpath}.{fmt.value}")
+            if existing is not None:
+                uploads.append(_done(existing))
+            else:
+                dumps.add(fmt)
+        raw_message_paths = self.gmail.dump_message(message, dumps) if dumps else []
+        uploads.extend(
+            self.s3.upload_many(
+                (str(x), str(x.relative_to(self.gmail.dest_dir)))
+                for x in raw_message_paths
+            )
         )
-        if flag_label:
-            self.gmail.add_labels(message, [self.gmail.client.get_label_id(flag_label)])
+        if MessageFormat.EML in formats:
+            eml_dest = f"{fpath}.eml.gz" if self.eml_gzip else f"{fpath}.eml"
+            existing = self._existing(eml_dest)
+            if existing is not None:
+                uploads.append(_done(existing))
+            else:
+                eml = self.gmail.raw_message(message)
+                if self.eml_gzip:
+                    # Without the timestamp, the ETag only depends on the message
+                    eml = gzip.compress(eml, mtime=0)
+                uploads.extend(self.s3.upload_many([(eml, eml_dest)]))
+        if MessageFormat.PDF in formats:
+            existing = self._existing_pdf(message)
+            if existing is not None:
+                uploads.append(_done(existing))
+            else:
+                pdf = pdf or self.gmail.render_pdf(message)
+                uploads.extend(
+                    self.s3.upload_many([(pdf.result(), self._pdf_dest(message))])
+                )
+        s3_dests = [x.result() for x in uploads]
+        self._record(message_ref["id"], SyncStage.DUMPS, s3_dests, formats)
+        return s3_dests
+
+    def sync_email(
+        self,
+        message_ref: dict,
+        flag_label: str = "s3",
+        message: Message | None = None,
+        entry: LedgerEntry | None = None,
+    ) -> Tuple[dict, List[S3Dest]]:
+        """
+        Upload the attachments and the dumps of an email, trigger the webhooks
+        and flag it with the label. Stages, and formats, already completed
+        according to the ledger entry are skipped.
+        """
+        if entry is None:
+            entry = LedgerEntry(message_id=message_ref["id"])
+        if self._completed(entry, flag_label):
+            return (message_ref, self._ledger_dests(entry))
+        if message is None:
+            message = self.gmail.get_email(message_ref)
+        # One LIST of the message objects for the upload policy
+        self.s3.prefetch(self.gmail.storage_path(message) + "/")
+        missing = self._missing_formats(entry)
+
+        # The PDF renders in the render pool while the attachments are synced
+        pdf = None
+        if MessageFormat.PDF in missing:
+            pdf = self._render_pdf(message)
+        if MessageFormat.ATTACHMENTS in missing:
+            attachments, s3_dests = self._sync_attachments(message_ref, message)
+        else:
+            attachments = (
+                message.attachments if MessageFormat.ATTACHMENTS in self.formats else []
+            )
+            s3_dests = [S3Dest(**x) for x in entry.attachments_s3]
+            if not entry.attachments:
+                # Nothing to upload, the stage is done for `gmail-ledger --pending`
+                self._record(message_ref["id"], SyncStage.ATTACHMENTS)
+
+        dumps_s3 = [S3Dest(**x) for x in entry.dumps_s3]
+        if missing - {MessageFormat.ATTACHMENTS}:
+            dumps_s3 = self._sync_dumps(message_ref, message, pdf, missing, dumps_s3)
+        elif not entry.dumps:
+            self._record(message_ref["id"], SyncStage.DUMPS)
+        s3_dests.extend(dumps_s3)
+
+        if not entry.webhooks:
+            self.trigger_webhooks(
+                WebHookType.SYNCED_EMAIL,
+                message_ref,
+                attachments,
+                s3_dests,
+            )
+            self._record(message_ref["id"], SyncStage.WEBHOOKS)
+
+        if flag_label and not entry.labelled:
+            self.gmail.add_labels(message, [self.gmail.get_label_id(flag_label)])
+            self._record(message_ref["id"], SyncStage.LABELLED)
         return (message_ref, s3_dests)
 
-    def sync_emails_info(self) -> dict[str, Any]:
-        message_list = self.gmail.list_emails(self.message_query)
+    @staticmethod
+    def _ledger_dests(entry: LedgerEntry) -> List[S3Dest]:
+        return [S3Dest(**x) for x in entry.attachments_s3 + entry.dumps_s3]
+
+    def sync_emails_info(self, exact: bool = False) -> dict[str, Any]:
+        """
+        Number of emails to sync, estimated by Gmail unless `exact` is set.
+        """
         return {
-            "total": len(message_list.message_refs),
+            "total": self.gmail.count_emails(self.message_query, exact),
+            "exact": exact,
             "query": self.message_query.dict(),
         }
 
-    def sync_emails(self, flag_label: str = "s3") -> List[dict]:
-        message_list = self.gmail.list_emails(self.message_query)
-        total = len(message_list.message_refs)
-        i = 0
-        synced_emails = []
+    def _iter_emails(
+        self, message_query: MessageQuery, checkpoint: Checkpoint | None = None
+    ) -> Tuple[Iterable[List[dict]], str | None]:
+        """
+        Pages of emails to sync and the historyId to checkpoint once synced.
+        With a checkpoint, only the changes since the last sync are listed.
+        """
+        if checkpoint is None:
+            return self.gmail.iter_emails(message_query), None
+
+        state = checkpoint.load()
+        if state and state.get("history_id"):
+            history = self.gmail.list_history(state["history_id"], message_query)
+            if history is not None:
+                message_list, history_id = history
+                return [message_list.message_refs], history_id
+        # First run or expired checkpoint: get the historyId before listing
+        # so no message added during the sync is missed by the next run
+        history_id = self.gmail.get_history_id()
+        return self.gmail.iter_emails(message_query), history_id
+
+    def _sync_pages(
+        self, pages: Iterable[List[dict]], flag_label: str, workers: int
+    ) -> Iterator[Tuple[dict, List[S3Dest], LedgerEntry | None]]:
+        """
+        Sync the emails of each page as soon as it's listed and yield
+        (message_ref, s3_dests, ledger_entry) in the listing order.
+        Emails already synced according to the ledger are not fetched,
+        emails deleted since they were listed are skipped.
+        The flag label is left to the caller.
+        """
 
-        for message_ref in message_list.message_refs:
-            i += 1
-            logger.info("%s", message_ref)
-            logger.info("synced: %s/%s", i, total)
-            _, s3_dests = self.sync_email(message_ref, flag_label=flag_label)
-            synced_emails.append(
-                {
+        def with_entries() -> Iterator[List[Tuple[dict, LedgerEntry | None]]]:
+            for page in pages:
+                entries: Dict[str, LedgerEntry] = {}
+                if self.ledger is not None:
+                    entries = self.ledger.lookup([ref["id"] for ref in page])
+                yield [(ref, entries.get(ref["id"])) for ref in page]
+
+        def done(entry: LedgerEntry | None) -> bool:
+            return self._completed(entry, flag_label)
+
+        def sync(
+            ref: dict, entry: LedgerEntry | None, message: Message | None = None
+        ) -> Tuple[dict, List[S3Dest], LedgerEntry | None] | None:
+            if done(entry):
+                return ref, self._ledger_dests(entry), entry
+            if message is None:
+                try:
+                    message = self.gmail.get_email(ref)
+                except HttpError as exc:
+                    if exc.resp.status != 404:
+                        raise
+                    logger.warning("message %s deleted, skipped", ref["id"])
+                    return None
+            _, s3_dests = self.sync_email(
+                ref, flag_label="", message=message, entry=entry
+            )
+            return ref, s3_dests, entry
+
+        if workers > 1:
+            # Each worker fetches its own messages with its own client,
+            # the threads and so their clients outlive the sync
+            for synced in ordered_map(
+                lambda item: sync(*item),
+                chain.from_iterable(with_entries()),
+                workers=workers,
+                executor=sync_executor(),
+            ):
+                if synced is not None:
+                    yield synced
+            return
+
+        for page in with_entries():
+            with closing(
+                self.gmail.get_emails([ref for ref, entry in page if not done(entry)])
+            ) as messages:
+                for ref, entry in page:
+                    if done(entry):
+                        yield sync(ref, entry)
+                        continue
+                    fetched = next(messages, None)
+                    if fetched is None or fetched[0] is not ref:
+                        raise RuntimeError(f"message {ref['id']} fetched out of order")
+                    if fetched[1] is not None:
+                        yield sync(ref, entry, fetched[1])
+
+    def iter_sync_emails(
+        self,
+        flag_label: str = "s3",
+        workers: int = 1,
+        checkpoint: Checkpoint | None = None,
+        message_query: MessageQuery | None = None,
+    ) -> Iterator[dict]:
+        """
+        Sync all emails matching the query, or `message_query` if set,
+        and yield each synced email as soon as it's done.
+        Emails are listed page by page and synced while the next pages are listed.
+        With workers > 1, up to `workers` messages are processed at once,
+        each message still runs all its steps (upload, webhooks, label) in order.
+        Emails are yielded in the order of the message list.
+        With a checkpoint, only the emails added since the previous run are synced
+        and the checkpoint is updated once all of them are synced.
+        The flag label is applied by batches once the emails are synced.
+        """
+        pages, history_id = self._iter_emails(
+            message_query or self.message_query, checkpoint
+        )
+        synced = 0
+        label_id = self.gmail.get_label_id(flag_label) if flag_label else ""
+        try:
+            for message_ref, s3_dests, entry in self._sync_pages(
+                pages, flag_label, workers
+            ):
+                if label_id and not (entry and entry.labelled):
+                    self._queue_label(message_ref["id"], label_id)
+                synced += 1
+                logger.info("%s", message_ref)
+                logger.info("synced: %s", synced)
+                yield {
                     "message_id": message_ref["id"],
                     "s3_paths": [x.dict() for x in s3_dests],
                 }
-            )
+        finally:
+            # Label the emails synced so far, even if the sync failed
+            self._flush_labels()
+        if checkpoint is not None and history_id:
+            checkpoint.save({"history_id": history_id, "synced": synced})
+
+    def sync_emails(
+        self,
+        flag_label: str = "s3",
+        workers: int = 1,
+        checkpoint: Checkpoint | None = None,
+        message_query: MessageQuery | None = None,
+        progress: Callable[[dict], None] | None = None,
+    ) -> List[dict]:
+        """
+        Sync all emails and returns them, see `iter_sync_emails`.
+        `progress` is called with each synced email as soon as it's done.
+        """
+        synced_emails = []
+        with closing(
+            self.iter_sync_emails(flag_label, workers, checkpoint, message_query)
+        ) as emails:
+            for synced_email in emails:
+                synced_emails.append(synced_email)
+                if progress is not None:
+                    progress(synced_email)
         return synced_emails
 
+    def _queue_label(self, message_id: str, label_id: str):
+        if self.gmail.queue_labels(message_id, [label_id]) >= BATCH_MODIFY_MAX_IDS:
+            self._flush_labels()
+
+    def _flush_labels(self):
+        for message_id in self.gmail.flush_labels():
+            self._record(message_id, SyncStage.LABELLED)
+
     def forward_emails(
         self, to: str, forward_prefix="[FWD][G2S3] ", flag_label: str = ""
     ) -> List[dict]:
-        message_list = self.gmail.list_emails(self.message_query)
-        total = len(message_list.message_refs)
+        message_refs = chain.from_iterable(self.gmail.iter_emails(self.message_query))
         i = 0
         forwarded_emails = []
-        for message_ref in message_list.message_refs:
-            message = self.gmail.get_email(message_ref)
-            sender = message.sender
-            self.gmail.client.forward_message(
-                message, sender=sender, to=to, forward_prefix=forward_prefix
-            )
-            i += 1
-            logger.info("%s", message_ref)
-            logger.info("forwarded: %s/%s", i, total)
-            forwarded_emails.append({"message_id": message_ref["id"], "s3_paths": []})
-            if flag_label:
-                self.gmail.add_labels(
-                    message, [self.gmail.client.get_label_id(flag_label)]
+        label_id = self.gmail.get_label_id(flag_label) if flag_label else ""
+        try:
+            for message_ref, message in self.gmail.get_emails(message_refs):
+                self.gmail.forward_email(message, to=to, forward_prefix=forward_prefix)
+                i += 1
+                logger.info("%s", message_ref)
+                logger.info("forwarded: %s", i)
+                forwarded_emails.append(
+                    {"message_id": message_ref["id"], "s3_paths": []}
                 )
-
-            time.sleep(1)
+                if label_id:
+                    self._queue_label(message_ref["id"], label_id)
+        finally:
+            self._flush_labels()
         return forwarded_emails
 
     def forward_raw_emails(self, to: str, flag_label: str = "") -> List[dict]:
-        message_list = self.gmail.list_emails(self.message_query)
-        total = len(message_list.message_refs)
+        message_refs = chain.from_iterable(self.gmail.iter_emails(self.message_query))
         i = 0
         forwarded_emails = []
-        for message_ref in message_list.message_refs:
-            message = self.gmail.get_email(message_ref, with_raw=True)
-            sender = message.sender
-            self.gmail.client.forward_raw_message(message, to=to, sender=sender)
-            i += 1
-            logger.info("%s", message_ref)
-            logger.info("forwarded raw: %s/%s", i, total)
-            forwarded_emails.append({"message_id": message_ref["id"], "s3_paths": []})
-            if flag_label:
-                self.gmail.add_labels(
-                    message, [self.gmail.client.get_label_id(flag_label)]
+        label_id = self.gmail.get_label_id(flag_label) if flag_label else ""
+        try:
+            for message_ref, message in self.gmail.get_emails(
+                message_refs, with_raw=True
+            ):
+                self.gmail.forward_raw_email(message, to=to)
+                i += 1
+                logger.info("%s", message_ref)
+                logger.info("forwarded raw: %s", i)
+                forwarded_emails.append(
+                    {"message_id": message_ref["id"], "s3_paths": []}
                 )
-            time.sleep(1)
+                if label_id:
+                    self._queue_label(message_ref["id"], label_id)
+        finally:
+            self._flush_labels()
 
         return forwarded_emails
@@ -0,0 +1,363 @@
+import logging
+import os
+import pathlib
+import socket
+import sqlite3
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from enum import Enum
+from typing import Callable, Dict, List, Set
+
+from pydantic import BaseModel, Field
+
+from gmail2s3.config import GCONFIG
+
+logger = logging.getLogger(__name__)
+
+# A running job without progress or heartbeat for this long is considered dead
+JOB_STALE_AFTER = timedelta(minutes=10)
+# Interval of the heartbeats of the running jobs and of the resume of dead ones
+JOB_HEARTBEAT = timedelta(minutes=1)
+# Maximum number of errors kept on a job
+JOB_MAX_ERRORS = 20
+
+
+class JobStatus(str, Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLING = "cancelling"
+    CANCELLED = "cancelled"
+
+
+class Job(BaseModel):
+    id: str = Field("...")
+    kind: str = Field("...")
+    status: JobStatus = Field(JobStatus.PENDING)
+    params: dict = Field({})
+    processed: int = Field(0, description="Number of emails processed")
+    total: int | None = Field(None, description="Estimated number of emails")
+    bytes_uploaded: int = Field(0)
+    errors: List[str] = Field([])
+    result: List[dict] | None = Field(None)
+    owner: str | None = Field(None, description="Process running the job")
+    attempts: int = Field(0)
+    created_at: datetime = Field("...")
+    updated_at: datetime = Field("...")
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _owner_dead(owner: str | None) -> bool:
+    """True if the owner is a process of this host that exited"""
+    host, _, pid = (owner or "").rpartition("-")[0].rpartition("-")
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+class JobStore:
+    """
+    Jobs persisted in SQLite, shared by the workers of a server
+    so a job survives the restart of the worker running it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, job TEXT NOT NULL)"
+            )
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT job FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return Job.parse_raw(row[0])
+
+    def save(self, job: Job) -> Job:
+        job.updated_at = _now()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (id, job) VALUES (?, ?)",
+                (job.id, job.json()),
+            )
+        return job
+
+    def update(self, job_id: str, func: Callable[[Job], bool | None]) -> Job | None:
+        """
+        Apply `func` to the stored job and save it in one write transaction,
+        so concurrent updates of other threads or processes aren't lost.
+        `func` returns False to leave the job unchanged, or raises to abort.
+        Returns the updated job, None if it doesn't exist.
+        """
+        with self._lock, self._conn:
+            # Take the write lock before reading
+            self._conn.execute("BEGIN IMMEDIATE")
+            row = self._conn.execute(
+                "SELECT job FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            job = Job.parse_raw(row[0])
+            if func(job) is False:
+                return job
+            job.updated_at = _now()
+            self._conn.execute(
+                "UPDATE jobs SET job = ? WHERE id = ?", (job.json(), job.id)
+            )
+        return job
+
+    def claim(self, job: Job, owner: str) -> bool:
+        """
+        Take a job only if nobody updated it since it was read.
+        A resumed job reports all its emails again: its progress starts over.
+        """
+        previous = job.json()
+        if job.attempts > 0:
+            job.processed = 0
+            job.bytes_uploaded = 0
+        job.owner = owner
+        job.status = JobStatus.RUNNING
+        job.attempts += 1
+        job.updated_at = _now()
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET job = ? WHERE id = ? AND job = ?",
+                (job.json(), job.id, previous),
+            )
+        return cursor.rowcount == 1
+
+    def list(self) -> List[Job]:
+        with self._lock:
+            rows = self._conn.execute("SELECT job FROM jobs").fetchall()
+        return sorted(
+            (Job.parse_raw(row[0]) for row in rows), key=lambda x: x.created_at
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class JobProgress:
+    """Passed to a running job to report its progress and check cancellation"""
+
+    def __init__(self, manager: "JobManager", job: Job):
+        self.manager = manager
+        self.job = job
+
+    def set_total(self, total: int) -> None:
+        def update(job: Job) -> None:
+            self._check(job)
+            job.total = total
+
+        self._update(update)
+
+    def __call__(self, item: dict) -> None:
+        size = sum(x.get("size") or 0 for x in item.get("s3_paths", []))
+
+        def update(job: Job) -> None:
+            self._check(job)
+            job.processed += 1
+            job.bytes_uploaded += size
+
+        self._update(update)
+
+    def _update(self, func: Callable[[Job], None]) -> None:
+        job = self.manager.store.update(self.job.id, func)
+        if job is None:
+            raise JobCancelled(self.job.id)
+        self.job.total = job.total
+        self.job.processed = job.processed
+        self.job.bytes_uploaded = job.bytes_uploaded
+
+    def _check(self, stored: Job) -> None:
+        """Stop the job if it was cancelled or resumed by another process"""
+        if stored.status == JobStatus.CANCELLING or stored.owner != self.job.owner:
+            raise JobCancelled(self.job.id)
+
+
+JobFunc = Callable[[dict, JobProgress], List[dict]]
+
+
+class JobManager:
+    """
+    Run jobs in a background thread pool and track them in a JobStore.
+    Jobs are idempotent syncs: a job interrupted by a restart is run again
+    and skips the emails already synced. Once started, the manager sends
+    heartbeats for its running jobs and resumes the jobs of dead processes.
+    """
+
+    def __init__(self, store: JobStore, workers: int = 2):
+        self.store = store
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="gmail2s3-job"
+        )
+        self.funcs: Dict[str, JobFunc] = {}
+        self._running: Set[str] = set()
+        self._stopped = threading.Event()
+        self._monitor: threading.Thread | None = None
+
+    def register(self, kind: str, func: JobFunc) -> None:
+        self.funcs[kind] = func
+
+    def submit(self, kind: str, params: dict) -> Job:
+        if kind not in self.funcs:
+            raise ValueError(f"unknown job: {kind}")
+        now = _now()
+        job = Job(
+            id=uuid.uuid4().hex,
+            kind=kind,
+            params=params,
+            created_at=now,
+            updated_at=now,
+        )
+        self.store.save(job)
+        self._start(job)
+        return job
+
+    def _start(self, job: Job) -> None:
+        if self.store.claim(job, self.owner):
+            # Queued jobs get heartbeats too
+            self._running.add(job.id)
+            self.executor.submit(self._run, job)
+
+    def _run(self, job: Job) -> None:
+        try:
+            self._run_job(job)
+        finally:
+            self._running.discard(job.id)
+
+    def _run_job(self, job: Job) -> None:
+        logger.info("job %s started: %s", job.id, job.kind)
+        result = None
+        error = None
+        try:
+            result = self.funcs[job.kind](job.params, JobProgress(self, job))
+            status = JobStatus.SUCCEEDED
+        except JobCancelled:
+            status = JobStatus.CANCELLED
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.exception("job %s failed", job.id)
+            status = JobStatus.FAILED
+            error = repr(exc)
+
+        def finish(stored: Job) -> bool:
+            if stored.owner != job.owner:
+                logger.info("job %s taken over by %s", job.id, stored.owner)
+                return False
+            stored.status = status
+            stored.result = result
+            if error is not None:
+                stored.errors = (stored.errors + [error])[-JOB_MAX_ERRORS:]
+            return True
+
+        if self.store.update(job.id, finish) is not None:
+            logger.info("job %s: %s", job.id, status.value)
+
+    def get(self, job_id: str) -> Job | None:
+        return self.store.get(job_id)
+
+    def cancel(self, job_id: str) -> Job | None:
+        def cancel(job: Job) -> bool:
+            if job.status == JobStatus.PENDING:
+                job.status = JobStatus.CANCELLED
+            elif job.status == JobStatus.RUNNING:
+                # Picked up by the process running the job at its next progress
+                job.status = JobStatus.CANCELLING
+            else:
+                return False
+            return True
+
+        return self.store.update(job_id, cancel)
+
+    def resume(self) -> List[Job]:
+        """
+        Restart the jobs left pending or running by a dead process: a process
+        of this host that exited, or any process without heartbeat for
+        JOB_STALE_AFTER
+        """
+        resumed = []
+        stale = _now() - JOB_STALE_AFTER
+        for job in self.store.list():
+            if job.kind not in self.funcs:
+                continue
+            if job.status == JobStatus.PENDING or (
+                job.status in (JobStatus.RUNNING, JobStatus.CANCELLING)
+                and (job.updated_at < stale or _owner_dead(job.owner))
+            ):
+                if job.status == JobStatus.CANCELLING:
+                    self.store.update(job.id, self._cancelled(job))
+                    continue
+                logger.info("resume job %s", job.id)
+                self._start(job)
+                resumed.append(job)
+        return resumed
+
+    @staticmethod
+    def _cancelled(job: Job) -> Callable[[Job], bool]:
+        """Mark the job read as `job` cancelled, if nobody updated it since"""
+
+        def cancelled(stored: Job) -> bool:
+            if stored.updated_at != job.updated_at:
+                return False
+            stored.status = JobStatus.CANCELLED
+            return True
+
+        return cancelled
+
+    def heartbeat(self) -> None:
+        """Show that the jobs run by this process are alive, even without progress"""
+        for job_id in list(self._running):
+            self.store.update(job_id, lambda job: job.owner == self.owner)
+
+    def start(self, interval: timedelta = JOB_HEARTBEAT) -> None:
+        """Resume the dead jobs now, then send heartbeats and resume periodically"""
+        self.resume()
+
+        def monitor() -> None:
+            while not self._stopped.wait(interval.total_seconds()):
+                try:
+                    self.heartbeat()
+                    self.resume()
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("jobs monitor failed")
+
+        self._monitor = threading.Thread(
+            target=monitor, name="gmail2s3-jobs-monitor", daemon=True
+        )
+        self._monitor.start()
+
+    def shutdown(self) -> None:
+        self._stopped.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def default_job_manager() -> JobManager:
+    return JobManager(
+        JobStore(GCONFIG.gmail2s3["jobs_db"]),
+        workers=GCONFIG.gmail2s3["jobs_workers"],
+    )
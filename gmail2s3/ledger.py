@@ -0,0 +1,235 @@
+import csv
+import json
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from enum import Enum
+from pathlib import PurePath
+from typing import Dict, Iterable, List, TextIO
+
+from pydantic import BaseModel, Field
+
+from gmail2s3.config import GCONFIG
+from gmail2s3.utils import chunked
+
+logger = logging.getLogger(__name__)
+
+# SQLite limits the number of variables per query
+LOOKUP_CHUNK_SIZE = 500
+
+
+class SyncStage(str, Enum):
+    ATTACHMENTS = "attachments"
+    DUMPS = "dumps"
+    WEBHOOKS = "webhooks"
+    LABELLED = "labelled"
+
+
+class LedgerEntry(BaseModel):
+    message_id: str = Field("...")
+    attachments: bool = Field(False, description="Attachments uploaded")
+    dumps: bool = Field(False, description="json/txt/pdf/eml dumps uploaded")
+    webhooks: bool = Field(False, description="synced_email webhooks triggered")
+    labelled: bool = Field(False, description="Sync label applied to the email")
+    attachments_s3: List[dict] = Field([])
+    dumps_s3: List[dict] = Field([])
+    formats: List[str] = Field(
+        [], description="Formats uploaded by the attachments and dumps stages"
+    )
+    updated_at: str | None = Field(None)
+
+    def completed(
+        self, flag_label: str = "s3", formats: Iterable[str] | None = None
+    ) -> bool:
+        """
+        All the stages are done. With `formats`, the uploads stages are done
+        only if they covered all of them, not just the formats of a previous run.
+        """
+        if formats is None:
+            uploaded = self.attachments and self.dumps
+        else:
+            uploaded = set(formats) <= set(self.formats)
+        return uploaded and self.webhooks and (self.labelled or not flag_label)
+
+
+class SyncLedger:
+    """
+    Persistent record of the sync stages completed for each message.
+    Used to skip the work already done when a sync is re-run.
+    """
+
+    columns = [
+        "message_id",
+        "attachments",
+        "dumps",
+        "webhooks",
+        "labelled",
+        "attachments_s3",
+        "dumps_s3",
+        "formats",
+        "updated_at",
+    ]
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS sync_ledger (
+                    message_id TEXT PRIMARY KEY,
+                    attachments INTEGER NOT NULL DEFAULT 0,
+                    dumps INTEGER NOT NULL DEFAULT 0,
+                    webhooks INTEGER NOT NULL DEFAULT 0,
+                    labelled INTEGER NOT NULL DEFAULT 0,
+                    attachments_s3 TEXT NOT NULL DEFAULT '[]',
+                    dumps_s3 TEXT NOT NULL DEFAULT '[]',
+                    formats TEXT,
+                    updated_at TEXT
+                )"""
+            )
+            columns = {
+                row["name"]
+                for row in self._conn.execute("PRAGMA table_info(sync_ledger)")
+            }
+            if "formats" not in columns:
+                # Ledger of a previous version: formats are guessed on read
+                self._conn.execute("ALTER TABLE sync_ledger ADD COLUMN formats TEXT")
+            # Content-addressed attachments already in the bucket
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS blobs (
+                    bucket TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    PRIMARY KEY (bucket, path)
+                )"""
+            )
+
+    @staticmethod
+    def _entry(row: sqlite3.Row) -> LedgerEntry:
+        values = dict(row)
+        values["attachments_s3"] = json.loads(values["attachments_s3"])
+        values["dumps_s3"] = json.loads(values["dumps_s3"])
+        if values["formats"] is None:
+            values["formats"] = _uploaded_formats(values)
+        else:
+            values["formats"] = json.loads(values["formats"])
+        return LedgerEntry(**values)
+
+    def lookup(self, message_ids: Iterable[str]) -> Dict[str, LedgerEntry]:
+        """Returns the entries of the known messages, indexed by message_id"""
+        res: Dict[str, LedgerEntry] = {}
+        with self._lock:
+            for ids in chunked(message_ids, LOOKUP_CHUNK_SIZE):
+                rows = self._conn.execute(
+                    "SELECT * FROM sync_ledger WHERE message_id IN "
+                    f"({','.join('?' * len(ids))})",
+                    ids,
+                )
+                for row in rows:
+                    res[row["message_id"]] = self._entry(row)
+        return res
+
+    def get(self, message_id: str) -> LedgerEntry:
+        return self.lookup([message_id]).get(
+            message_id, LedgerEntry(message_id=message_id)
+        )
+
+    def record(
+        self,
+        message_id: str,
+        stage: SyncStage,
+        s3_paths: List[dict] | None = None,
+        formats: Iterable[str] = (),
+    ) -> None:
+        """
+        Mark a stage as completed, with the S3 paths it uploaded.
+        The `formats` it uploaded are added to the ones of the other stages.
+        """
+        now = datetime.now(timezone.utc).isoformat()
+        params = {"message_id": message_id, "updated_at": now}
+        assignments = [f"{stage.value} = 1", "updated_at = :updated_at"]
+        if stage in (SyncStage.ATTACHMENTS, SyncStage.DUMPS):
+            params["s3_paths"] = json.dumps(s3_paths or [])
+            assignments.append(f"{stage.value}_s3 = :s3_paths")
+            assignments.append("formats = :formats")
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO sync_ledger (message_id) VALUES (:message_id)",
+                params,
+            )
+            if "s3_paths" in params:
+                row = self._conn.execute(
+                    "SELECT * FROM sync_ledger WHERE message_id = :message_id",
+                    params,
+                ).fetchone()
+                covered = set(self._entry(row).formats).union(formats)
+                params["formats"] = json.dumps(sorted(covered))
+            self._conn.execute(
+                f"UPDATE sync_ledger SET {', '.join(assignments)} "
+                "WHERE message_id = :message_id",
+                params,
+            )
+
+    def entries(self, pending_only: bool = False) -> List[LedgerEntry]:
+        query = "SELECT * FROM sync_ledger"
+        if pending_only:
+            query += " WHERE NOT (attachments AND dumps AND webhooks AND labelled)"
+        with self._lock:
+            return [self._entry(row) for row in self._conn.execute(query)]
+
+    def export(self, output: TextIO, fmt: str = "json", pending_only=False) -> int:
+        """Write all entries to `output` as json lines or csv"""
+        entries = self.entries(pending_only=pending_only)
+        if fmt == "csv":
+            writer = csv.DictWriter(output, fieldnames=self.columns)
+            writer.writeheader()
+            for entry in entries:
+                row = entry.dict()
+                row["attachments_s3"] = json.dumps(row["attachments_s3"])
+                row["dumps_s3"] = json.dumps(row["dumps_s3"])
+                row["formats"] = json.dumps(row["formats"])
+                writer.writerow(row)
+        else:
+            for entry in entries:
+                output.write(entry.json() + "\n")
+        return len(entries)
+
+    def has_blob(self, bucket: str, path: str) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM blobs WHERE bucket = ? AND path = ?", (bucket, path)
+            ).fetchone()
+        return row is not None
+
+    def record_blob(self, bucket: str, path: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO blobs (bucket, path) VALUES (?, ?)",
+                (bucket, path),
+            )
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def _uploaded_formats(values: dict) -> List[str]:
+    """
+    Formats of an entry recorded before they were: the ones of its dumps,
+    and the attachments once their stage is done
+    """
+    formats = {"attachments"} if values["attachments"] else set()
+    for dump in values["dumps_s3"]:
+        path = dump["path"].removesuffix(".gz")
+        formats.add(PurePath(path).suffix.lstrip("."))
+    return sorted(formats)
+
+
+def default_ledger(path: str | None = None) -> SyncLedger | None:
+    """Open the ledger at `path`, or the configured one if any"""
+    if not path:
+        path = GCONFIG.gmail2s3["ledger"]
+    if not path:
+        return None
+    return SyncLedger(path)
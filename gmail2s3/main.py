@@ -9,7 +9,10 @@ from starlette.exceptions import ExceptionMiddleware
 from starlette.responses import JSONResponse
 from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
 from sentry_sdk.integrations.asgi import SentryAsgiMiddleware
-from gmail2s3.api import gmail2s3, info
+from gmail2s3.api import gmail2s3, info, jobs, messages
+from gmail2s3.api.concurrency import shutdown_executor
+from gmail2s3.gmailauth import shutdown_sync_executor
+from gmail2s3.pdf import shutdown_render_pool
 
 from gmail2s3.exception import UnauthorizedAccess
 from gmail2s3.config import GCONFIG
@@ -61,7 +64,9 @@ app.add_middleware(ExceptionMiddleware, handlers=app.exception_handlers)
 app.add_route("/metrics", handle_metrics)
 
 
-def exception_handler(exc: Exception, message: str, status: int, request: Request):
+def exception_handler(
+    exc: Exception, message: str, status: int, request: Request, headers=None
+):
     logger.error(exc)
     logger.error("".join(traceback.format_exception(type(exc), exc, exc.__traceback__)))
     request_dict = {
@@ -78,6 +83,7 @@ def exception_handler(exc: Exception, message: str, status: int, request: Reques
             "status": status,
         },
         status_code=status,
+        headers=headers,
     )
 
 
@@ -89,10 +95,33 @@ async def any_exception_handler(request: Request, exc: Exception):
 
 @app.exception_handler(Gmail2S3Exception)
 async def custom_exception_handler(request: Request, exc: Gmail2S3Exception):
-    return exception_handler(exc, exc.to_dict(), exc.status_code, request)
+    return exception_handler(
+        exc, exc.to_dict(), exc.status_code, request, getattr(exc, "headers", None)
+    )
+
+
+@app.on_event("startup")
+async def resume_jobs():
+    # Restart the jobs interrupted by a previous worker, then keep
+    # resuming the jobs of the workers dying while this one is up
+    app.state.jobs = jobs.job_manager()
+    app.state.jobs.start()
+
+
+@app.on_event("shutdown")
+async def close_aiogmail():
+    if getattr(app.state, "aiogmail", None) is not None:
+        await app.state.aiogmail.close()
+    if getattr(app.state, "jobs", None) is not None:
+        app.state.jobs.shutdown()
+    shutdown_executor()
+    shutdown_sync_executor()
+    shutdown_render_pool()
 
 
 # # Uncomment to check a token before serving the API
 # app.middleware("http")(add_check_token)
 app.include_router(info.router)
 app.include_router(gmail2s3.router)
+app.include_router(messages.router)
+app.include_router(jobs.router)
@@ -0,0 +1,192 @@
+"""
+Render emails to PDF.
+
+`fpdf` renders in the process, `wkhtmltopdf` starts a wkhtmltopdf
+(and X server) process per email but keeps the HTML layout.
+"""
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import lru_cache
+from typing import Dict, Type
+
+import fpdf
+import pdfkit
+
+from gmail2s3.config import GCONFIG
+
+
+class PdfRenderer:
+    name = "base"
+
+    def render(self, text: str) -> bytes:
+        """Render the email as text, `Message.as_simple_string`, to PDF"""
+        raise NotImplementedError
+
+
+class WkhtmltopdfRenderer(PdfRenderer):
+    name = "wkhtmltopdf"
+
+    def render(self, text: str) -> bytes:
+        html = f'<html><header><meta charset="utf-8"/></header><body><div>{text}</div></body></html>'
+        html = html.replace("\n", "<br />\n")
+        return pdfkit.from_string(html, False)
+
+
+# fpdf's TrueType support is limited to the Basic Multilingual Plane
+NON_BMP = re.compile("[\U00010000-\U0010ffff]")
+
+
+class FpdfRenderer(PdfRenderer):
+    """
+    In-process renderer. With a TrueType `font` any unicode text is rendered,
+    without it the text is limited to latin-1 and other characters replaced.
+    """
+
+    name = "fpdf"
+    font_size = 10
+
+    def __init__(self, font: str | None = None, cache_dir: str | None = None):
+        self.font = font if font and os.path.exists(font) else None
+        if self.font and cache_dir:
+            # Parse the font once and keep its metrics out of the font directory
+            os.makedirs(cache_dir, exist_ok=True)
+            fpdf.set_global("FPDF_CACHE_MODE", 2)
+            fpdf.set_global("FPDF_CACHE_DIR", cache_dir)
+        # fpdf's font loading isn't thread-safe
+        self._lock = threading.Lock()
+
+    def render(self, text: str) -> bytes:
+        with self._lock:
+            pdf = fpdf.FPDF()
+            pdf.set_auto_page_break(True, margin=15)
+            pdf.add_page()
+            if self.font:
+                pdf.add_font("email", fname=self.font, uni=True)
+                pdf.set_font("email", size=self.font_size)
+                # Emojis and such fail the rendering, replace them
+                text = NON_BMP.sub("\ufffd", text)
+            else:
+                text = text.encode("latin-1", "replace").decode("latin-1")
+                pdf.set_font("Helvetica", size=self.font_size)
+            pdf.multi_cell(0, self.font_size * 0.5, text.replace("\t", "    "))
+            return pdf.output(dest="S").encode("latin-1")
+
+
+RENDERERS: Dict[str, Type[PdfRenderer]] = {
+    FpdfRenderer.name: FpdfRenderer,
+    WkhtmltopdfRenderer.name: WkhtmltopdfRenderer,
+}
+
+
+def get_renderer(
+    name: str | None = None, font: str | None = None, cache_dir: str | None = None
+) -> PdfRenderer:
+    """Renderer shared by the process, the configured one for unset options"""
+    conf = GCONFIG.gmail2s3
+    return _renderer(
+        name or conf["pdf_renderer"],
+        conf["pdf_font"] if font is None else font,
+        os.path.join(conf["tmp_dir"], "fonts") if cache_dir is None else cache_dir,
+    )
+
+
+@lru_cache(maxsize=None)
+def _renderer(name: str, font: str, cache_dir: str) -> PdfRenderer:
+    if name not in RENDERERS:
+        raise ValueError(f"unknown PDF renderer: {name}")
+    if name == FpdfRenderer.name:
+        return FpdfRenderer(font=font, cache_dir=cache_dir)
+    return RENDERERS[name]()
+
+
+def render_pdf(
+    text: str,
+    renderer: str | None = None,
+    font: str | None = None,
+    cache_dir: str | None = None,
+) -> bytes:
+    return get_renderer(renderer, font, cache_dir).render(text)
+
+
+class RenderPool:
+    """
+    Render PDFs in worker processes, on all the cores, while the calling
+    threads keep downloading and uploading emails. At most `maxsize` renders
+    are queued or running: `submit` blocks until one is done above.
+    """
+
+    def __init__(
+        self,
+        workers: int | None = None,
+        maxsize: int | None = None,
+        renderer: str | None = None,
+    ):
+        self.workers = workers or os.cpu_count() or 1
+        self.renderer = renderer or GCONFIG.gmail2s3["pdf_renderer"]
+        # Spawned workers only see the default configuration, not --conf
+        self.font = GCONFIG.gmail2s3["pdf_font"]
+        self.cache_dir = os.path.join(GCONFIG.gmail2s3["tmp_dir"], "fonts")
+        self._slots = threading.BoundedSemaphore(maxsize or 2 * self.workers)
+        # Forking a process running boto3/httplib2 threads isn't safe
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def submit(self, text: str) -> Future:
+        """Start rendering the text to PDF, returns a Future of the PDF bytes"""
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(
+                render_pdf, text, self.renderer, self.font, self.cache_dir
+            )
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_POOL: RenderPool | None = None
+_POOL_LOCK = threading.Lock()
+
+
+def render_pool() -> RenderPool | None:
+    """Render pool shared by the process, None if `render_workers` is 0"""
+    global _POOL  # pylint: disable=global-statement
+    workers = GCONFIG.gmail2s3["render_workers"]
+    if workers == 0:
+        return None
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = RenderPool(workers, maxsize=GCONFIG.gmail2s3["render_queue"])
+    return _POOL
+
+
+def shutdown_render_pool() -> None:
+    global _POOL  # pylint: disable=global-statement
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.shutdown()
+            _POOL = None
+
+
+def render_async(text: str) -> Future:
+    """
+    Render the text to PDF in the render pool,
+    or in the calling thread if the pool is disabled
+    """
+    pool = render_pool()
+    if pool is not None:
+        return pool.submit(text)
+    future: Future = Future()
+    try:
+        future.set_result(render_pdf(text))
+    except Exception as exc:  # pylint: disable=broad-except
+        future.set_exception(exc)
+    return future
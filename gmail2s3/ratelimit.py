@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Awaitable, Callable
+
+from googleapiclient.errors import HttpError
+
+from gmail2s3.config import GCONFIG
+
+logger = logging.getLogger(__name__)
+
+# Cost of each Gmail API method in quota units
+# https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    "getProfile": 1,
+    "history.list": 2,
+    "labels.list": 1,
+    "labels.get": 1,
+    "labels.create": 5,
+    "messages.list": 5,
+    "messages.get": 5,
+    "messages.attachments.get": 5,
+    "messages.modify": 5,
+    "messages.batchModify": 50,
+    "messages.send": 100,
+}
+DEFAULT_QUOTA_UNITS = 5
+
+
+def is_rate_limited(exc: HttpError) -> bool:
+    if exc.resp.status == 429:
+        return True
+    # rateLimitExceeded and userRateLimitExceeded are returned as 403
+    return (
+        exc.resp.status == 403 and b"ratelimitexceeded" in (exc.content or b"").lower()
+    )
+
+
+class QuotaLimiter:
+    """
+    Token bucket of Gmail quota units, refilled at `rate` units per second.
+    The rate is halved when Gmail answers with a rate limit error
+    and grows back by `increase` units per second after each successful call.
+    """
+
+    def __init__(
+        self,
+        max_rate: float = 250,
+        min_rate: float = 5,
+        increase: float = 1,
+        retries: int = 5,
+    ):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.rate = max_rate
+        self.increase = increase
+        self.retries = retries
+        self.tokens = max_rate
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def _reserve(self, units: float) -> float:
+        """
+        Take `units` from the bucket, returns the time to wait for them.
+        The bucket goes into debt rather than capping the cost of a call
+        at its size, the next calls wait for the debt to be refilled.
+        """
+        with self._lock:
+            self._refill()
+            self.tokens -= units
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self, units: float) -> float:
+        """Block until `units` are available, returns the time waited"""
+        wait = self._reserve(units)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    async def aacquire(self, units: float) -> float:
+        wait = self._reserve(units)
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+            logger.warning("Gmail rate limited, slow down to %s units/s", self.rate)
+
+    def call(self, method: str, func: Callable, *args, **kwargs) -> Any:
+        """
+        Call `func` once the quota units of the Gmail `method` are available.
+        Rate limited calls are retried with an exponential backoff.
+        """
+        units = QUOTA_UNITS.get(method, DEFAULT_QUOTA_UNITS)
+        attempt = 0
+        while True:
+            self.acquire(units)
+            try:
+                res = func(*args, **kwargs)
+            except HttpError as exc:
+                if not is_rate_limited(exc) or attempt >= self.retries:
+                    raise
+                self.on_throttle()
+                time.sleep(2**attempt)
+                attempt += 1
+            else:
+                self.on_success()
+                return res
+
+    async def acall(self, method: str, func: Callable[..., Awaitable], *args, **kwargs):
+        """asyncio version of `call`, `func` is a coroutine function"""
+        units = QUOTA_UNITS.get(method, DEFAULT_QUOTA_UNITS)
+        attempt = 0
+        while True:
+            await self.aacquire(units)
+            try:
+                res = await func(*args, **kwargs)
+            except HttpError as exc:
+                if not is_rate_limited(exc) or attempt >= self.retries:
+                    raise
+                self.on_throttle()
+                await asyncio.sleep(2**attempt)
+                attempt += 1
+            else:
+                self.on_success()
+                return res
+
+
+_limiter_lock = threading.Lock()
+_limiters: dict[str, QuotaLimiter] = {}
+
+
+def gmail_limiter() -> QuotaLimiter:
+    """
+    Limiter shared by all the Gmail clients of the process, the quota being per user.
+    Created on first use so it picks the loaded configuration.
+    """
+    with _limiter_lock:
+        if "gmail" not in _limiters:
+            _limiters["gmail"] = QuotaLimiter(
+                max_rate=GCONFIG.gmail["quota_units_per_second"]
+            )
+        return _limiters["gmail"]
@@ -1,13 +1,104 @@
+import hashlib
+import io
+import os
+import threading
+from concurrent.futures import Future
+from enum import Enum
 from pathlib import PurePath
-from typing import Tuple
+from typing import BinaryIO, Dict, Iterable, List, Tuple
 import boto3
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
 from botocore.client import Config
+from botocore.exceptions import ClientError
 from pydantic import BaseModel, Field
+from s3transfer.manager import TransferManager
+from s3transfer.subscribers import BaseSubscriber
+
+from gmail2s3.utils import ClientRegistry, client_threads
+
+MB = 1024 * 1024
+
+# boto3 clients, one per thread, and transfer managers reused by the process
+S3_CLIENTS = ClientRegistry(maxsize=client_threads)
+TRANSFERS = ClientRegistry(maxsize=8)
+
+
+class UploadPolicy(str, Enum):
+    ALWAYS = "always"
+    IF_MISSING = "if-missing"
+    IF_CHANGED = "if-changed"
 
 
 class S3Dest(BaseModel):
     bucket: str = Field("...")
     path: str = Field("...")
+    size: int | None = Field(None, description="Size of the object in bytes")
+    filename: str | None = Field(
+        None, description="Original name of a content-addressed object"
+    )
+
+
+def _options_key(options: dict) -> tuple:
+    return tuple(
+        sorted((k, v) for k, v in options.items() if k not in ("bucket", "prefix"))
+    )
+
+
+def transfer_config(options: dict) -> TransferConfig:
+    return TransferConfig(
+        multipart_threshold=options.get("multipart_threshold") or 8 * MB,
+        multipart_chunksize=options.get("multipart_chunksize") or 8 * MB,
+        max_concurrency=options.get("max_concurrency") or 10,
+    )
+
+
+def etag(src: bytes | str, config: TransferConfig) -> str:
+    """
+    ETag S3 computes for the content, bytes or a file path, uploaded with
+    this transfer config: the MD5, or the MD5 of the parts MD5 if multipart
+    """
+    size = len(src) if isinstance(src, bytes) else os.path.getsize(src)
+    with io.BytesIO(src) if isinstance(src, bytes) else open(src, "rb") as content:
+        if size < config.multipart_threshold:
+            return f'"{hashlib.md5(content.read()).hexdigest()}"'
+        parts = []
+        while chunk := content.read(config.multipart_chunksize):
+            parts.append(hashlib.md5(chunk).digest())
+    return f'"{hashlib.md5(b"".join(parts)).hexdigest()}-{len(parts)}"'
+
+
+# Conditional PutObject headers, not in the PutObject model of older botocores
+CONDITIONAL_PUT_PARAMS = {"IfNoneMatch": "If-None-Match", "IfMatch": "If-Match"}
+
+
+def _pop_conditions(params: dict, context: dict, **_) -> None:
+    """Keep the conditions out of the validated parameters"""
+    context["put_conditions"] = {
+        header: params.pop(name)
+        for name, header in CONDITIONAL_PUT_PARAMS.items()
+        if name in params
+    }
+
+
+def _add_conditions(params: dict, context: dict, **_) -> None:
+    params["headers"].update(context.pop("put_conditions", {}))
+
+
+class _TransferDone(BaseSubscriber):
+    """Resolve a Future with `result` once the transfer is done"""
+
+    def __init__(self, future: Future, result):
+        super().__init__()
+        self.future = future
+        self.result = result
+
+    def on_done(self, future, **kwargs):
+        try:
+            future.result()
+        except Exception as exc:  # pylint: disable=broad-except
+            self.future.set_exception(exc)
+        else:
+            self.future.set_result(self.result)
 
 
 class S3Client:
@@ -27,18 +118,202 @@ class S3Client:
         self.options: dict = options
         kwargs: dict = self._boto_args(options)
         self.client = boto3.resource("s3", **kwargs)
+        events = self.client.meta.client.meta.events
+        events.register("provide-client-params.s3.PutObject", _pop_conditions)
+        events.register("before-call.s3.PutObject", _add_conditions)
         self.bucket: str = bucket
         self.prefix: str = prefix
+        self.transfer_config = transfer_config(options)
+        self.upload_policy = UploadPolicy(
+            options.get("upload_policy") or UploadPolicy.ALWAYS
+        )
+        # (prefix, {path: (size, etag)}) of the last prefetched prefix
+        self._listing: Tuple[str, Dict[str, Tuple[int, str]]] | None = None
+
+    @property
+    def transfer(self) -> TransferManager:
+        """
+        Transfer manager shared by all the S3Clients of the process with the
+        same endpoint and credentials: one thread pool and connection pool
+        """
+        return TRANSFERS.get(_options_key(self.options), self._new_transfer)
+
+    def _new_transfer(self) -> TransferManager:
+        kwargs = self._boto_args(self.options)
+        kwargs["config"] = kwargs["config"].merge(
+            Config(max_pool_connections=self.transfer_config.max_request_concurrency)
+        )
+        client = boto3.session.Session().client("s3", **kwargs)
+        return create_transfer_manager(client, self.transfer_config)
 
     def buildpath(self, filename: str, dest: str = ""):
         if not dest:
             dest = PurePath(filename).name
         return f"{self.prefix}{dest}"
 
+    def prefetch(self, dest_prefix: str) -> None:
+        """
+        List the objects under a prefix, usually a message, so the upload
+        policy checks them with one LIST instead of a HEAD per object
+        """
+        if self.upload_policy == UploadPolicy.ALWAYS:
+            return
+        prefix = f"{self.prefix}{dest_prefix}"
+        objects = {
+            x.key: (x.size, x.e_tag)
+            for x in self.client.Bucket(self.bucket).objects.filter(Prefix=prefix)
+        }
+        self._listing = (prefix, objects)
+
+    def _head(self, path: str) -> Tuple[int, str] | None:
+        """(size, etag) of an object or None if it doesn't exist"""
+        if self._listing is not None and path.startswith(self._listing[0]):
+            return self._listing[1].get(path)
+        try:
+            head = self.client.meta.client.head_object(Bucket=self.bucket, Key=path)
+        except ClientError as exc:
+            if exc.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+        return head["ContentLength"], head["ETag"]
+
+    def _skip_upload(self, path: str, src: bytes | str) -> bool:
+        """True if the upload policy says the object is already up to date"""
+        if self.upload_policy == UploadPolicy.ALWAYS:
+            return False
+        remote = self._head(path)
+        if remote is None:
+            return False
+        if self.upload_policy == UploadPolicy.IF_MISSING:
+            return True
+        size = len(src) if isinstance(src, bytes) else os.path.getsize(src)
+        return remote[0] == size and remote[1] == etag(src, self.transfer_config)
+
     def upload_file(self, filepath: str, dest: str = "") -> S3Dest:
         path = self.buildpath(filepath, dest)
-        self.client.Bucket(self.bucket).upload_file(filepath, path)
-        return S3Dest(bucket=self.bucket, path=path)
+        if not self._skip_upload(path, filepath):
+            self.client.Bucket(self.bucket).upload_file(
+                filepath, path, Config=self.transfer_config
+            )
+        return S3Dest(bucket=self.bucket, path=path, size=os.path.getsize(filepath))
+
+    def upload_many(self, uploads: Iterable[Tuple[str | bytes, str]]) -> List[Future]:
+        """
+        Start uploading (filepath or content, dest) pairs concurrently through
+        the shared transfer manager and return a Future of S3Dest per upload.
+        Objects already up to date according to the upload policy are skipped.
+        """
+        futures = []
+        for src, dest in uploads:
+            path = f"{self.prefix}{dest}"
+            if isinstance(src, bytes):
+                fileobj: str | BinaryIO = io.BytesIO(src)
+                size = len(src)
+            else:
+                fileobj = src
+                size = os.path.getsize(src)
+            future: Future = Future()
+            if self._skip_upload(path, src):
+                future.set_result(S3Dest(bucket=self.bucket, path=path, size=size))
+                futures.append(future)
+                continue
+            self.transfer.upload(
+                fileobj,
+                self.bucket,
+                path,
+                subscribers=[
+                    _TransferDone(
+                        future, S3Dest(bucket=self.bucket, path=path, size=size)
+                    )
+                ],
+            )
+            futures.append(future)
+        return futures
+
+    def put_object(self, data: bytes, dest: str) -> S3Dest:
+        path = f"{self.prefix}{dest}"
+        self.client.Object(self.bucket, path).put(Body=data)
+        return S3Dest(bucket=self.bucket, path=path, size=len(data))
+
+    def get_object(self, dest: str) -> bytes | None:
+        """Returns the content of the object or None if it doesn't exist"""
+        path = f"{self.prefix}{dest}"
+        try:
+            return self.client.Object(self.bucket, path).get()["Body"].read()
+        except ClientError as exc:
+            if exc.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+
+    def get_object_etag(self, dest: str) -> Tuple[bytes, str] | None:
+        """Returns the content of the object and its ETag, None if it doesn't exist"""
+        path = f"{self.prefix}{dest}"
+        try:
+            resp = self.client.Object(self.bucket, path).get()
+        except ClientError as exc:
+            if exc.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+        return resp["Body"].read(), resp["ETag"]
+
+    def put_object_if(
+        self, data: bytes, dest: str, if_match: str | None = None
+    ) -> S3Dest | None:
+        """
+        Conditional write: create the object only if it doesn't exist, or with
+        `if_match`, an ETag, replace it only if it wasn't changed since it was read.
+        Returns None if the condition failed, another writer got there first.
+        """
+        path = f"{self.prefix}{dest}"
+        condition = {"IfMatch": if_match} if if_match else {"IfNoneMatch": "*"}
+        try:
+            self.client.meta.client.put_object(
+                Bucket=self.bucket, Key=path, Body=data, **condition
+            )
+        except ClientError as exc:
+            code = exc.response["Error"]["Code"]
+            if code in ("PreconditionFailed", "ConditionalRequestConflict"):
+                return None
+            # The object read was deleted meanwhile
+            if if_match and code in ("NoSuchKey", "404"):
+                return None
+            raise
+        return S3Dest(bucket=self.bucket, path=path, size=len(data))
+
+    def presigned_url(self, dest: str, expires: int = 3600) -> str:
+        """Temporary URL to download the object without credentials"""
+        return self.client.meta.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": f"{self.prefix}{dest}"},
+            ExpiresIn=expires,
+        )
+
+    def stat(self, dest: str) -> S3Dest | None:
+        """The object if it exists, looked up in the prefetched listing if any"""
+        path = f"{self.prefix}{dest}"
+        head = self._head(path)
+        if head is None:
+            return None
+        return S3Dest(bucket=self.bucket, path=path, size=head[0])
+
+    def exists(self, dest: str) -> bool:
+        return self._head(f"{self.prefix}{dest}") is not None
+
+    def delete_object(self, dest: str) -> None:
+        self.client.Object(self.bucket, f"{self.prefix}{dest}").delete()
+
+    @staticmethod
+    def copy_path(
+        src_path: str,
+        dest_prefix: str = "",
+        name_only: bool = False,
+        dest_name: str | None = None,
+    ) -> str:
+        if dest_name:
+            return f"{dest_prefix}{dest_name}"
+        if not name_only:
+            return f"{dest_prefix}{src_path}"
+        return f"{dest_prefix}{PurePath(src_path).name}"
 
     def copy_s3_to_s3(
         self,
@@ -47,20 +322,46 @@ class S3Client:
         dest_bucket: str,
         dest_prefix: str = "",
         name_only: bool = False,
+        dest_name: str | None = None,
     ) -> Tuple[S3Dest, S3Dest]:
         copy_source = {
             "Bucket": src_bucket,
             "Key": src_path,
         }
-
-        if not name_only:
-            dest_path = f"{dest_prefix}{src_path}"
-        else:
-            dest_path = f"{dest_prefix}{PurePath(src_path).name}"
-
-        self.client.meta.client.copy(copy_source, dest_bucket, dest_path)
+        dest_path = self.copy_path(src_path, dest_prefix, name_only, dest_name)
+        self.client.meta.client.copy(
+            copy_source, dest_bucket, dest_path, Config=self.transfer_config
+        )
 
         return (
             S3Dest(bucket=src_bucket, path=src_path),
             S3Dest(bucket=dest_bucket, path=dest_path),
         )
+
+    def copy_many(self, copies: Iterable[Tuple[S3Dest, S3Dest]]) -> List[Future]:
+        """
+        Start server-side copies of (source, dest) objects concurrently through
+        the shared transfer manager. Objects below the multipart threshold are
+        copied with a single CopyObject, larger ones in parts.
+        Returns a Future of (source, dest) per copy.
+        """
+        futures = []
+        for src, dest in copies:
+            future: Future = Future()
+            self.transfer.copy(
+                {"Bucket": src.bucket, "Key": src.path},
+                dest.bucket,
+                dest.path,
+                subscribers=[_TransferDone(future, (src, dest))],
+            )
+            futures.append(future)
+        return futures
+
+
+def get_s3_client(options: dict, bucket: str, prefix: str = "") -> S3Client:
+    """
+    Cached S3Client for this configuration. boto3 resources aren't
+    thread-safe: each thread gets its own client.
+    """
+    key = (_options_key(options), bucket, prefix, threading.get_ident())
+    return S3_CLIENTS.get(key, lambda: S3Client(options, bucket=bucket, prefix=prefix))
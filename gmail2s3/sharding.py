@@ -0,0 +1,246 @@
+import json
+import logging
+import os
+import socket
+import uuid
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Callable, List, Tuple
+
+from pydantic import BaseModel, Field
+
+from gmail2s3.gmailauth import Gmail2S3
+from gmail2s3.s3 import S3Client
+
+logger = logging.getLogger(__name__)
+
+# Windows shorter than this are not split further
+MIN_SHARD_WINDOW = timedelta(hours=1)
+
+
+class ShardLost(Exception):
+    """The lease of the shard being synced was taken by another process"""
+
+
+class Shard(BaseModel):
+    index: int = Field("...")
+    after: datetime = Field("...")
+    before: datetime = Field("...")
+    estimate: int = Field(0, description="Estimated number of emails in the window")
+
+
+class ShardLease(BaseModel):
+    owner: str = Field("...")
+    expires_at: datetime = Field("...")
+
+
+def _as_datetime(value: date | datetime) -> datetime:
+    if not isinstance(value, datetime):
+        value = datetime.combine(value, time.min)
+    if value.tzinfo is None:
+        value = value.astimezone()
+    return value
+
+
+def split_window(
+    after: datetime,
+    before: datetime,
+    max_shards: int,
+    estimate: Callable[[datetime, datetime], int],
+) -> List[Tuple[datetime, datetime, int]]:
+    """
+    Split [after, before) in up to `max_shards` windows of similar density:
+    the window with the most emails is halved until there are enough shards.
+    `estimate` returns the number of emails in a window.
+    """
+    windows = [(after, before, estimate(after, before))]
+    while len(windows) < max_shards:
+        densest = max(
+            (x for x in windows if x[1] - x[0] >= 2 * MIN_SHARD_WINDOW),
+            key=lambda x: x[2],
+            default=None,
+        )
+        if densest is None or densest[2] == 0:
+            break
+        start, end, _ = densest
+        middle = start + (end - start) / 2
+        idx = windows.index(densest)
+        windows[idx : idx + 1] = [
+            (start, middle, estimate(start, middle)),
+            (middle, end, estimate(middle, end)),
+        ]
+    return windows
+
+
+class ShardedSync:
+    """
+    Split one logical sync in date windows (shards) that several processes,
+    or pods, sync in parallel.
+    The plan and the leases are stored in the S3 bucket under
+    `shards/<sync_id>/`. A process claims a shard by writing its lease,
+    and marks it done once synced. Expired leases can be claimed again:
+    the lease is renewed while the shard is syncing, every half `lease_ttl`.
+    The plan and the leases are written with conditional PUTs, so only
+    one of the processes racing to create or take them wins.
+    """
+
+    def __init__(
+        self,
+        gmailsyncer: Gmail2S3,
+        sync_id: str,
+        shards: int = 4,
+        owner: str | None = None,
+        lease_ttl: timedelta = timedelta(hours=6),
+        s3: S3Client | None = None,
+    ):
+        self.gmailsyncer = gmailsyncer
+        self.sync_id = sync_id
+        self.shards = shards
+        self.owner = (
+            owner or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        )
+        self.lease_ttl = lease_ttl
+        self.s3 = s3 or gmailsyncer.s3
+
+    def _key(self, name: str) -> str:
+        return f"shards/{self.sync_id}/{name}"
+
+    def _read_json(self, name: str) -> dict | list | None:
+        content = self.s3.get_object(self._key(name))
+        if content is None:
+            return None
+        return json.loads(content)
+
+    def _write_json(self, name: str, value: dict | list) -> None:
+        self.s3.put_object(
+            json.dumps(value, default=str).encode("utf-8"), self._key(name)
+        )
+
+    def _write_json_if(
+        self, name: str, value: dict | list, etag: str | None = None
+    ) -> bool:
+        """Create, or replace the `etag` version of, the object. False if it lost"""
+        dest = self.s3.put_object_if(
+            json.dumps(value, default=str).encode("utf-8"), self._key(name), etag
+        )
+        return dest is not None
+
+    def _estimate(self, after: datetime, before: datetime) -> int:
+        query = self.gmailsyncer.message_query.copy(
+            update={"after": after, "before": before}
+        )
+        return self.gmailsyncer.gmail.estimate_emails(query)
+
+    def plan(self) -> List[Shard]:
+        """
+        Load the shards of the sync, or compute them if it's the first process.
+        Processes planning at once may compute different windows: only the
+        first plan written is kept and all of them read it back.
+        """
+        stored = self._read_json("plan.json")
+        if stored is None:
+            query = self.gmailsyncer.message_query
+            if not query.after:
+                raise ValueError("A sharded sync requires an 'after' date")
+            after = _as_datetime(query.after)
+            before = _as_datetime(query.before or datetime.now(timezone.utc))
+            windows = split_window(after, before, self.shards, self._estimate)
+            plan = [
+                Shard(index=i, after=start, before=end, estimate=count)
+                for i, (start, end, count) in enumerate(windows)
+            ]
+            if self._write_json_if("plan.json", [x.dict() for x in plan]):
+                logger.info("sharded sync %s: %s shards", self.sync_id, len(plan))
+            stored = self._read_json("plan.json")
+        return [Shard(**x) for x in stored]
+
+    def claim(self, shard: Shard) -> bool:
+        """Try to take the lease of a shard, returns True if this process owns it"""
+        if self._read_json(f"{shard.index}.done") is not None:
+            return False
+        now = datetime.now(timezone.utc)
+        name = f"{shard.index}.lease"
+        current = self.s3.get_object_etag(self._key(name))
+        etag = None
+        if current is not None:
+            lease = ShardLease(**json.loads(current[0]))
+            if lease.owner != self.owner and lease.expires_at > now:
+                return False
+            etag = current[1]
+        lease = ShardLease(owner=self.owner, expires_at=now + self.lease_ttl)
+        # Replace the lease only if nobody else claimed it since it was read
+        if not self._write_json_if(name, json.loads(lease.json()), etag):
+            return False
+        # Stores ignoring the conditions: the last writer wins
+        current = self._read_json(name)
+        return current is not None and current["owner"] == self.owner
+
+    def renew(self, shard: Shard) -> bool:
+        """Extend the lease of a shard owned by this process, False if it lost it"""
+        name = f"{shard.index}.lease"
+        current = self.s3.get_object_etag(self._key(name))
+        if current is None or json.loads(current[0])["owner"] != self.owner:
+            return False
+        lease = ShardLease(
+            owner=self.owner, expires_at=datetime.now(timezone.utc) + self.lease_ttl
+        )
+        return self._write_json_if(name, json.loads(lease.json()), current[1])
+
+    def _renewing(
+        self, shard: Shard, progress: Callable[[dict], None] | None
+    ) -> Callable[[dict], None]:
+        """Progress callback renewing the lease of the shard as emails are synced"""
+        renewed_at = datetime.now(timezone.utc)
+
+        def renew(item: dict) -> None:
+            nonlocal renewed_at
+            now = datetime.now(timezone.utc)
+            if now - renewed_at >= self.lease_ttl / 2:
+                if not self.renew(shard):
+                    raise ShardLost(shard.index)
+                renewed_at = now
+            if progress is not None:
+                progress(item)
+
+        return renew
+
+    def complete(self, shard: Shard, synced: int) -> None:
+        self._write_json(
+            f"{shard.index}.done",
+            {
+                "owner": self.owner,
+                "synced": synced,
+                "completed_at": datetime.now(timezone.utc).isoformat(),
+            },
+        )
+        self.s3.delete_object(self._key(f"{shard.index}.lease"))
+
+    def run(
+        self,
+        flag_label: str = "s3",
+        workers: int = 1,
+        progress: Callable[[dict], None] | None = None,
+    ) -> List[dict]:
+        """Sync all the shards this process can claim"""
+        synced_emails = []
+        for shard in self.plan():
+            if not self.claim(shard):
+                continue
+            logger.info(
+                "sync shard %s: %s -> %s", shard.index, shard.after, shard.before
+            )
+            query = self.gmailsyncer.message_query.copy(
+                update={"after": shard.after, "before": shard.before}
+            )
+            try:
+                resp = self.gmailsyncer.sync_emails(
+                    flag_label=flag_label,
+                    workers=workers,
+                    message_query=query,
+                    progress=self._renewing(shard, progress),
+                )
+            except ShardLost:
+                logger.warning("shard %s taken by another process", shard.index)
+                continue
+            self.complete(shard, len(resp))
+            synced_emails.extend(resp)
+        return synced_emails
@@ -0,0 +1,209 @@
+import fcntl
+import pathlib
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Tuple,
+    TypeVar,
+)
+
+from gmail2s3.config import GCONFIG
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# Threads shared by the syncs with workers > 1: their thread-local
+# Gmail and S3 clients are reused by the next syncs
+SYNC_THREADS = 64
+# Other threads with their own clients: main thread, default executor...
+EXTRA_CLIENT_THREADS = 8
+
+
+def client_threads() -> int:
+    """
+    Number of threads of the process keeping their own Gmail and S3 clients:
+    the sync pool, the blocking executor of the API and the jobs
+    """
+    conf = GCONFIG.gmail2s3
+    return (
+        SYNC_THREADS + conf["api_workers"] + conf["jobs_workers"] + EXTRA_CLIENT_THREADS
+    )
+
+
+def chunked(iterable: Iterable[T], size: int) -> Iterator[List[T]]:
+    """Split an iterable in lists of at most `size` items"""
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def ordered_map(
+    func: Callable[[T], R],
+    iterable: Iterable[T],
+    workers: int = 1,
+    executor: ThreadPoolExecutor | None = None,
+) -> Iterator[R]:
+    """
+    Like `map` but runs `func` on up to `workers` threads.
+    Results are yielded in the order of `iterable`. At most 2 * workers items
+    are in flight, so a lazy iterable is consumed progressively.
+    With a shared `executor`, its threads are used instead of new ones,
+    at most `workers` items are in flight, and it's left running.
+    With workers <= 1, items are processed sequentially in the calling thread.
+    """
+    if workers <= 1:
+        yield from map(func, iterable)
+        return
+    if executor is not None:
+        yield from _ordered_submit(func, iterable, executor, workers)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as own_executor:
+        yield from _ordered_submit(func, iterable, own_executor, 2 * workers)
+
+
+def _ordered_submit(
+    func: Callable[[T], R],
+    iterable: Iterable[T],
+    executor: ThreadPoolExecutor,
+    in_flight: int,
+) -> Iterator[R]:
+    pending: Deque[Future] = deque()
+    try:
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # Stop scheduling new work if the consumer stops or a task fails
+        for future in pending:
+            future.cancel()
+
+
+@contextmanager
+def file_lock(path: str) -> Iterator[None]:
+    """Exclusive lock on `path`, shared by all the processes of the host"""
+    pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a", encoding="utf-8") as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+class TTLCache:
+    """Thread-safe mapping whose entries expire `ttl` seconds after being set"""
+
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: Dict[Hashable, Tuple[float, Any]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if item[0] <= time.monotonic():
+                del self._data[key]
+                return default
+            return item[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if len(self._data) >= self.maxsize:
+                self._data = {k: v for k, v in self._data.items() if v[0] > now}
+                if len(self._data) >= self.maxsize:
+                    # Drop the entry expiring first
+                    del self._data[min(self._data, key=lambda k: self._data[k][0])]
+            self._data[key] = (now + self.ttl, value)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class ClientRegistry:
+    """
+    Bounded LRU of clients keyed by their configuration, so clients and
+    their connection pools are reused across requests.
+    Clients idle for more than `idle_ttl` seconds, or the least recently
+    used ones above `maxsize`, are dropped and closed if they have a `close`.
+    `maxsize` is a function for the registries sized from the configuration.
+    """
+
+    def __init__(self, maxsize: int | Callable[[], int] = 32, idle_ttl: float = 900):
+        self.maxsize = maxsize
+        self.idle_ttl = idle_ttl
+        self._items: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, factory: Callable[[], T]) -> T:
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items[key] = (now, item[1])
+                self._items.move_to_end(key)
+                return item[1]
+        # Build the client outside of the lock, it can be slow
+        client = factory()
+        with self._lock:
+            if key in self._items:
+                # Built concurrently by another thread, keep the first one
+                existing = self._items[key][1]
+                evicted = [client]
+            else:
+                existing = client
+                self._items[key] = (now, client)
+                evicted = self._evict(now)
+        for item in evicted:
+            _close(item)
+        return existing
+
+    def _evict(self, now: float) -> List[Any]:
+        maxsize = self.maxsize() if callable(self.maxsize) else self.maxsize
+        evicted = []
+        while self._items:
+            key, (last_used, client) = next(iter(self._items.items()))
+            if len(self._items) <= maxsize and now - last_used < self.idle_ttl:
+                break
+            del self._items[key]
+            evicted.append(client)
+        return evicted
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def clear(self) -> None:
+        with self._lock:
+            evicted = [x[1] for x in self._items.values()]
+            self._items.clear()
+        for item in evicted:
+            _close(item)
+
+
+def _close(client: Any) -> None:
+    """
+    Release the resources (threads, connections) of a dropped client,
+    with its `close` or, for the s3transfer managers, `shutdown`
+    """
+    close = getattr(client, "close", None) or getattr(client, "shutdown", None)
+    if callable(close):
+        close()
@@ -4,14 +4,26 @@ import os.path
 import base64
 import json
 
+import boto3
 import pytest
+from moto import mock_s3
 
 from gmail2s3.commands.cli import all_commands, get_parser
+from gmail2s3.s3 import S3Client
 
 
 LOCAL_DIR = os.path.dirname(__file__)
+S3CONF = {"endpoint": None, "region": "us-east-1", "access_key": "a", "secret_key": "b"}
 
 
 @pytest.fixture()
 def cli_parser():
     return get_parser(all_commands())
+
+
+@pytest.fixture()
+def s3():
+    """S3Client on the 'emails' bucket of a mocked S3"""
+    with mock_s3():
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="emails")
+        yield S3Client(S3CONF, bucket="emails", prefix="sync/")
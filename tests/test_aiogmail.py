@@ -0,0 +1,106 @@
+from collections import Counter
+from contextlib import asynccontextmanager
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from googleapiclient.errors import HttpError
+
+from gmail2s3.aiogmail import AsyncGmailClient
+from gmail2s3.gmailauth import COUNT_CACHE, MessageQuery
+
+
+# Requests received by the fake Gmail API
+CALLS = Counter()
+
+
+class FakeCreds:
+    access_token = "token"
+    access_token_expired = False
+
+
+class FakeGmailClient:
+    class client:
+        creds = FakeCreds()
+
+
+async def list_messages(request):
+    assert request.headers["Authorization"] == "Bearer token"
+    CALLS["messages.list"] += 1
+    if request.query["maxResults"] == "1":
+        return web.json_response(
+            {"messages": [{"id": "m1", "threadId": "t1"}], "resultSizeEstimate": 42}
+        )
+    if request.query.get("pageToken") == "2":
+        return web.json_response({"messages": [{"id": "m3", "threadId": "t3"}]})
+    return web.json_response(
+        {
+            "messages": [
+                {"id": "m1", "threadId": "t1"},
+                {"id": "m2", "threadId": "t2"},
+            ],
+            "nextPageToken": "2",
+        }
+    )
+
+
+async def get_message(request):
+    msg_id = request.match_info["msg_id"]
+    if msg_id == "missing":
+        return web.json_response({"error": "not found"}, status=404)
+    return web.json_response({"id": msg_id, "format": request.query["format"]})
+
+
+@asynccontextmanager
+async def fake_gmail():
+    """AsyncGmailClient connected to a local fake Gmail API"""
+    app = web.Application()
+    CALLS.clear()
+    app.router.add_get("/messages", list_messages)
+    app.router.add_get("/messages/{msg_id}", get_message)
+    async with TestServer(app) as server:
+        client = AsyncGmailClient(
+            gmail=FakeGmailClient(), api_url=str(server.make_url(""))
+        )
+        try:
+            yield client
+        finally:
+            await client.close()
+
+
+@pytest.mark.asyncio
+async def test_list_emails():
+    async with fake_gmail() as aiogmail:
+        message_list = await aiogmail.list_emails(MessageQuery(labels=["new"]))
+    assert [x["id"] for x in message_list.message_refs] == ["m1", "m2", "m3"]
+
+
+@pytest.mark.asyncio
+async def test_get_emails():
+    async with fake_gmail() as aiogmail:
+        messages = await aiogmail.get_emails([{"id": "m1"}, {"id": "m2"}], fmt="raw")
+    assert messages == {
+        "m1": {"id": "m1", "format": "raw"},
+        "m2": {"id": "m2", "format": "raw"},
+    }
+
+
+@pytest.mark.asyncio
+async def test_get_email_error():
+    async with fake_gmail() as aiogmail:
+        with pytest.raises(HttpError) as exc:
+            await aiogmail.get_email({"id": "missing"})
+    assert exc.value.resp.status == 404
+
+
+@pytest.mark.asyncio
+async def test_count_emails():
+    COUNT_CACHE.clear()
+    query = MessageQuery(labels=["count"])
+    async with fake_gmail() as aiogmail:
+        assert await aiogmail.count_emails(query) == 42
+        assert await aiogmail.count_emails(query) == 42
+        assert CALLS["messages.list"] == 1
+        assert await aiogmail.count_emails(query, exact=True) == 3
+        assert CALLS["messages.list"] == 3
+    COUNT_CACHE.clear()
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+from gmail2s3 import blobs
+from gmail2s3.blobs import BlobStore, blob_path
+from gmail2s3.ledger import SyncLedger
+
+PDF = b"%PDF-1.4 invoice"
+
+
+@pytest.fixture()
+def ledger(tmp_path):
+    ledger = SyncLedger(str(tmp_path / "ledger.db"))
+    yield ledger
+    ledger.close()
+
+
+@pytest.fixture(autouse=True)
+def forget_blobs(monkeypatch):
+    monkeypatch.setattr(blobs, "_KNOWN", set())
+
+
+def test_blob_uploaded_once(s3, ledger, monkeypatch):
+    store = BlobStore(s3, ledger)
+    first = store.put(PDF, "invoice-1.pdf").result(timeout=10)
+    assert first.path.startswith("sync/blobs/")
+    assert (first.filename, first.size) == ("invoice-1.pdf", len(PDF))
+    assert s3.get_object(first.path[len("sync/") :]) == PDF
+
+    monkeypatch.setattr(s3, "upload_many", pytest.fail)
+    monkeypatch.setattr(s3, "exists", pytest.fail)
+    second = store.put(PDF, "invoice-2.pdf").result()
+    assert second.path == first.path
+    assert second.filename == "invoice-2.pdf"
+
+
+def test_blob_known_from_ledger(s3, ledger, monkeypatch):
+    BlobStore(s3, ledger).put(PDF, "a.pdf").result(timeout=10)
+    # A new process: only the ledger knows the blob
+    monkeypatch.setattr(blobs, "_KNOWN", set())
+    monkeypatch.setattr(s3, "exists", pytest.fail)
+    monkeypatch.setattr(s3, "upload_many", pytest.fail)
+    BlobStore(s3, ledger).put(PDF, "b.pdf").result()
+
+
+def test_blob_exists_in_s3(s3, monkeypatch):
+    digest = "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"
+    s3.put_object(b"", blob_path(digest))
+    monkeypatch.setattr(s3, "upload_many", pytest.fail)
+    dest = BlobStore(s3).put(b"", "empty.txt").result()
+    assert dest.path == f"sync/{blob_path(digest)}"
+
+
+def test_blob_manifest(s3):
+    store = BlobStore(s3)
+    dests = [store.put(PDF, "a.pdf").result(timeout=10)]
+    manifest = store.put_manifest("2022/09/id1/attachments.json", dests)
+    content = json.loads(s3.get_object("2022/09/id1/attachments.json"))
+    assert manifest.path == "sync/2022/09/id1/attachments.json"
+    assert content[0]["filename"] == "a.pdf"
+    assert content[0]["path"] == dests[0].path
+    assert len(content[0]["sha256"]) == 64
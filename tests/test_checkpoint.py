@@ -0,0 +1,32 @@
+from gmail2s3.checkpoint import FileCheckpoint, S3Checkpoint
+from gmail2s3.gmailauth import MessageQuery
+
+
+def test_file_checkpoint(tmp_path):
+    checkpoint = FileCheckpoint(str(tmp_path / "sync" / "checkpoint.json"))
+    assert checkpoint.load() is None
+    checkpoint.save({"history_id": "123", "synced": 4})
+    assert checkpoint.load() == {"history_id": "123", "synced": 4}
+    checkpoint.save({"history_id": "456", "synced": 0})
+    assert checkpoint.load() == {"history_id": "456", "synced": 0}
+    assert [x.name for x in (tmp_path / "sync").iterdir()] == ["checkpoint.json"]
+
+
+def test_s3_checkpoint(s3):
+    checkpoint = S3Checkpoint(s3, "checkpoints/test.json")
+    assert checkpoint.load() is None
+    checkpoint.save({"history_id": "123", "synced": 4})
+    assert checkpoint.load() == {"history_id": "123", "synced": 4}
+    assert s3.exists("checkpoints/test.json")
+
+
+def test_s3_checkpoint_per_query(s3):
+    new = MessageQuery(labels=["new"]).json(sort_keys=True)
+    other = MessageQuery(labels=["other"]).json(sort_keys=True)
+    checkpoint = S3Checkpoint.for_query(s3, new)
+    assert checkpoint.dest == S3Checkpoint.for_query(s3, new).dest
+    assert checkpoint.dest != S3Checkpoint.for_query(s3, other).dest
+
+    checkpoint.save({"history_id": "123"})
+    assert S3Checkpoint.for_query(s3, new).load() == {"history_id": "123"}
+    assert S3Checkpoint.for_query(s3, other).load() is None
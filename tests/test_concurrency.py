@@ -0,0 +1,152 @@
+import asyncio
+import json
+import threading
+import time
+
+import httpx
+
+import pytest
+from fastapi.testclient import TestClient
+
+from gmail2s3.api import gmail2s3 as api
+from gmail2s3.api.concurrency import iter_blocking, run_blocking
+from gmail2s3.main import app
+
+
+@pytest.mark.asyncio
+async def test_run_blocking_thread():
+    name = await run_blocking(lambda: threading.current_thread().name)
+    assert name.startswith("gmail2s3-api")
+
+
+def test_sync_limit_429(monkeypatch):
+    monkeypatch.setattr(api.sync_limit, "in_flight", api.sync_limit.limit)
+    resp = TestClient(app).post("/api/v1/sync_emails", json={})
+    assert resp.status_code == 429
+    assert resp.headers["Retry-After"] == str(api.sync_limit.retry_after)
+    assert resp.json()["message"]["code"] == "too-many-requests"
+    assert api.sync_limit.in_flight == api.sync_limit.limit
+
+
+def test_copy_limit_released(monkeypatch):
+    monkeypatch.setattr(api, "_copy_s3", lambda webhook: api.CopyS3RespList())
+    body = {
+        "event": "uploaded_attachment",
+        "payload": {"message_ref": {"id": "id1"}, "s3_uploads": []},
+        "params": {"s3_copy_dest": {"bucket": "bucket", "prefix": "copy/"}},
+    }
+    for _ in range(api.copy_limit.limit + 1):
+        resp = TestClient(app).post(
+            "/api/v1/webhooks/upload_attachment/copy", json=body
+        )
+        assert resp.status_code == 200
+    assert api.copy_limit.in_flight == 0
+
+
+def test_sync_key():
+    req = api.SyncedEmailRequest(query={"labels": ["new"]}, workers=1)
+    assert api.sync_key(req) == api.sync_key(req.copy(update={"workers": 8}))
+    assert api.sync_key(req) != api.sync_key(
+        api.SyncedEmailRequest(query={"labels": ["old"]})
+    )
+
+
+def test_sync_workers_bounded():
+    resp = TestClient(app).post(
+        "/api/v1/sync_emails", json={"workers": api.SYNC_THREADS + 1}
+    )
+    assert resp.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_sync_coalesced(monkeypatch, tmp_path):
+    calls = []
+
+    def sync(req, key):
+        calls.append(key)
+        time.sleep(0.2)
+        return [{"message_id": "id1", "s3_paths": []}]
+
+    monkeypatch.setattr(api, "_sync_emails", sync)
+    async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+        resps = await asyncio.gather(
+            *[
+                client.post("/api/v1/sync_emails", json={"workers": i + 1})
+                for i in range(api.sync_limit.limit + 2)
+            ]
+        )
+    assert [x.status_code for x in resps] == [200] * len(resps)
+    assert all(x.json()["total"] == 1 for x in resps)
+    assert len(calls) == 1
+    assert not api.sync_flight.calls
+
+
+def test_sync_stream_ndjson(monkeypatch):
+    def sync(req, key):
+        for i in range(3):
+            yield {"message_id": f"id{i}", "s3_paths": []}
+
+    monkeypatch.setattr(api, "_iter_sync_emails", sync)
+    resp = TestClient(app).post(
+        "/api/v1/sync_emails", json={}, headers={"Accept": api.NDJSON}
+    )
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith(api.NDJSON)
+    lines = [json.loads(x) for x in resp.text.splitlines()]
+    assert [x.get("message_id") for x in lines[:3]] == ["id0", "id1", "id2"]
+    assert lines[3] == {"total": 3}
+    assert api.sync_limit.in_flight == 0
+
+
+def test_sync_stream_error(monkeypatch):
+    def sync(req, key):
+        yield {"message_id": "id0", "s3_paths": []}
+        raise ValueError("boom")
+
+    monkeypatch.setattr(api, "_iter_sync_emails", sync)
+    resp = TestClient(app).post(
+        "/api/v1/sync_emails", json={}, headers={"Accept": api.NDJSON}
+    )
+    lines = [json.loads(x) for x in resp.text.splitlines()]
+    assert lines[-1]["total"] == 1
+    assert "boom" in lines[-1]["error"]
+
+
+@pytest.mark.asyncio
+async def test_iter_blocking_closed_early():
+    closed = threading.Event()
+
+    def items():
+        try:
+            for i in range(1000):
+                yield i
+        finally:
+            closed.set()
+
+    result = []
+    async for item in iter_blocking(items, maxsize=2):
+        result.append(item)
+        if item == 4:
+            break
+    assert result == [0, 1, 2, 3, 4]
+    assert await run_blocking(closed.wait, 5)
+
+
+def test_copy_many_events(monkeypatch):
+    copied = []
+    monkeypatch.setattr(
+        api,
+        "_copy_s3",
+        lambda webhooks: copied.extend(webhooks) or api.CopyS3RespList(),
+    )
+    body = {
+        "event": "uploaded_attachment",
+        "payload": {"message_ref": {"id": "id1"}, "s3_uploads": []},
+        "params": {"s3_copy_dest": {"bucket": "bucket", "prefix": "copy/"}},
+    }
+    client = TestClient(app)
+    assert client.post("/api/v1/webhooks/upload_attachment/copy", json=body).ok
+    assert client.post(
+        "/api/v1/webhooks/upload_attachment/copy", json=[body, body, body]
+    ).ok
+    assert len(copied) == 4
@@ -0,0 +1,737 @@
+import base64
+import gzip
+import pathlib
+import threading
+import time
+from collections import defaultdict
+from contextlib import closing
+from datetime import datetime
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from gmail2s3.config import GCONFIG
+from gmail2s3 import gmailauth
+from gmail2s3.checkpoint import FileCheckpoint
+from gmail2s3.ledger import SyncLedger
+from gmail2s3.gmailauth import (
+    Gmail2S3,
+    GmailClient,
+    MessageFormat,
+    MessageQuery,
+    dest_format,
+)
+from gmail2s3.s3 import S3Dest
+
+
+EML = b"From: a@b.c\r\nSubject: hello\r\n\r\nworld\r\n"
+
+
+class FakeLimiter:
+    def call(self, method, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+
+class FakeRequest:
+    def __init__(self, func):
+        self.func = func
+
+    def execute(self):
+        return self.func()
+
+
+class FakeMessages:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, **params):
+        def execute():
+            index = int(params.get("pageToken", 0))
+            self.service.events.append(("list", index))
+            resp = {
+                "messages": [
+                    {"id": x, "threadId": x} for x in self.service.pages[index]
+                ]
+            }
+            if index + 1 < len(self.service.pages):
+                resp["nextPageToken"] = str(index + 1)
+            return resp
+
+        return FakeRequest(execute)
+
+    def batchModify(self, userId, body):  # pylint: disable=invalid-name
+        def execute():
+            if self.service.fail_modify:
+                raise RuntimeError("batchModify failed")
+            self.service.modified.append((body["ids"], body["addLabelIds"]))
+            return {}
+
+        return FakeRequest(execute)
+
+
+class FakeHistory:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, **params):
+        def execute():
+            self.service.events.append(("history", params))
+            if self.service.history_expired:
+                raise HttpError(httplib2.Response({"status": 404}), b"expired")
+            index = int(params.get("pageToken", 0))
+            resp = {"history": self.service.history_pages[index], "historyId": "h2"}
+            if index + 1 < len(self.service.history_pages):
+                resp["nextPageToken"] = str(index + 1)
+            return resp
+
+        return FakeRequest(execute)
+
+
+class FakeService:
+    """Fake googleapiclient Gmail resource, listing `message_ids` by pages"""
+
+    def __init__(self, message_ids, page_size=2):
+        self.pages = [
+            message_ids[i : i + page_size]
+            for i in range(0, len(message_ids), page_size)
+        ] or [[]]
+        self.events = []
+        self.modified = []
+        self.fail_modify = False
+        # Names of the threads fetching the messages
+        self.threads = []
+        # Seconds to fetch a message by id, and ids failing to be fetched
+        self.fetch_delay = {}
+        self.fail_get = set()
+        # Ids of the messages deleted since listed
+        self.deleted = set()
+        # Pages of history records, or a 404 if expired
+        self.history_pages = [[]]
+        self.history_expired = False
+
+    def users(self):
+        return self
+
+    def history(self):
+        return FakeHistory(self)
+
+    def getProfile(self, userId):  # pylint: disable=invalid-name
+        return FakeRequest(lambda: {"historyId": "h1"})
+
+    def messages(self):
+        return FakeMessages(self)
+
+
+class FakeAttachment:
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = None
+
+    def download(self):
+        self.data = f"data of {self.filename}".encode()
+
+    def dict(self):
+        return {"filename": self.filename}
+
+
+class FakeLabel:
+    def __init__(self, name, label_id):
+        self.name = name
+        self.id = label_id
+
+
+class FakeGmail:
+    """Fake simplegmail.Gmail"""
+
+    # Attachments of the fetched messages
+    attachments = ()
+
+    def __init__(self, service):
+        self.service = service
+        # System labels are named after their id
+        self.labels = {"s3": "Label_s3", "INBOX": "INBOX", "SPAM": "SPAM"}
+        self.label_lists = 0
+        # Ids of the messages fetched with this client
+        self.fetched = []
+
+    def get_message_from_ref(self, ref, with_raw=True):
+        self.service.events.append(("get", ref["id"]))
+        self.service.threads.append(threading.current_thread().name)
+        if ref["id"] in self.service.fail_get:
+            raise RuntimeError(f"get {ref['id']} failed")
+        if ref["id"] in self.service.deleted:
+            raise HttpError(httplib2.Response({"status": 404}), b"not found")
+        self.fetched.append(ref["id"])
+        # The first messages are the slowest to fetch
+        time.sleep(self.service.fetch_delay.get(ref["id"], 0))
+        message = FakeMessage(ref["id"], attachments=self.attachments)
+        message.gmail = self
+        return message
+
+    def list_labels(self):
+        self.label_lists += 1
+        return [FakeLabel(name, label_id) for name, label_id in self.labels.items()]
+
+    def get_label_id(self, name):
+        self.labels.setdefault(name, f"Label_{name}")
+        return self.labels[name]
+
+
+class FakeMessage:
+    date = datetime(2022, 1, 5)
+    raw = base64.urlsafe_b64encode(EML).decode().rstrip("=")
+
+    def __init__(self, message_id="m1", attachments=()):
+        self.id = message_id
+        self.attachments = [FakeAttachment(x) for x in attachments]
+
+    def as_simple_string(self):
+        return f"Subject: hello {self.id}\n\nworld"
+
+    def dump(self, path, as_string=False):
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as dumpfile:
+            dumpfile.write(self.as_simple_string() if as_string else "{}")
+
+
+@pytest.fixture()
+def gmail(tmp_path, monkeypatch):
+    """GmailClient on a fake Gmail API listing m0..m4 by pages of 2"""
+    service = FakeService([f"m{i}" for i in range(5)])
+    client = GmailClient(dest_dir=str(tmp_path / "dumps"))
+    client._client = FakeGmail(service)
+    client.limiter = FakeLimiter()
+    monkeypatch.setattr(client, "auth", lambda: FakeGmail(service))
+    monkeypatch.setattr(gmailauth, "get_gmail_client", lambda *args: client)
+    return client
+
+
+@pytest.fixture()
+def syncer(s3, gmail, monkeypatch):
+    monkeypatch.setitem(GCONFIG.gmail2s3, "render_workers", 0)
+    monkeypatch.setitem(GCONFIG.gmail2s3, "pdf_renderer", "fpdf")
+
+    def new(
+        formats=None, lazy_pdf=False, eml_gzip=False, ledger=None, upload_policy=None
+    ):
+        return Gmail2S3(
+            MessageQuery(),
+            s3conf=dict(
+                s3.options,
+                bucket=s3.bucket,
+                prefix=s3.prefix,
+                upload_policy=upload_policy,
+            ),
+            ledger=ledger,
+            formats=formats,
+            lazy_pdf=lazy_pdf,
+            eml_gzip=eml_gzip,
+        )
+
+    return new
+
+
+def test_sync_only_pdf(syncer, s3):
+    dests = syncer(["pdf"])._sync_dumps({"id": "m1"}, FakeMessage())
+    assert [x.path for x in dests] == ["sync/2022/01/m1/m1.pdf"]
+    assert s3.get_object("2022/01/m1/m1.pdf").startswith(b"%PDF")
+    assert not s3.exists("2022/01/m1/m1.json")
+
+
+def test_sync_lazy_pdf(syncer):
+    dests = syncer(["json", "pdf"], lazy_pdf=True)._sync_dumps(
+        {"id": "m1"}, FakeMessage()
+    )
+    # The txt dump is kept to render the PDF from
+    assert sorted(x.path for x in dests) == [
+        "sync/2022/01/m1/m1.json",
+        "sync/2022/01/m1/m1.txt",
+    ]
+    # Without the PDF format, there's nothing to render later
+    dests = syncer(["json"], lazy_pdf=True)._sync_dumps({"id": "m1"}, FakeMessage())
+    assert [x.path for x in dests] == ["sync/2022/01/m1/m1.json"]
+
+
+@pytest.mark.parametrize("eml_gzip", [False, True])
+def test_sync_eml(syncer, s3, eml_gzip):
+    dests = syncer(["eml"], eml_gzip=eml_gzip)._sync_dumps({"id": "m1"}, FakeMessage())
+    if eml_gzip:
+        assert [x.path for x in dests] == ["sync/2022/01/m1/m1.eml.gz"]
+        assert gzip.decompress(s3.get_object("2022/01/m1/m1.eml.gz")) == EML
+    else:
+        assert [x.path for x in dests] == ["sync/2022/01/m1/m1.eml"]
+        assert s3.get_object("2022/01/m1/m1.eml") == EML
+    assert dest_format("m1", dests[0]) == MessageFormat.EML
+
+
+def test_sync_without_attachments(syncer, monkeypatch):
+    gmailsyncer = syncer(["json"])
+    monkeypatch.setattr(gmailsyncer.gmail, "iter_attachments", pytest.fail)
+    _, dests = gmailsyncer.sync_email({"id": "m1"}, "", FakeMessage())
+    assert [x.path for x in dests] == ["sync/2022/01/m1/m1.json"]
+
+
+def test_dest_format():
+    def fmt(path):
+        return dest_format("m1", S3Dest(bucket="emails", path=path))
+
+    assert fmt("sync/2022/01/m1/m1.pdf") == MessageFormat.PDF
+    assert fmt("sync/2022/01/m1/m1.txt") == MessageFormat.TXT
+    assert fmt("sync/2022/01/m1/attachments/m1.pdf") == MessageFormat.ATTACHMENTS
+    assert fmt("sync/2022/01/m1/attachments/invoice.pdf") == MessageFormat.ATTACHMENTS
+    assert fmt("sync/2022/01/m1/attachments.json") == MessageFormat.ATTACHMENTS
+
+
+def _record_steps(monkeypatch):
+    """Record the sync steps run for each message"""
+    steps = defaultdict(list)
+
+    def wrap(name):
+        func = getattr(Gmail2S3, name)
+
+        def wrapped(self, message_ref, *args, **kwargs):
+            steps[message_ref["id"]].append(name)
+            return func(self, message_ref, *args, **kwargs)
+
+        monkeypatch.setattr(Gmail2S3, name, wrapped)
+
+    wrap("_sync_attachments")
+    wrap("_sync_dumps")
+    trigger = Gmail2S3.trigger_webhooks
+
+    def trigger_webhooks(self, webhtype, message_ref, attachments, s3_dests):
+        steps[message_ref["id"]].append(webhtype.value)
+        return trigger(self, webhtype, message_ref, attachments, s3_dests)
+
+    monkeypatch.setattr(Gmail2S3, "trigger_webhooks", trigger_webhooks)
+    return steps
+
+
+@pytest.mark.parametrize("workers", [2, 4])
+def test_sync_workers_same_result(syncer, monkeypatch, workers):
+    monkeypatch.setattr(FakeGmail, "attachments", ("a.pdf",))
+    expected = syncer(["json", "attachments"]).sync_emails(workers=1)
+    steps = _record_steps(monkeypatch)
+    assert syncer(["json", "attachments"]).sync_emails(workers=workers) == expected
+    assert [x["message_id"] for x in expected] == [f"m{i}" for i in range(5)]
+    assert len(steps) == 5
+    for message_steps in steps.values():
+        assert message_steps == [
+            "_sync_attachments",
+            "uploaded_attachment",
+            "_sync_dumps",
+            "synced_email",
+        ]
+
+
+def test_get_emails_in_order(gmail):
+    gmail._client.service.fetch_delay = {"m0": 0.05, "m1": 0.02}
+    refs = [{"id": f"m{i}"} for i in range(5)]
+    fetched = [(ref, message.id) for ref, message in gmail.get_emails(refs, ahead=3)]
+    assert fetched == [(ref, ref["id"]) for ref in refs]
+
+
+def test_get_emails_ahead(gmail):
+    events = gmail._client.service.events
+    refs = [{"id": f"m{i}"} for i in range(10)]
+    for i, (_, message) in enumerate(gmail.get_emails(refs, ahead=2)):
+        time.sleep(0.01)
+        # The yielded message plus at most 2 fetched ahead
+        assert len(events) <= i + 3
+        assert message.id == f"m{i}"
+    assert len(events) == 10
+
+
+def test_get_emails_client_held(gmail):
+    """The client of a yielded message isn't used until the caller moves on"""
+    refs = [{"id": f"m{i}"} for i in range(8)]
+    clients = set()
+    for _, message in gmail.get_emails(refs, ahead=4):
+        fetched = list(message.gmail.fetched)
+        time.sleep(0.01)
+        assert message.gmail.fetched == fetched
+        clients.add(message.gmail)
+    # Clients are reused: at most the messages fetched ahead plus the yielded one
+    assert 1 < len(clients) <= 5
+    assert len(gmail._fetch_clients) == len(clients)
+
+
+def test_get_emails_closed_early(gmail, monkeypatch):
+    service = gmail._client.service
+    clients = []
+
+    def auth():
+        clients.append(FakeGmail(service))
+        return clients[-1]
+
+    monkeypatch.setattr(gmail, "auth", auth)
+    refs = [{"id": f"m{i}"} for i in range(8)]
+    with closing(gmail.get_emails(refs, ahead=3)) as messages:
+        next(messages)
+    time.sleep(0.05)
+    # Nothing is fetched past the window and every client is released
+    assert len(service.events) <= 4
+    assert sorted(map(id, gmail._fetch_clients)) == sorted(map(id, clients))
+
+
+def _added(message_id, *label_ids, change="messagesAdded"):
+    return {
+        change: [
+            {
+                "message": {
+                    "id": message_id,
+                    "threadId": message_id,
+                    "labelIds": list(label_ids),
+                }
+            }
+        ]
+    }
+
+
+def test_list_history_labels(gmail):
+    service = gmail._client.service
+    service.history_pages = [
+        [_added("m1", "Label_new"), _added("m2", "Label_new", "Label_s3")],
+        [_added("m3", "Label_other"), _added("m1", "Label_new", change="labelsAdded")],
+        [_added("m4", "Label_s3", "Label_new", change="labelsAdded")],
+        [_added("m5", "Label_new", change="labelsAdded")],
+    ]
+    query = MessageQuery(labels=["new"], exclude_labels=["s3"])
+    message_list, history_id = gmail.list_history("h0", query)
+    # Labeled messages are listed once, on any page, without the excluded ones
+    assert [x["id"] for x in message_list.message_refs] == ["m1", "m5"]
+    assert history_id == "h2"
+    pages = [x[1].get("pageToken") for x in service.events if x[0] == "history"]
+    assert pages == [None, "1", "2", "3"]
+    assert service.events[0][1]["startHistoryId"] == "h0"
+
+
+def test_list_history_spam_trash_deleted(gmail):
+    service = gmail._client.service
+    service.history_pages = [
+        [_added("m1", "INBOX"), _added("m2", "SPAM"), _added("m3", "INBOX")],
+        [_added("m4", "INBOX"), _added("m1", "TRASH", change="labelsAdded")],
+        [_added("m3", change="messagesDeleted")],
+    ]
+    message_list, _ = gmail.list_history("h0", MessageQuery())
+    assert [x["id"] for x in message_list.message_refs] == ["m4"]
+    assert "messageDeleted" in service.events[0][1]["historyTypes"]
+    # Unless asked for
+    message_list, _ = gmail.list_history("h0", MessageQuery(labels=["SPAM"]))
+    assert [x["id"] for x in message_list.message_refs] == ["m2"]
+
+
+def test_list_history_search_filters(gmail):
+    service = gmail._client.service
+    service.history_pages = [[_added("m1"), _added("m7"), _added("m3")]]
+    message_list, _ = gmail.list_history("h0", MessageQuery())
+    assert [x["id"] for x in message_list.message_refs] == ["m1", "m7", "m3"]
+    assert not [x for x in service.events if x[0] == "list"]
+    # Only the messages a listing of the query returns, m0..m4
+    query = MessageQuery(before=datetime(2020, 1, 1), sender=["a@b.c"])
+    message_list, _ = gmail.list_history("h0", query)
+    assert [x["id"] for x in message_list.message_refs] == ["m1", "m3"]
+    assert [x for x in service.events if x[0] == "list"]
+
+
+def test_list_history_expired(gmail):
+    gmail._client.service.history_expired = True
+    assert gmail.list_history("h0", MessageQuery()) is None
+
+
+def test_iter_emails_full_listing(syncer, tmp_path):
+    checkpoint = FileCheckpoint(str(tmp_path / "checkpoint.json"))
+    gmailsyncer = syncer()
+    pages, history_id = gmailsyncer._iter_emails(MessageQuery(), checkpoint)
+    # First run: the whole query is listed, from the current historyId
+    assert history_id == "h1"
+    assert [[x["id"] for x in page] for page in pages] == [
+        ["m0", "m1"],
+        ["m2", "m3"],
+        ["m4"],
+    ]
+    # Without a checkpoint, there's nothing to save
+    pages, history_id = gmailsyncer._iter_emails(MessageQuery())
+    assert history_id is None
+
+
+def test_iter_emails_history(syncer, gmail, tmp_path):
+    checkpoint = FileCheckpoint(str(tmp_path / "checkpoint.json"))
+    checkpoint.save({"history_id": "h0", "synced": 5})
+    service = gmail._client.service
+    service.history_pages = [[_added("m7")]]
+    pages, history_id = syncer()._iter_emails(MessageQuery(), checkpoint)
+    assert history_id == "h2"
+    assert [[x["id"] for x in page] for page in pages] == [["m7"]]
+    assert not [x for x in service.events if x[0] == "list"]
+
+    # Expired historyId: back to a full listing
+    service.history_expired = True
+    pages, history_id = syncer()._iter_emails(MessageQuery(), checkpoint)
+    assert history_id == "h1"
+    assert len(list(pages)) == 3
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_sync_skips_deleted(syncer, gmail, workers):
+    gmail._client.service.deleted = {"m1", "m3"}
+    synced = syncer(["json"]).sync_emails(flag_label="", workers=workers)
+    assert [x["message_id"] for x in synced] == ["m0", "m2", "m4"]
+
+
+def test_flush_labels_chunks(gmail, monkeypatch):
+    monkeypatch.setattr(gmailauth, "BATCH_MODIFY_MAX_IDS", 2)
+    for i in range(5):
+        gmail.queue_labels(f"m{i}", ["Label_s3"])
+    gmail.queue_labels("m5", ["Label_other"])
+    assert gmail.flush_labels() == ["m0", "m1", "m2", "m3", "m4", "m5"]
+    assert gmail._client.service.modified == [
+        (["m0", "m1"], ["Label_s3"]),
+        (["m2", "m3"], ["Label_s3"]),
+        (["m4"], ["Label_s3"]),
+        (["m5"], ["Label_other"]),
+    ]
+    # The queue is emptied
+    assert gmail.flush_labels() == []
+
+
+def test_sync_labels_batches(syncer, gmail, monkeypatch):
+    monkeypatch.setattr(gmailauth, "BATCH_MODIFY_MAX_IDS", 2)
+    syncer().sync_emails(flag_label="s3")
+    # Flushed as soon as a batch is full, the rest at the end
+    assert gmail._client.service.modified == [
+        (["m0", "m1"], ["Label_s3"]),
+        (["m2", "m3"], ["Label_s3"]),
+        (["m4"], ["Label_s3"]),
+    ]
+
+
+def test_sync_labels_flushed_on_failure(syncer, gmail, tmp_path):
+    ledger = SyncLedger(str(tmp_path / "ledger.db"))
+    gmail._client.service.fail_get = {"m3"}
+    with pytest.raises(RuntimeError, match="get m3 failed"):
+        syncer(ledger=ledger).sync_emails(flag_label="s3")
+    # The emails synced before the failure are labelled
+    assert gmail._client.service.modified == [(["m0", "m1", "m2"], ["Label_s3"])]
+    entries = ledger.lookup([f"m{i}" for i in range(5)])
+    assert sorted(entries) == ["m0", "m1", "m2"]
+    assert all(x.labelled for x in entries.values())
+
+
+def test_sync_labels_recorded_once_applied(syncer, gmail, tmp_path):
+    ledger = SyncLedger(str(tmp_path / "ledger.db"))
+    gmail._client.service.fail_modify = True
+    with pytest.raises(RuntimeError, match="batchModify failed"):
+        syncer(ledger=ledger).sync_emails(flag_label="s3")
+    entries = ledger.lookup([f"m{i}" for i in range(5)])
+    assert len(entries) == 5
+    assert all(x.dumps and not x.labelled for x in entries.values())
+
+    # The next run only applies the labels
+    gmail._client.service.fail_modify = False
+    syncer(ledger=ledger).sync_emails(flag_label="s3")
+    assert gmail._client.service.modified == [
+        ([f"m{i}" for i in range(5)], ["Label_s3"])
+    ]
+    assert all(
+        x.completed() for x in ledger.lookup([f"m{i}" for i in range(5)]).values()
+    )
+
+
+def test_label_ids_cache(gmail, monkeypatch):
+    client = gmail._client
+    now = [1000.0]
+    monkeypatch.setattr(gmailauth.time, "monotonic", lambda: now[0])
+    assert gmail.get_label_id("s3") == "Label_s3"
+    assert gmail.get_label_id("s3") == "Label_s3"
+    assert client.label_lists == 1
+
+    # Refreshed once expired
+    now[0] += gmailauth.LABELS_CACHE_TTL
+    assert gmail.get_label_id("s3") == "Label_s3"
+    assert client.label_lists == 2
+
+    # An unknown label is looked up again, then created
+    client.labels["other"] = "Label_other"
+    assert gmail.get_label_id("other") == "Label_other"
+    assert client.label_lists == 3
+    assert gmail.get_label_id("new") == "Label_new"
+    assert client.label_lists == 4
+    assert gmail.get_label_id("new") == "Label_new"
+    assert client.label_lists == 4
+
+
+def test_iter_emails_pages(gmail):
+    events = gmail._client.service.events
+    pages = gmail.iter_emails(MessageQuery(), page_size=2)
+    # Each page is requested only when the previous one is consumed
+    assert [x["id"] for x in next(pages)] == ["m0", "m1"]
+    assert events == [("list", 0)]
+    assert [[x["id"] for x in page] for page in pages] == [["m2", "m3"], ["m4"]]
+    assert events == [("list", 0), ("list", 1), ("list", 2)]
+
+
+def _listed(events, pages):
+    return sum(len(pages[x[1]]) for x in events if x[0] == "list")
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_sync_interleaves_listing(syncer, gmail, workers):
+    service = gmail._client.service
+    service.pages = [[f"m{i}" for i in range(p * 5, p * 5 + 5)] for p in range(10)]
+    ahead = 2 * workers if workers > 1 else 0
+    yielded = []
+    for synced in syncer().iter_sync_emails(flag_label="", workers=workers):
+        yielded.append(synced["message_id"])
+        # Pages are listed as the sync progresses, at most a page ahead
+        listed = _listed(service.events, service.pages)
+        assert listed <= len(yielded) + 5 + ahead
+        fetched = len([x for x in service.events if x[0] == "get"])
+        assert fetched <= len(yielded) + gmailauth.FETCH_AHEAD + ahead
+    assert yielded == [f"m{i}" for i in range(50)]
+    # The first emails are fetched before the last pages are listed
+    events = service.events
+    assert events.index(("get", "m0")) < events.index(("list", 9))
+
+
+def test_sync_pages_ledger(syncer, gmail, tmp_path):
+    ledger = SyncLedger(str(tmp_path / "ledger.db"))
+    syncer(ledger=ledger).sync_emails(flag_label="")
+    service = gmail._client.service
+    service.events.clear()
+    service.pages = [["m0", "m5"], ["m1", "m2"]]
+    gmailsyncer = syncer(ledger=ledger)
+    synced = list(
+        gmailsyncer._sync_pages(gmailsyncer.gmail.iter_emails(MessageQuery()), "", 1)
+    )
+    # Listing order is kept, only the unknown email is fetched
+    assert [x[0]["id"] for x in synced] == ["m0", "m5", "m1", "m2"]
+    assert [x[2] is not None for x in synced] == [True, False, True, True]
+    assert [x for x in service.events if x[0] == "get"] == [("get", "m5")]
+    # Synced emails return their uploads from the ledger
+    assert synced[0][1] and all(x.path.startswith("sync/") for x in synced[0][1])
+
+
+def test_sync_ledger_new_formats(syncer, s3, tmp_path):
+    ledger = SyncLedger(str(tmp_path / "ledger.db"))
+    syncer(["attachments"], ledger=ledger).sync_emails(flag_label="")
+    entries = ledger.lookup([f"m{i}" for i in range(5)])
+    assert all(x.formats == ["attachments"] for x in entries.values())
+    assert not s3.exists("2022/01/m0/m0.json")
+
+    # The dumps of the formats added since are uploaded on the next run
+    syncer(["attachments", "json", "txt"], ledger=ledger).sync_emails(flag_label="")
+    entries = ledger.lookup([f"m{i}" for i in range(5)])
+    assert all(x.formats == ["attachments", "json", "txt"] for x in entries.values())
+    assert all(x.completed("", ["json", "txt"]) for x in entries.values())
+    assert s3.exists("2022/01/m0/m0.json") and s3.exists("2022/01/m0/m0.txt")
+    assert not s3.exists("2022/01/m0/m0.pdf")
+
+
+@pytest.mark.parametrize("formats", [["attachments"], ["eml"]])
+def test_sync_ledger_skipped_stages(syncer, tmp_path, formats):
+    ledger = SyncLedger(str(tmp_path / "ledger.db"))
+    syncer(formats, ledger=ledger).sync_emails(flag_label="s3")
+    entries = ledger.lookup([f"m{i}" for i in range(5)])
+    assert all(x.formats == formats for x in entries.values())
+    # The stages without format to upload aren't pending
+    assert ledger.entries(pending_only=True) == []
+
+
+def test_sync_workers_shared_threads(syncer, gmail):
+    service = gmail._client.service
+    syncer().sync_emails(flag_label="", workers=2)
+    syncer().sync_emails(flag_label="", workers=2)
+    # Both syncs run on the long-lived pool, whose clients are kept
+    assert len(service.threads) == 10
+    assert all(x.startswith("gmail2s3-sync") for x in service.threads)
+    assert gmailauth.sync_executor() is gmailauth.sync_executor()
+
+
+def test_gmail_client_close(gmail):
+    refs = [{"id": f"m{i}"} for i in range(3)]
+    assert len(list(gmail.get_emails(refs))) == 3
+    pool = gmail._fetch_pool
+    gmail.close()
+    assert pool._shutdown
+    assert gmail._fetch_pool is None and gmail._fetch_clients == []
+    # Still usable, e.g. by the thread it was evicted from
+    assert [x.id for _, x in gmail.get_emails(refs)] == ["m0", "m1", "m2"]
+    gmail.close()
+
+
+def _sync_twice(syncer, gmail, monkeypatch, deleted=(), **kwargs):
+    """Sync m0..m4 twice, returns what the second sync did"""
+    monkeypatch.setattr(FakeGmail, "attachments", ("a.pdf",))
+    first = syncer(**kwargs)
+    first.sync_emails(flag_label="")
+    for dest in deleted:
+        first.s3.delete_object(dest)
+    done = defaultdict(list)
+    gmailsyncer = syncer(**kwargs)
+    transfer = gmailsyncer.s3.transfer
+    upload = transfer.upload
+    monkeypatch.setattr(
+        transfer,
+        "upload",
+        lambda src, bucket, key, **kw: done["upload"].append(key)
+        or upload(src, bucket, key, **kw),
+    )
+    for name in ("render_pdf", "raw_message", "dump_message"):
+        func = getattr(gmail, name)
+        monkeypatch.setattr(
+            gmail,
+            name,
+            lambda *args, _name=name, _func=func: done[_name].append(args[0].id)
+            or _func(*args),
+        )
+    download = FakeAttachment.download
+    monkeypatch.setattr(
+        FakeAttachment,
+        "download",
+        lambda attach: done["download"].append(attach.filename) or download(attach),
+    )
+    synced = gmailsyncer.sync_emails(flag_label="")
+    assert [len(x["s3_paths"]) for x in synced] == [5] * 5
+    return done
+
+
+def test_sync_if_changed(syncer, gmail, monkeypatch):
+    formats = ["json", "txt", "pdf", "eml", "attachments"]
+    done = _sync_twice(
+        syncer, gmail, monkeypatch, formats=formats, upload_policy="if-changed"
+    )
+    # Dumps and attachments are compared, the uploaded PDFs are kept
+    assert "render_pdf" not in done
+    assert len(done["download"]) == len(done["dump_message"]) == 5
+    assert "upload" not in done
+
+
+def test_sync_if_changed_eml_gzip(syncer, gmail, monkeypatch):
+    done = _sync_twice(
+        syncer,
+        gmail,
+        monkeypatch,
+        formats=["json", "txt", "pdf", "eml", "attachments"],
+        eml_gzip=True,
+        upload_policy="if-changed",
+    )
+    assert len(done["raw_message"]) == 5
+    assert "upload" not in done
+
+
+def test_sync_if_missing(syncer, gmail, monkeypatch):
+    done = _sync_twice(
+        syncer,
+        gmail,
+        monkeypatch,
+        deleted=["2022/01/m3/m3.txt"],
+        formats=["json", "txt", "pdf", "eml", "attachments"],
+        upload_policy="if-missing",
+    )
+    # Nothing is downloaded or rendered again, but the missing txt
+    assert "render_pdf" not in done and "raw_message" not in done
+    assert "download" not in done
+    assert done["dump_message"] == ["m3"]
+    assert done["upload"] == ["sync/2022/01/m3/m3.txt"]
@@ -0,0 +1,246 @@
+import socket
+import subprocess
+import threading
+from datetime import timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+from gmail2s3.jobs import JobManager, JobStatus, JobStore
+from gmail2s3.main import app
+
+
+@pytest.fixture()
+def store(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.db"))
+    yield store
+    store.close()
+
+
+def _wait(manager, job_id, *status):
+    for _ in range(500):
+        job = manager.get(job_id)
+        if job.status in status:
+            return job
+        threading.Event().wait(0.01)
+    raise AssertionError(f"job {job_id} is {job.status}")
+
+
+def test_job_succeeded(store):
+    manager = JobManager(store)
+
+    def sync(params, progress):
+        progress.set_total(params["count"])
+        result = []
+        for i in range(params["count"]):
+            item = {"message_id": f"id{i}", "s3_paths": [{"size": 10}, {"size": None}]}
+            progress(item)
+            result.append(item)
+        return result
+
+    manager.register("sync", sync)
+    job = manager.submit("sync", {"count": 3})
+    job = _wait(manager, job.id, JobStatus.SUCCEEDED)
+    assert job.total == 3
+    assert job.processed == 3
+    assert job.bytes_uploaded == 30
+    assert len(job.result) == 3
+    manager.shutdown()
+
+
+def test_job_failed(store):
+    manager = JobManager(store)
+
+    def sync(params, progress):
+        raise ValueError("boom")
+
+    manager.register("sync", sync)
+    job = _wait(manager, manager.submit("sync", {}).id, JobStatus.FAILED)
+    assert "boom" in job.errors[0]
+    manager.shutdown()
+
+
+def test_job_cancel(store):
+    manager = JobManager(store)
+    started = threading.Event()
+    cancelled = threading.Event()
+
+    def sync(params, progress):
+        started.set()
+        cancelled.wait(5)
+        progress({"message_id": "id1", "s3_paths": []})
+        return []
+
+    manager.register("sync", sync)
+    job = manager.submit("sync", {})
+    started.wait(5)
+    assert manager.cancel(job.id).status == JobStatus.CANCELLING
+    cancelled.set()
+    job = _wait(manager, job.id, JobStatus.CANCELLED)
+    assert job.processed == 0
+    assert manager.cancel("unknown") is None
+    manager.shutdown()
+
+
+def test_store_update_concurrent(store, tmp_path):
+    manager = JobManager(store)
+    manager.register("sync", lambda params, progress: [])
+    job = manager.submit("sync", {})
+    _wait(manager, job.id, JobStatus.SUCCEEDED)
+    # Another process updating the same database
+    other = JobStore(str(tmp_path / "jobs.db"))
+
+    def increment(job_store):
+        for _ in range(50):
+
+            def update(job):
+                job.processed += 1
+
+            job_store.update(job.id, update)
+
+    threads = [threading.Thread(target=increment, args=(x,)) for x in (store, other)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert store.get(job.id).processed == 100
+    assert store.update("unknown", lambda job: None) is None
+    other.close()
+    manager.shutdown()
+
+
+def test_job_cancel_during_progress(store, tmp_path):
+    manager = JobManager(store)
+    started = threading.Event()
+
+    def sync(params, progress):
+        for i in range(10000):
+            progress({"message_id": f"id{i}", "s3_paths": [{"size": 1}]})
+            if i == 10:
+                started.set()
+        return []
+
+    manager.register("sync", sync)
+    job = manager.submit("sync", {})
+    started.wait(5)
+    # Cancelled from another process while the progress is saved
+    other = JobManager(JobStore(str(tmp_path / "jobs.db")))
+    assert other.cancel(job.id).status == JobStatus.CANCELLING
+    job = _wait(manager, job.id, JobStatus.CANCELLED)
+    assert 0 < job.processed < 10000
+    assert job.bytes_uploaded == job.processed
+    other.store.close()
+    manager.shutdown()
+
+
+def test_job_resume(store, monkeypatch):
+    dead = JobManager(store)
+    dead.register("sync", lambda params, progress: [])
+    # The job is claimed by a process that died before running it
+    monkeypatch.setattr(dead.executor, "submit", lambda *args: None)
+    job = dead.submit("sync", {})
+    assert store.get(job.id).status == JobStatus.RUNNING
+
+    manager = JobManager(store)
+    manager.register("sync", lambda params, progress: [{"message_id": "id1"}])
+    assert manager.resume() == []
+    monkeypatch.setattr("gmail2s3.jobs.JOB_STALE_AFTER", timedelta(0))
+    assert [x.id for x in manager.resume()] == [job.id]
+    job = _wait(manager, job.id, JobStatus.SUCCEEDED)
+    assert job.owner == manager.owner
+    assert job.attempts == 2
+    manager.shutdown()
+
+
+def test_job_resume_progress(store, monkeypatch):
+    def sync(params, progress):
+        progress.set_total(3)
+        for i in range(3):
+            progress({"message_id": f"id{i}", "s3_paths": [{"size": 10}]})
+        return []
+
+    dead = JobManager(store)
+    dead.register("sync", sync)
+    monkeypatch.setattr(dead.executor, "submit", lambda *args: None)
+    job = dead.submit("sync", {})
+
+    # The process died after 2 of the 3 emails
+    def progress(stored):
+        stored.total, stored.processed, stored.bytes_uploaded = 3, 2, 20
+
+    store.update(job.id, progress)
+    manager = JobManager(store)
+    manager.register("sync", sync)
+    monkeypatch.setattr("gmail2s3.jobs.JOB_STALE_AFTER", timedelta(0))
+    assert [x.id for x in manager.resume()] == [job.id]
+    job = _wait(manager, job.id, JobStatus.SUCCEEDED)
+    # The resumed sync reports all the emails again
+    assert job.processed == job.total == 3
+    assert job.bytes_uploaded == 30
+    manager.shutdown()
+
+
+def test_job_resume_dead_owner(store, monkeypatch):
+    alive = JobManager(store)
+    alive.register("sync", lambda params, progress: [])
+    monkeypatch.setattr(alive.executor, "submit", lambda *args: None)
+    running = alive.submit("sync", {})
+    dead = alive.submit("sync", {})
+    # The owner of the second job exited, right after its last heartbeat
+    process = subprocess.Popen(["true"])
+    process.wait()
+    store.update(
+        dead.id,
+        lambda job: setattr(job, "owner", f"{socket.gethostname()}-{process.pid}-x"),
+    )
+    other_host = alive.submit("sync", {})
+    store.update(other_host.id, lambda job: setattr(job, "owner", "other-host-1-x"))
+
+    manager = JobManager(store)
+    manager.register("sync", lambda params, progress: [])
+    # The heartbeats are fresh: only the job of the dead process is resumed
+    assert [x.id for x in manager.resume()] == [dead.id]
+    assert _wait(manager, dead.id, JobStatus.SUCCEEDED).owner == manager.owner
+    assert store.get(running.id).owner == alive.owner
+    assert store.get(other_host.id).status == JobStatus.RUNNING
+    manager.shutdown()
+
+
+def test_job_heartbeat(store, monkeypatch):
+    manager = JobManager(store)
+    started = threading.Event()
+    done = threading.Event()
+
+    def sync(params, progress):
+        started.set()
+        done.wait(5)
+        return []
+
+    manager.register("sync", sync)
+    job = manager.submit("sync", {})
+    started.wait(5)
+    manager.start(interval=timedelta(seconds=0.01))
+    monkeypatch.setattr("gmail2s3.jobs.JOB_STALE_AFTER", timedelta(seconds=0.1))
+    other = JobManager(store)
+    other.register("sync", lambda params, progress: [])
+    # No progress, but the heartbeats keep the job from being resumed
+    other.start(interval=timedelta(seconds=0.01))
+    for _ in range(20):
+        threading.Event().wait(0.01)
+        assert store.get(job.id).owner == manager.owner
+    done.set()
+    job = _wait(manager, job.id, JobStatus.SUCCEEDED)
+    assert job.attempts == 1
+    other.shutdown()
+    manager.shutdown()
+
+
+def test_api_sync_job(store, monkeypatch):
+    manager = JobManager(store)
+    manager.register("sync_emails", lambda params, progress: [])
+    monkeypatch.setattr(app.state, "jobs", manager, raising=False)
+    resp = TestClient(app).post("/api/v1/jobs/sync_emails", json={})
+    assert resp.status_code == 202
+    job = resp.json()
+    assert job["url"].endswith(f"/api/v1/jobs/{job['id']}")
+    manager.shutdown()
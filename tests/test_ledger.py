@@ -0,0 +1,95 @@
+import io
+import json
+import sqlite3
+
+import pytest
+
+from gmail2s3.ledger import LedgerEntry, SyncLedger, SyncStage
+
+
+@pytest.fixture()
+def ledger(tmp_path):
+    ledger = SyncLedger(str(tmp_path / "ledger.db"))
+    yield ledger
+    ledger.close()
+
+
+def test_ledger_record_stages(ledger):
+    s3_path = {"bucket": "bucket", "path": "2022/09/id1/attachments/a.pdf"}
+    ledger.record("id1", SyncStage.ATTACHMENTS, [s3_path])
+    ledger.record("id1", SyncStage.DUMPS, [])
+    entry = ledger.get("id1")
+    assert entry.attachments and entry.dumps
+    assert not entry.webhooks
+    assert entry.attachments_s3 == [s3_path]
+    assert not entry.completed()
+
+
+def test_ledger_completed(ledger):
+    for stage in [SyncStage.ATTACHMENTS, SyncStage.DUMPS, SyncStage.WEBHOOKS]:
+        ledger.record("id1", stage)
+    assert ledger.get("id1").completed(flag_label="")
+    assert not ledger.get("id1").completed(flag_label="s3")
+    ledger.record("id1", SyncStage.LABELLED)
+    assert ledger.get("id1").completed(flag_label="s3")
+
+
+def test_ledger_formats(ledger):
+    ledger.record("id1", SyncStage.ATTACHMENTS, formats=["attachments"])
+    ledger.record("id1", SyncStage.DUMPS, formats=["json"])
+    ledger.record("id1", SyncStage.WEBHOOKS)
+    entry = ledger.get("id1")
+    assert entry.formats == ["attachments", "json"]
+    assert entry.completed("", ["attachments", "json"])
+    # A format added since is pending
+    assert not entry.completed("", ["json", "pdf"])
+    ledger.record("id1", SyncStage.DUMPS, formats=["pdf"])
+    assert ledger.get("id1").formats == ["attachments", "json", "pdf"]
+    assert ledger.get("id1").completed("", ["json", "pdf"])
+
+
+def test_ledger_legacy_formats(tmp_path):
+    path = str(tmp_path / "ledger.db")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE sync_ledger (message_id TEXT PRIMARY KEY,"
+        " attachments INTEGER NOT NULL DEFAULT 0, dumps INTEGER NOT NULL DEFAULT 0,"
+        " webhooks INTEGER NOT NULL DEFAULT 0, labelled INTEGER NOT NULL DEFAULT 0,"
+        " attachments_s3 TEXT NOT NULL DEFAULT '[]',"
+        " dumps_s3 TEXT NOT NULL DEFAULT '[]', updated_at TEXT)"
+    )
+    dumps = [{"bucket": "b", "path": "2022/09/id1/id1.json"}]
+    dumps.append({"bucket": "b", "path": "2022/09/id1/id1.eml.gz"})
+    conn.execute(
+        "INSERT INTO sync_ledger (message_id, attachments, dumps, dumps_s3)"
+        " VALUES ('id1', 1, 1, ?)",
+        (json.dumps(dumps),),
+    )
+    conn.commit()
+    conn.close()
+    ledger = SyncLedger(path)
+    # The formats of the entries recorded before are inferred from their uploads
+    assert ledger.get("id1").formats == ["attachments", "eml", "json"]
+    ledger.record("id1", SyncStage.DUMPS, formats=["txt"])
+    assert ledger.get("id1").formats == ["attachments", "eml", "json", "txt"]
+    ledger.close()
+
+
+def test_ledger_lookup(ledger):
+    for i in range(1200):
+        ledger.record(f"id{i}", SyncStage.ATTACHMENTS)
+    entries = ledger.lookup([f"id{i}" for i in range(0, 1500, 2)])
+    assert len(entries) == 600
+    assert ledger.get("unknown") == LedgerEntry(message_id="unknown")
+
+
+def test_ledger_export(ledger):
+    ledger.record("id1", SyncStage.ATTACHMENTS)
+    for stage in SyncStage:
+        ledger.record("id2", stage)
+    output = io.StringIO()
+    assert ledger.export(output, pending_only=True) == 1
+    assert json.loads(output.getvalue())["message_id"] == "id1"
+    output = io.StringIO()
+    assert ledger.export(output, fmt="csv") == 2
+    assert output.getvalue().startswith("message_id,attachments")
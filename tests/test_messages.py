@@ -0,0 +1,58 @@
+from datetime import datetime
+
+import pytest
+from fastapi.testclient import TestClient
+
+from gmail2s3.api import messages
+from gmail2s3.api.gmail2s3 import get_aiogmail
+from gmail2s3.config import GCONFIG
+from gmail2s3.ledger import SyncLedger, SyncStage
+from gmail2s3.main import app
+
+
+class FakeAioGmail:
+    async def get_email_date(self, message_id):
+        return datetime(2022, 2, 1, 12)
+
+
+@pytest.fixture()
+def client(s3, tmp_path, monkeypatch):
+    for key, value in dict(s3.options, bucket=s3.bucket, prefix=s3.prefix).items():
+        monkeypatch.setitem(GCONFIG.s3, key, value)
+    monkeypatch.setitem(GCONFIG.gmail2s3, "render_workers", 0)
+    monkeypatch.setitem(GCONFIG.gmail2s3, "pdf_renderer", "fpdf")
+    ledger = SyncLedger(str(tmp_path / "ledger.db"))
+    ledger.record(
+        "m1",
+        SyncStage.DUMPS,
+        [{"bucket": "emails", "path": "sync/2022/01/m1/m1.txt"}],
+    )
+    monkeypatch.setattr(messages, "default_ledger", lambda: ledger)
+    app.dependency_overrides[get_aiogmail] = FakeAioGmail
+    yield TestClient(app)
+    app.dependency_overrides.clear()
+
+
+def test_message_pdf_rendered_once(client, s3, monkeypatch):
+    s3.put_object(b"Subject: hello\n\nworld", "2022/01/m1/m1.txt")
+    resp = client.get("/api/v1/messages/m1/pdf")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "application/pdf"
+    assert resp.content.startswith(b"%PDF")
+    assert s3.get_object("2022/01/m1/m1.pdf") == resp.content
+
+    monkeypatch.setattr(messages, "render_async", pytest.fail)
+    assert client.get("/api/v1/messages/m1/pdf").content == resp.content
+    resp = client.get("/api/v1/messages/m1/pdf?redirect=true", allow_redirects=False)
+    assert resp.status_code == 307
+    assert "sync/2022/01/m1/m1.pdf" in resp.headers["location"]
+
+
+def test_message_pdf_from_gmail_date(client, s3):
+    s3.put_object(b"Subject: hello", "2022/02/m2/m2.txt")
+    assert client.get("/api/v1/messages/m2/pdf").content.startswith(b"%PDF")
+    assert s3.exists("2022/02/m2/m2.pdf")
+
+
+def test_message_pdf_not_synced(client):
+    assert client.get("/api/v1/messages/m3/pdf").status_code == 404
@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+from gmail2s3.config import GCONFIG
+from gmail2s3.pdf import (
+    FpdfRenderer,
+    RenderPool,
+    get_renderer,
+    render_async,
+    render_pool,
+)
+
+FONT = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+TEXT = "From: a@b.c\nSubject: Rechnung\n\nGrüße,\n\tline " + "x" * 300
+
+
+def test_fpdf_latin1():
+    pdf = FpdfRenderer(font=None).render(TEXT + " ☃")
+    assert pdf.startswith(b"%PDF")
+
+
+def test_fpdf_font(tmp_path):
+    renderer = FpdfRenderer(font=FONT, cache_dir=str(tmp_path))
+    if renderer.font is None:
+        pytest.skip("DejaVu font not installed")
+    pdf = renderer.render(TEXT + " ☃")
+    assert pdf.startswith(b"%PDF")
+    assert renderer.render(TEXT).startswith(b"%PDF")
+
+
+def test_fpdf_font_non_bmp(tmp_path):
+    renderer = FpdfRenderer(font=FONT, cache_dir=str(tmp_path))
+    if renderer.font is None:
+        pytest.skip("DejaVu font not installed")
+    assert renderer.render(TEXT + " emoji 😀 𝔘").startswith(b"%PDF")
+    assert renderer.render(TEXT + " 中文 漢字 한국어").startswith(b"%PDF")
+
+
+def test_get_renderer():
+    assert isinstance(get_renderer("fpdf"), FpdfRenderer)
+    assert get_renderer("fpdf") is get_renderer("fpdf")
+    with pytest.raises(ValueError):
+        get_renderer("unknown")
+
+
+def test_get_renderer_config(monkeypatch, tmp_path):
+    monkeypatch.setitem(GCONFIG.gmail2s3, "pdf_renderer", "fpdf")
+    monkeypatch.setitem(GCONFIG.gmail2s3, "pdf_font", "")
+    renderer = get_renderer()
+    assert renderer.font is None
+    # Loading another configuration picks another renderer
+    monkeypatch.setitem(GCONFIG.gmail2s3, "pdf_font", FONT)
+    monkeypatch.setitem(GCONFIG.gmail2s3, "tmp_dir", str(tmp_path))
+    assert get_renderer() is not renderer
+    assert get_renderer() is get_renderer("fpdf", FONT, str(tmp_path / "fonts"))
+
+
+def test_render_pool_config(monkeypatch, tmp_path):
+    if not os.path.exists(FONT):
+        pytest.skip("DejaVu font not installed")
+    # Overridden in this process only, like --conf
+    monkeypatch.setitem(GCONFIG.gmail2s3, "pdf_font", FONT)
+    monkeypatch.setitem(GCONFIG.gmail2s3, "tmp_dir", str(tmp_path))
+    pool = RenderPool(workers=1, maxsize=1, renderer="fpdf")
+    try:
+        assert pool.submit(TEXT + " ☃").result(timeout=60).startswith(b"%PDF")
+    finally:
+        pool.shutdown()
+    # The worker cached the font metrics in the configured directory
+    assert os.listdir(tmp_path / "fonts")
+
+
+def test_render_pool():
+    pool = RenderPool(workers=1, maxsize=1, renderer="fpdf")
+    try:
+        futures = [pool.submit(f"{TEXT} {i}") for i in range(3)]
+        assert all(x.result(timeout=60).startswith(b"%PDF") for x in futures)
+    finally:
+        pool.shutdown()
+
+
+def test_render_async_inline(monkeypatch):
+    monkeypatch.setitem(GCONFIG.gmail2s3, "render_workers", 0)
+    monkeypatch.setitem(GCONFIG.gmail2s3, "pdf_renderer", "fpdf")
+    assert render_pool() is None
+    assert render_async(TEXT).result().startswith(b"%PDF")
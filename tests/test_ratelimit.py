@@ -0,0 +1,95 @@
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from gmail2s3.ratelimit import QuotaLimiter, is_rate_limited
+
+
+def http_error(status, content=b"{}"):
+    return HttpError(httplib2.Response({"status": status}), content)
+
+
+@pytest.fixture()
+def clock(monkeypatch):
+    """Fake clock advanced by time.sleep"""
+
+    class Clock:
+        now = 0.0
+        sleeps = []
+
+        def sleep(self, seconds):
+            self.sleeps.append(seconds)
+            self.now += seconds
+
+        def monotonic(self):
+            return self.now
+
+    fake = Clock()
+    monkeypatch.setattr("gmail2s3.ratelimit.time.sleep", fake.sleep)
+    monkeypatch.setattr("gmail2s3.ratelimit.time.monotonic", fake.monotonic)
+    return fake
+
+
+def test_is_rate_limited():
+    assert is_rate_limited(http_error(429))
+    assert is_rate_limited(
+        http_error(403, b'{"error": {"errors": [{"reason": "rateLimitExceeded"}]}}')
+    )
+    assert not is_rate_limited(http_error(403, b'{"error": "forbidden"}'))
+    assert not is_rate_limited(http_error(500))
+
+
+def test_acquire_waits_for_tokens(clock):
+    limiter = QuotaLimiter(max_rate=100)
+    assert limiter.acquire(100) == 0
+    assert limiter.acquire(50) == pytest.approx(0.5)
+
+
+def test_acquire_costly_calls_throttled(clock):
+    limiter = QuotaLimiter(max_rate=250, min_rate=5)
+    for _ in range(10):
+        limiter.on_throttle()
+    assert limiter.rate == 5
+    # A send costs 100 units whatever the rate: 20 s each at 5 units/s
+    waited = sum(limiter.acquire(100) for _ in range(3))
+    assert waited == pytest.approx(60)
+    assert clock.now == pytest.approx(60)
+
+
+def test_call_retries_and_adapts(clock):
+    limiter = QuotaLimiter(max_rate=100, increase=10)
+    calls = []
+
+    def func():
+        calls.append(1)
+        if len(calls) < 3:
+            raise http_error(429)
+        return "ok"
+
+    assert limiter.call("messages.get", func) == "ok"
+    assert len(calls) == 3
+    # halved twice then increased once
+    assert limiter.rate == 35
+
+
+def test_call_raises_other_errors(clock):
+    limiter = QuotaLimiter()
+
+    def func():
+        raise http_error(404)
+
+    with pytest.raises(HttpError):
+        limiter.call("messages.get", func)
+    assert limiter.rate == limiter.max_rate
+
+
+def test_call_gives_up(clock):
+    limiter = QuotaLimiter(retries=2)
+
+    def func():
+        raise http_error(429)
+
+    with pytest.raises(HttpError):
+        limiter.call("messages.send", func)
+    assert limiter.rate == limiter.max_rate / 4
+    assert [x for x in clock.sleeps if x >= 1] == [1, 2]
@@ -0,0 +1,170 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import pytest
+from botocore.awsrequest import AWSResponse
+
+import gmail2s3.s3
+from gmail2s3.s3 import S3Client, S3Dest
+
+
+def test_upload_file(s3, tmp_path):
+    fpath = tmp_path / "a.txt"
+    fpath.write_bytes(b"hello")
+    dest = s3.upload_file(str(fpath), "2022/09/id1/a.txt")
+    assert (dest.path, dest.size) == ("sync/2022/09/id1/a.txt", 5)
+    assert s3.get_object("missing") is None
+
+
+def test_upload_many(s3, tmp_path):
+    fpath = tmp_path / "id1.json"
+    fpath.write_bytes(b"{}")
+    futures = s3.upload_many(
+        [(str(fpath), "id1/id1.json")]
+        + [(f"data{i}".encode(), f"id1/attachments/{i}.bin") for i in range(20)]
+    )
+    dests = [x.result(timeout=10) for x in futures]
+    assert [x.path for x in dests[:2]] == [
+        "sync/id1/id1.json",
+        "sync/id1/attachments/0.bin",
+    ]
+    assert dests[0].size == 2
+    assert s3.get_object("id1/attachments/19.bin") == b"data19"
+    assert s3.transfer is s3.transfer
+
+
+def test_transfer_config():
+    config = gmail2s3.s3.transfer_config({"max_concurrency": 4})
+    assert config.max_request_concurrency == 4
+    assert config.multipart_threshold == 8 * gmail2s3.s3.MB
+
+
+def test_get_s3_client_cached():
+    conf = {
+        "endpoint": None,
+        "region": "us-east-1",
+        "access_key": "a",
+        "secret_key": "b",
+    }
+    client = gmail2s3.s3.get_s3_client(conf, bucket="emails")
+    assert gmail2s3.s3.get_s3_client(dict(conf), bucket="emails") is client
+    assert gmail2s3.s3.get_s3_client(conf, bucket="other") is not client
+    with ThreadPoolExecutor(1) as pool:
+        other = pool.submit(gmail2s3.s3.get_s3_client, conf, "emails").result()
+    assert other is not client
+
+
+@pytest.mark.parametrize(
+    "size,chunksize",
+    [(10, 8 * gmail2s3.s3.MB), (12 * gmail2s3.s3.MB, 5 * gmail2s3.s3.MB)],
+)
+def test_etag_matches_s3(s3, tmp_path, size, chunksize):
+    s3.transfer_config = gmail2s3.s3.transfer_config(
+        {"multipart_threshold": 8 * gmail2s3.s3.MB, "multipart_chunksize": chunksize}
+    )
+    fpath = tmp_path / "file.bin"
+    fpath.write_bytes(b"x" * size)
+    s3.upload_file(str(fpath), "file.bin")
+    remote = s3._head("sync/file.bin")
+    assert remote == (size, gmail2s3.s3.etag(str(fpath), s3.transfer_config))
+
+
+@pytest.mark.parametrize(
+    "policy,uploads", [("always", 2), ("if-missing", 0), ("if-changed", 1)]
+)
+def test_upload_policy(s3, monkeypatch, policy, uploads):
+    s3.put_object(b"v1", "id1/a.txt")
+    s3.put_object(b"v1", "id1/b.txt")
+    s3.upload_policy = gmail2s3.s3.UploadPolicy(policy)
+    s3.prefetch("id1/")
+    calls = []
+    transfer = s3.transfer
+    upload = transfer.upload
+    monkeypatch.setattr(
+        transfer,
+        "upload",
+        lambda *args, **kw: calls.append(args) or upload(*args, **kw),
+    )
+    monkeypatch.setattr(s3.client.meta.client, "head_object", pytest.fail)
+    futures = s3.upload_many([(b"v1", "id1/a.txt"), (b"v2", "id1/b.txt")])
+    assert [x.result(timeout=10).path for x in futures] == [
+        "sync/id1/a.txt",
+        "sync/id1/b.txt",
+    ]
+    assert len(calls) == uploads
+    if policy != "if-missing":
+        assert s3.get_object("id1/b.txt") == b"v2"
+
+
+def test_upload_many_policy(s3, monkeypatch):
+    s3.put_object(b"v1", "id1/a.txt")
+    s3.upload_policy = gmail2s3.s3.UploadPolicy.IF_CHANGED
+    monkeypatch.setattr(gmail2s3.s3.S3Client, "transfer", None)
+    dest = s3.upload_many([(b"v1", "id1/a.txt")])[0].result()
+    assert (dest.path, dest.size) == ("sync/id1/a.txt", 2)
+
+
+def test_copy_many(s3):
+    boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="copies")
+    srcs = [s3.put_object(f"data{i}".encode(), f"id{i}/a.pdf") for i in range(5)]
+    copies = [
+        (
+            src,
+            S3Dest(bucket="copies", path=s3.copy_path(src.path, "in/")),
+        )
+        for src in srcs
+    ]
+    results = [x.result(timeout=10) for x in s3.copy_many(copies)]
+    assert results == copies
+    body = boto3.client("s3", region_name="us-east-1").get_object(
+        Bucket="copies", Key="in/sync/id3/a.pdf"
+    )["Body"]
+    assert body.read() == b"data3"
+
+
+def test_copy_path():
+    assert S3Client.copy_path("a/b.pdf", "p/") == "p/a/b.pdf"
+    assert S3Client.copy_path("a/b.pdf", "p/", name_only=True) == "p/b.pdf"
+    assert S3Client.copy_path("blobs/ab/abc", "p/", True, "b.pdf") == "p/b.pdf"
+
+
+def test_put_object_if(s3):
+    sent = []
+
+    def capture(request, **kwargs):
+        headers = {k: request.headers.get(k) for k in ("If-None-Match", "If-Match")}
+        sent.append({k: v.decode() if v else v for k, v in headers.items()})
+
+    s3.client.meta.client.meta.events.register("before-send.s3.PutObject", capture)
+    assert s3.put_object_if(b"v1", "lease") is not None
+    content, tag = s3.get_object_etag("lease")
+    assert content == b"v1"
+    assert s3.put_object_if(b"v2", "lease", if_match=tag) is not None
+    assert sent == [
+        {"If-None-Match": "*", "If-Match": None},
+        {"If-None-Match": None, "If-Match": tag},
+    ]
+    assert s3.get_object("lease") == b"v2"
+    assert s3.get_object_etag("missing") is None
+
+
+class FakeRaw:
+    """Raw HTTP response body of a stubbed S3 reply"""
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+def test_put_object_if_failed(s3):
+    def precondition_failed(request, **kwargs):
+        body = b"<Error><Code>PreconditionFailed</Code></Error>"
+        return AWSResponse(request.url, 412, {}, FakeRaw(body))
+
+    # The first response is used, before moto's
+    s3.client.meta.client.meta.events.register_first(
+        "before-send.s3.PutObject", precondition_failed
+    )
+    assert s3.put_object_if(b"v1", "lease") is None
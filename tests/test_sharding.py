@@ -0,0 +1,203 @@
+import hashlib
+import time
+from datetime import datetime, timedelta, timezone
+
+from gmail2s3.gmailauth import MessageQuery
+from gmail2s3.sharding import Shard, ShardedSync, split_window
+
+AFTER = datetime(2020, 1, 1, tzinfo=timezone.utc)
+BEFORE = datetime(2022, 1, 1, tzinfo=timezone.utc)
+
+
+def test_split_window_density():
+    # All emails are in 2021
+    def estimate(start, end):
+        start = max(start, datetime(2021, 1, 1, tzinfo=timezone.utc))
+        return max(0, (end - start).days)
+
+    windows = split_window(AFTER, BEFORE, 4, estimate)
+    assert len(windows) == 4
+    assert windows[0][0] == AFTER and windows[-1][1] == BEFORE
+    assert all(a[1] == b[0] for a, b in zip(windows, windows[1:]))
+    # The empty year is not split
+    assert windows[0] == (AFTER, AFTER + (BEFORE - AFTER) / 2, 0)
+
+
+def test_split_window_empty():
+    assert split_window(AFTER, BEFORE, 4, lambda *_: 0) == [(AFTER, BEFORE, 0)]
+
+
+class FakeS3:
+    """In-memory bucket honouring the conditional PUTs, like S3"""
+
+    def __init__(self):
+        self.objects = {}
+        # Called before each conditional write, to race with it
+        self.before_put = lambda dest: None
+
+    def get_object(self, dest):
+        return self.objects.get(dest)
+
+    def get_object_etag(self, dest):
+        if dest not in self.objects:
+            return None
+        return self.objects[dest], hashlib.md5(self.objects[dest]).hexdigest()
+
+    def put_object(self, data, dest):
+        self.objects[dest] = data
+
+    def put_object_if(self, data, dest, if_match=None):
+        self.before_put(dest)
+        current = self.get_object_etag(dest)
+        if (current[1] if current else None) != if_match:
+            return None
+        self.objects[dest] = data
+        return dest
+
+    def delete_object(self, dest):
+        self.objects.pop(dest, None)
+
+
+class FakeGmail:
+    def __init__(self, estimate):
+        self.estimate = estimate
+
+    def estimate_emails(self, query):
+        return self.estimate(query.after, query.before)
+
+
+class FakeSyncer:
+    def __init__(self, s3, estimate=None, emails=0, delay=0.0, between=None):
+        self.s3 = s3
+        self.message_query = MessageQuery(after=AFTER, before=BEFORE)
+        self.gmail = FakeGmail(estimate or (lambda *_: 0))
+        # Emails synced by shard, taking `delay` seconds each
+        self.emails = emails
+        self.delay = delay
+        # Called after each synced email
+        self.between = between or (lambda: None)
+
+    def sync_emails(self, flag_label, workers, message_query, progress):
+        synced = []
+        for i in range(self.emails):
+            time.sleep(self.delay)
+            synced.append({"message_id": f"m{i}", "s3_paths": []})
+            progress(synced[-1])
+            self.between()
+        return synced
+
+
+def test_shard_leases(s3):
+    shard = Shard(index=0, after=AFTER, before=BEFORE)
+    first = ShardedSync(FakeSyncer(s3), sync_id="backfill", owner="pod-1")
+    second = ShardedSync(FakeSyncer(s3), sync_id="backfill", owner="pod-2")
+    assert first.claim(shard)
+    assert first.claim(shard)
+    assert not second.claim(shard)
+    first.complete(shard, synced=10)
+    assert not first.claim(shard)
+    assert not second.claim(shard)
+
+
+def test_shard_lease_expires(s3):
+    shard = Shard(index=1, after=AFTER, before=BEFORE)
+    first = ShardedSync(
+        FakeSyncer(s3), sync_id="backfill", owner="pod-1", lease_ttl=timedelta(0)
+    )
+    second = ShardedSync(FakeSyncer(s3), sync_id="backfill", owner="pod-2")
+    assert first.claim(shard)
+    assert second.claim(shard)
+    assert not first.claim(shard)
+
+
+def test_plan_race():
+    s3 = FakeS3()
+
+    # Pod B plans while pod A is estimating, with other estimates
+    def estimate_a(start, end):
+        if "shards/backfill/plan.json" not in s3.objects:
+            pod_b.plan()
+        return (end - start).days
+
+    def estimate_b(start, end):
+        start = max(start, datetime(2021, 1, 1, tzinfo=timezone.utc))
+        return max(0, (end - start).days)
+
+    pod_a = ShardedSync(FakeSyncer(s3, estimate_a), sync_id="backfill", owner="a")
+    pod_b = ShardedSync(FakeSyncer(s3, estimate_b), sync_id="backfill", owner="b")
+    plan = pod_a.plan()
+    assert plan == pod_b.plan()
+    # Pod B wrote first: its plan doesn't split the empty year
+    assert plan[0].after == AFTER and plan[0].estimate == 0
+    assert plan[0].before == AFTER + (BEFORE - AFTER) / 2
+
+
+def test_claim_race():
+    s3 = FakeS3()
+    shard = Shard(index=0, after=AFTER, before=BEFORE)
+    first = ShardedSync(FakeSyncer(s3), sync_id="backfill", owner="pod-1")
+    second = ShardedSync(FakeSyncer(s3), sync_id="backfill", owner="pod-2")
+
+    # Pod 2 claims the shard between the read and the write of pod 1
+    def race(dest):
+        s3.before_put = lambda dest: None
+        assert second.claim(shard)
+
+    s3.before_put = race
+    assert not first.claim(shard)
+    assert not first.claim(shard)
+    assert second.claim(shard)
+
+
+def test_claim_expired_race():
+    s3 = FakeS3()
+    shard = Shard(index=0, after=AFTER, before=BEFORE)
+    expired = ShardedSync(
+        FakeSyncer(s3), sync_id="backfill", owner="pod-0", lease_ttl=timedelta(0)
+    )
+    first = ShardedSync(FakeSyncer(s3), sync_id="backfill", owner="pod-1")
+    second = ShardedSync(FakeSyncer(s3), sync_id="backfill", owner="pod-2")
+    assert expired.claim(shard)
+
+    # Both take over the expired lease, only one of them gets it
+    def race(dest):
+        s3.before_put = lambda dest: None
+        assert second.claim(shard)
+
+    s3.before_put = race
+    assert not first.claim(shard)
+    assert not expired.claim(shard)
+
+
+def test_run_renews_lease():
+    s3 = FakeS3()
+    other = ShardedSync(FakeSyncer(s3), sync_id="backfill", owner="pod-2")
+    shard = Shard(index=0, after=AFTER, before=BEFORE)
+    stolen = []
+    syncer = FakeSyncer(
+        s3, emails=3, delay=0.25, between=lambda: stolen.append(other.claim(shard))
+    )
+    pod = ShardedSync(
+        syncer, sync_id="backfill", owner="pod-1", lease_ttl=timedelta(seconds=0.4)
+    )
+    pod._write_json("plan.json", [shard.dict()])
+    # The shard takes longer than the lease TTL but stays owned by pod-1
+    assert len(pod.run()) == 3
+    assert stolen == [False, False, False]
+    assert pod._read_json("0.done")["owner"] == "pod-1"
+
+
+def test_run_lease_lost():
+    s3 = FakeS3()
+    shard = Shard(index=0, after=AFTER, before=BEFORE)
+    syncer = FakeSyncer(s3, emails=3, delay=0.1)
+    pod = ShardedSync(
+        syncer, sync_id="backfill", owner="pod-1", lease_ttl=timedelta(seconds=0.1)
+    )
+    # Another pod takes the shard over during the sync
+    syncer.between = lambda: pod._write_json(
+        "0.lease", {"owner": "pod-2", "expires_at": BEFORE.isoformat()}
+    )
+    pod._write_json("plan.json", [shard.dict()])
+    assert pod.run() == []
+    assert pod._read_json("0.done") is None
@@ -0,0 +1,178 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from gmail2s3.config import GCONFIG
+from gmail2s3.utils import (
+    SYNC_THREADS,
+    ClientRegistry,
+    TTLCache,
+    chunked,
+    client_threads,
+    file_lock,
+    ordered_map,
+)
+
+
+def test_ordered_map_sequential():
+    assert list(ordered_map(lambda x: x * 2, [1, 2, 3])) == [2, 4, 6]
+
+
+def test_ordered_map_keeps_order():
+    def slow(x):
+        time.sleep(0.01 * (5 - x))
+        return x
+
+    assert list(ordered_map(slow, range(5), workers=4)) == list(range(5))
+
+
+def test_ordered_map_uses_threads():
+    threads = set()
+
+    def record(x):
+        threads.add(threading.get_ident())
+        time.sleep(0.01)
+        return x
+
+    list(ordered_map(record, range(8), workers=4))
+    assert len(threads) > 1
+
+
+def test_ordered_map_executor():
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def record(x):
+        with lock:
+            running.append(x)
+            peak.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(x)
+        return threading.current_thread().name
+
+    with ThreadPoolExecutor(8, thread_name_prefix="shared") as executor:
+        names = list(ordered_map(record, range(12), workers=3, executor=executor))
+        # The executor outlives the map
+        assert executor.submit(lambda: 1).result() == 1
+    assert all(x.startswith("shared") for x in names)
+    assert max(peak) <= 3
+
+
+def test_ordered_map_error():
+    def fail(x):
+        if x == 2:
+            raise ValueError("boom")
+        return x
+
+    with pytest.raises(ValueError):
+        list(ordered_map(fail, range(10), workers=2))
+
+
+def test_chunked():
+    assert list(chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(chunked([], 3)) == []
+
+
+def test_file_lock(tmp_path):
+    lock = str(tmp_path / "locks" / "sync.lock")
+    order = []
+
+    def locked(i):
+        with file_lock(lock):
+            order.append(("in", i))
+            time.sleep(0.05)
+            order.append(("out", i))
+
+    threads = [threading.Thread(target=locked, args=(i,)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [x[0] for x in order] == ["in", "out"] * 3
+
+
+def test_ttl_cache(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    cache = TTLCache(ttl=10, maxsize=2)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    now[0] += 10
+    assert cache.get("a") is None
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.set("c", 3)
+    assert cache.get("a") is None
+    assert (cache.get("b"), cache.get("c")) == (2, 3)
+
+
+def test_client_registry(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    registry = ClientRegistry(maxsize=2, idle_ttl=60)
+    first = registry.get("a", object)
+    assert registry.get("a", object) is first
+    registry.get("b", object)
+    registry.get("a", object)
+    # "b" is the least recently used
+    registry.get("c", object)
+    assert len(registry) == 2
+    assert registry.get("a", object) is first
+    now[0] += 60
+    registry.get("d", object)
+    assert len(registry) == 1
+    assert registry.get("a", object) is not first
+
+
+def test_client_registry_sized_by_config(monkeypatch):
+    monkeypatch.setitem(GCONFIG.gmail2s3, "api_workers", 8)
+    monkeypatch.setitem(GCONFIG.gmail2s3, "jobs_workers", 2)
+    # The clients of the threads of the sync pool aren't evicted
+    assert client_threads() > SYNC_THREADS + 10
+    registry = ClientRegistry(maxsize=client_threads)
+    first = registry.get(0, object)
+    for i in range(1, client_threads()):
+        registry.get(i, object)
+    assert registry.get(0, object) is first
+    monkeypatch.setitem(GCONFIG.gmail2s3, "api_workers", 4)
+    registry.get("new", object)
+    assert len(registry) == client_threads()
+
+
+class Shutdownable:
+    def __init__(self):
+        self.closed = False
+
+    def shutdown(self):
+        self.closed = True
+
+
+class Closable:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_client_registry_close(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    registry = ClientRegistry(maxsize=1, idle_ttl=60)
+    first = registry.get("a", Closable)
+    second = registry.get("b", Closable)
+    # Evicted clients are closed, without closing the live ones
+    assert first.closed and not second.closed
+    registry.clear()
+    assert second.closed
+    # Transfer managers are shut down
+    third = registry.get("c", Shutdownable)
+    registry.get("d", Closable)
+    assert third.closed
+    # Clients without close are just dropped
+    registry.get("e", object)
+    registry.get("f", object)